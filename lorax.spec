@@ -152,6 +152,7 @@ Requires: python3-rpmfluff
 Requires: git
 Requires: xz
 Requires: createrepo_c
+Recommends: python3-zstandard
 
 %{?systemd_requires}
 BuildRequires: systemd
@@ -18,8 +18,10 @@ import logging
 log = logging.getLogger("composer-cli")
 
 from datetime import datetime
+import http.client
 import sys
 import json
+import time
 
 from composer import http_client as client
 from composer.cli.help import compose_help
@@ -128,7 +130,8 @@ def compose_status(socket_path, api_version, args, show_json=False, testmode=0):
                 "status": compose["queue_status"],
                 "created": compose.get("job_created"),
                 "started": compose.get("job_started"),
-                "finished": compose.get("job_finished")}
+                "finished": compose.get("job_finished"),
+                "progress": compose.get("progress")}
 
     # Sort the status in a specific order
     def sort_status(a):
@@ -169,9 +172,25 @@ def compose_status(socket_path, api_version, args, show_json=False, testmode=0):
         dt = datetime.fromtimestamp(c.get("finished") or c.get("started") or c.get("created"))
 
         print("%s %-8s %s %-15s %s %-16s %s" % (c["id"], c["status"], dt.strftime("%c"), c["blueprint"],
-                                                c["version"], c["compose_type"], image_size))
+                                                c["version"], c["compose_type"],
+                                                image_size or format_progress(c)))
 
 
+def format_progress(compose):
+    """Return the progress of a running compose as a string
+
+    :param compose: The compose details, with the progress
+    :type compose: dict
+    :returns: The phase and the package count, eg. "install 212/417", or ""
+    :rtype: str
+    """
+    progress = compose.get("progress")
+    if compose.get("status", compose.get("queue_status")) != "RUNNING" or not progress or not progress["phase"]:
+        return ""
+    if progress["packages_total"]:
+        return "%s %d/%d" % (progress["phase"], progress["packages_done"], progress["packages_total"])
+    return progress["phase"]
+
 def compose_types(socket_path, api_version, args, show_json=False, testmode=0):
     """Return information about the supported compose types
 
@@ -253,11 +272,14 @@ def compose_log(socket_path, api_version, args, show_json=False, testmode=0):
     :param testmode: unused in this function
     :type testmode: int
 
-    compose log <uuid> [<size>kB]
+    compose log <uuid> [<size>kB] [--follow]
 
     This will display the last 1kB of the compose's log file. Can be used to follow progress
-    during the build.
+    during the build. With --follow new lines are displayed as they are written, until the
+    compose has finished.
     """
+    follow = "--follow" in args
+    args = [a for a in args if a != "--follow"]
     if len(args) == 0:
         log.error("log is missing the compose build id")
         return 1
@@ -270,6 +292,9 @@ def compose_log(socket_path, api_version, args, show_json=False, testmode=0):
     else:
         log_size = 1024
 
+    if follow:
+        return compose_log_follow(socket_path, api_version, args[0], log_size)
+
     api_route = client.api_url(api_version, "/compose/log/%s?size=%d" % (args[0], log_size))
     try:
         result = client.get_url_raw(socket_path, api_route)
@@ -280,6 +305,50 @@ def compose_log(socket_path, api_version, args, show_json=False, testmode=0):
     print(result)
     return 0
 
+def compose_log_follow(socket_path, api_version, uuid, log_size):
+    """Display the compose log as it is written
+
+    :param socket_path: Path to the Unix socket to use for API communication
+    :type socket_path: str
+    :param api_version: Version of the API to talk to. eg. "0"
+    :type api_version: str
+    :param uuid: The UUID of the compose
+    :type uuid: str
+    :param log_size: KiB of the log to display when starting
+    :type log_size: int
+    :returns: 0 if the compose finished, 1 if it failed or there was an error
+    :rtype: int
+
+    If the connection is lost it reconnects, continuing from the last event it received.
+    """
+    api_route = client.api_url(api_version, "/compose/log/%s?size=%d&follow=1" % (uuid, log_size))
+    last_id = None
+    retries = 0
+    while True:
+        try:
+            for event, data, event_id in client.get_url_events(socket_path, api_route, last_id):
+                retries = 0
+                last_id = event_id or last_id
+                if event == "log":
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+                elif event == "switch":
+                    log.debug("Following the %s log", data)
+                elif event == "end":
+                    print("Compose %s is %s" % (uuid, data))
+                    return 0 if data == "FINISHED" else 1
+        except RuntimeError as e:
+            print(str(e))
+            return 1
+        except (OSError, http.client.HTTPException) as e:
+            log.debug("Lost the connection to the log: %s", e)
+        # The connection closed before the end of the compose, continue where it stopped
+        retries += 1
+        if retries > 5:
+            log.error("Lost the connection to the API server")
+            return 1
+        time.sleep(retries)
+
 def compose_cancel(socket_path, api_version, args, show_json=False, testmode=0):
     """Cancel a running compose
 
@@ -373,6 +442,16 @@ def compose_info(socket_path, api_version, args, show_json=False, testmode=0):
                                          result["blueprint"]["version"],
                                          result["compose_type"],
                                          image_size))
+    if result["queue_status"] == "RUNNING" and result.get("progress"):
+        print("Progress: %s" % format_progress(result))
+    for image_name, checksums in sorted(result.get("checksums", {}).items()):
+        for hashname, digest in sorted(checksums.items()):
+            print("%s (%s) = %s" % (hashname.upper(), image_name, digest))
+    if result.get("stages"):
+        print("Stages:")
+        for stage in result["stages"]:
+            print("    %-24s %9.1fs%s" % (stage["stage"], stage["duration"], " (failed)" if stage["failed"] else ""))
+
     print("Packages:")
     for p in result["blueprint"]["packages"]:
         print("    %s-%s" % (p["name"], p["version"]))
@@ -495,18 +574,28 @@ def compose_image(socket_path, api_version, args, show_json=False, testmode=0):
     :param testmode: unused in this function
     :type testmode: int
 
-    compose image <uuid>
+    compose image <uuid> [--connections N]
 
     This downloads only the result image, saving it as the image name, which depends on the type
-    of compose that was selected.
+    of compose that was selected. An interrupted download is resumed when it is run again, and
+    large images are downloaded with N (default 4) parallel range requests.
     """
+    connections = 4
+    if "--connections" in args:
+        i = args.index("--connections")
+        try:
+            connections = int(args[i+1])
+        except (IndexError, ValueError):
+            log.error("--connections must be followed by the number of connections")
+            return 1
+        args = args[:i] + args[i+2:]
     if len(args) == 0:
-        log.error("logs is missing the compose build id")
+        log.error("image is missing the compose build id")
         return 1
 
     api_route = client.api_url(api_version, "/compose/image/%s" % args[0])
     try:
-        rc = client.download_file(socket_path, api_route, sys.stdout.isatty())
+        rc = client.download_file_ranges(socket_path, api_route, sys.stdout.isatty(), connections)
     except RuntimeError as e:
         print(str(e))
         rc = 1
@@ -23,13 +23,15 @@ compose types
     List the supported output types.
 
 compose status
-    List the status of all running and finished composes.
+    List the status of all running and finished composes. Running composes
+    show the phase of the installation and the number of packages installed.
 
 compose list [waiting|running|finished|failed]
     List basic information about composes.
 
-compose log <UUID> [<SIZE>]
-    Show the last SIZE kB of the compose log.
+compose log <UUID> [<SIZE>] [--follow]
+    Show the last SIZE kB of the compose log. With --follow keep showing
+    the log as it is written, until the compose has finished.
 
 compose cancel <UUID>
     Cancel a running compose and delete any intermediate results.
@@ -38,7 +40,8 @@ compose delete <UUID,...>
     Delete the listed compose results.
 
 compose info <UUID>
-    Show detailed information on the compose.
+    Show detailed information on the compose, including how long each stage
+    of the build took.
 
 compose metadata <UUID>
     Download the metadata use to create the compose to <uuid>-metadata.tar
@@ -49,8 +52,10 @@ compose logs <UUID>
 compose results <UUID>
     Download all of the compose results; metadata, logs, and image to <uuid>.tar
 
-compose image <UUID>
+compose image <UUID> [--connections <N>]
     Download the output image from the compose. Filename depends on the type.
+    An interrupted download is resumed when it is run again. Large images are
+    downloaded using N (default 4) connections.
 """
 
 blueprints_help = """
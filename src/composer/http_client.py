@@ -20,9 +20,12 @@ log = logging.getLogger("composer-cli")
 import os
 import sys
 import json
+import threading
+import time
+from http.client import HTTPException
 from urllib.parse import urlparse, urlunparse
 
-from composer.unix_socket import UnixHTTPConnectionPool
+from composer.unix_socket import UnixHTTPConnection, UnixHTTPConnectionPool
 
 def api_url(api_version, url):
     """Return the versioned path to the API route
@@ -79,6 +82,61 @@ def get_url_raw(socket_path, url):
 
     return r.data.decode('utf-8')
 
+def get_url_events(socket_path, url, last_event_id=None):
+    """Return the Server-Sent Events from a GET request as they arrive
+
+    :param socket_path: Path to the Unix socket to use for API communication
+    :type socket_path: str
+    :param url: URL to request
+    :type url: str
+    :param last_event_id: id of the last event received, to continue an earlier request
+    :type last_event_id: str
+    :returns: Tuples of (event, data, id) until the server closes the connection
+    :rtype: generator
+    :raises: RuntimeError if the server returned an error
+    """
+    headers = {"Accept": "text/event-stream"}
+    if last_event_id:
+        headers["Last-Event-ID"] = last_event_id
+    conn = UnixHTTPConnection(socket_path)
+    try:
+        conn.request("GET", url, headers=headers)
+        r = conn.getresponse()
+        if r.status != 200:
+            data = r.read().decode("utf-8")
+            try:
+                err = json.loads(data)
+                msgs = [e["msg"] for e in err["errors"]]
+            except (ValueError, KeyError, TypeError):
+                msgs = [data or r.reason]
+            raise RuntimeError(", ".join(msgs))
+
+        event, data, event_id = "message", [], None
+        while True:
+            line = r.readline()
+            if not line:
+                break
+            line = line.decode("utf-8").rstrip("\r\n")
+            if not line:
+                if data:
+                    yield (event, "\n".join(data), event_id)
+                event, data = "message", []
+            elif line.startswith(":"):
+                # A comment, sent to keep the connection open
+                continue
+            else:
+                field, _, value = line.partition(":")
+                if value.startswith(" "):
+                    value = value[1:]
+                if field == "event":
+                    event = value
+                elif field == "data":
+                    data.append(value)
+                elif field == "id":
+                    event_id = value
+    finally:
+        conn.close()
+
 def get_url_json(socket_path, url):
     """Return the JSON results of a GET request
 
@@ -258,3 +316,171 @@ def download_file(socket_path, url, progress=True):
     r.release_conn()
 
     return 0
+
+# Files smaller than this are downloaded with a single request
+PARALLEL_MIN_SIZE = 256 * 1024**2
+
+# Number of bytes read from a response at a time
+DOWNLOAD_BLOCK_SIZE = 1024**2
+
+def _split_ranges(size, count):
+    """Split a file into ranges for parallel downloads
+
+    :param int size: Size of the file
+    :param int count: Number of ranges
+    :returns: [start, end, bytes downloaded] for each range, end is not included
+    :rtype: list of lists
+    """
+    count = max(1, min(count, size))
+    step = size // count
+    starts = [i * step for i in range(count)]
+    return [[start, end, 0] for start, end in zip(starts, starts[1:] + [size])]
+
+def _read_download_state(state_path, etag, size):
+    """Read the ranges of an interrupted download
+
+    :returns: The ranges, or None if there is no state or it is for a different file
+    :rtype: list of lists or None
+    """
+    try:
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("etag") != etag or state.get("size") != size:
+        return None
+    return state["ranges"]
+
+def _write_download_state(state_path, etag, size, ranges):
+    """Save the progress of a download, replacing the old state atomically"""
+    with open(state_path + ".tmp", "w") as f:
+        json.dump({"etag": etag, "size": size, "ranges": ranges}, f)
+    os.rename(state_path + ".tmp", state_path)
+
+def download_file_ranges(socket_path, url, progress=True, connections=4):
+    """Download a file, resuming an interrupted download and using parallel range requests
+
+    :param socket_path: Path to the Unix socket to use for API communication
+    :type socket_path: str
+    :param url: URL of the file
+    :type url: str
+    :param progress: Show the progress of the download
+    :type progress: bool
+    :param connections: Maximum number of ranges to download at the same time
+    :type connections: int
+    :returns: 0
+    :rtype: int
+    :raises: RuntimeError if the download failed
+
+    The file is downloaded to FILENAME.part, with the progress saved in FILENAME.part.json,
+    and renamed once it is complete. If it is interrupted running it again will continue
+    where it stopped, as long as the ETag of the file on the server has not changed.
+    Files of PARALLEL_MIN_SIZE or more are split into several ranges. If the server does
+    not support range requests download_file() is used instead.
+    """
+    http = UnixHTTPConnectionPool(socket_path)
+    r = http.request("HEAD", url)
+    etag = r.headers.get("etag")
+    if r.status != 200 or r.headers.get("accept-ranges") != "bytes" or not etag \
+       or "content-length" not in r.headers:
+        # Let download_file report the error, or download it without ranges
+        return download_file(socket_path, url, progress)
+    size = int(r.headers["content-length"])
+
+    filename = get_filename(r.headers)
+    if os.path.exists(filename):
+        msg = "%s exists, skipping download" % filename
+        log.error(msg)
+        raise RuntimeError(msg)
+
+    part_path = filename + ".part"
+    state_path = part_path + ".json"
+    ranges = None
+    if os.path.exists(part_path):
+        ranges = _read_download_state(state_path, etag, size)
+    if ranges is None:
+        ranges = _split_ranges(size, connections if size >= PARALLEL_MIN_SIZE else 1)
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        _write_download_state(state_path, etag, size, ranges)
+    else:
+        log.info("Resuming the download of %s", filename)
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+    last_update = [0]
+
+    def update(force=False):
+        # Called with the lock held
+        now = time.time()
+        if not force and now - last_update[0] < 1:
+            return
+        last_update[0] = now
+        _write_download_state(state_path, etag, size, ranges)
+        if progress:
+            done = sum(r[2] for r in ranges)
+            sys.stdout.write("%s: %0.2f / %0.2f MB (%d%%)    \r" % (filename, done / 1024**2, size / 1024**2,
+                                                                   100 * done // max(size, 1)))
+            sys.stdout.flush()
+
+    def fetch(rng, fd):
+        retries = 0
+        while rng[0] + rng[2] < rng[1] and not stop.is_set():
+            conn = UnixHTTPConnection(socket_path)
+            try:
+                conn.request("GET", url, headers={"Range": "bytes=%d-%d" % (rng[0] + rng[2], rng[1] - 1),
+                                                  "If-Range": etag})
+                resp = conn.getresponse()
+                if resp.status != 206:
+                    raise RuntimeError("%s changed on the server while it was downloaded, "
+                                       "remove %s and try again" % (filename, part_path))
+                while not stop.is_set():
+                    data = resp.read(DOWNLOAD_BLOCK_SIZE)
+                    if not data:
+                        break
+                    os.pwrite(fd, data, rng[0] + rng[2])
+                    with lock:
+                        rng[2] += len(data)
+                        update()
+                    retries = 0
+            except (OSError, HTTPException) as e:
+                retries += 1
+                if retries > 5:
+                    raise RuntimeError("Downloading %s failed: %s" % (filename, e))
+                log.debug("Retrying the download of bytes %d-%d: %s", rng[0] + rng[2], rng[1] - 1, e)
+                time.sleep(retries)
+            finally:
+                conn.close()
+
+    def run(rng, fd):
+        try:
+            fetch(rng, fd)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+            stop.set()
+
+    fd = os.open(part_path, os.O_WRONLY)
+    threads = [threading.Thread(target=run, args=(rng, fd), daemon=True) for rng in ranges]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    finally:
+        # Stop the other downloads if it was interrupted, and save how far they got
+        stop.set()
+        for t in threads:
+            t.join()
+        os.close(fd)
+        with lock:
+            update(force=True)
+        if progress:
+            print("")
+
+    if errors:
+        raise errors[0]
+    os.rename(part_path, filename)
+    os.unlink(state_path)
+    return 0
@@ -41,7 +41,7 @@ import pylorax.output as output
 
 import dnf
 
-from pylorax.sysutils import joinpaths, remove, linktree
+from pylorax.sysutils import joinpaths, remove, linktree, set_cpu_budget, cpu_budget
 
 from pylorax.treebuilder import RuntimeBuilder, TreeBuilder
 from pylorax.buildstamp import BuildStamp
@@ -101,6 +101,7 @@ class Lorax(BaseLoraxClass):
         self.conf.set("lorax", "debug", "1")
         self.conf.set("lorax", "sharedir", "/usr/share/lorax")
         self.conf.set("lorax", "logdir", "/var/log/lorax")
+        self.conf.set("lorax", "cpus", "0")
 
         self.conf.add_section("output")
         self.conf.set("output", "colors", "1")
@@ -110,6 +111,10 @@ class Lorax(BaseLoraxClass):
         self.conf.add_section("templates")
         self.conf.set("templates", "ramdisk", "ramdisk.ltmpl")
 
+        self.conf.add_section("dnf")
+        self.conf.set("dnf", "max_parallel_downloads", "0")
+        self.conf.set("dnf", "pkgcache", "")
+
         self.conf.add_section("compression")
         self.conf.set("compression", "type", "xz")
         self.conf.set("compression", "args", "")
@@ -119,6 +124,9 @@ class Lorax(BaseLoraxClass):
         if os.path.isfile(conf_file):
             self.conf.read(conf_file)
 
+        # limit the number of cpus used by the compression and image tools
+        set_cpu_budget(self.conf.getint("lorax", "cpus"))
+
         # set up the output
         self.debug = self.conf.getboolean("lorax", "debug")
         output_level = output.DEBUG if self.debug else output.INFO
@@ -182,6 +190,7 @@ class Lorax(BaseLoraxClass):
             add_arch_templates=None,
             add_arch_template_vars=None,
             verify=True,
+            verify_libs=False,
             user_dracut_args=None,
             squashfs_only=False):
 
@@ -277,7 +286,7 @@ class Lorax(BaseLoraxClass):
 
         if self.debug:
             rb.writepkglists(joinpaths(logdir, "pkglists"))
-            rb.writepkgsizes(joinpaths(logdir, "original-pkgsizes.txt"))
+            original_pkgsizes = rb.writepkgsizes(joinpaths(logdir, "original-pkgsizes.txt"))
 
         logger.info("doing post-install configuration")
         rb.postinstall()
@@ -298,13 +307,16 @@ class Lorax(BaseLoraxClass):
 
         if verify:
             logger.info("verifying the installroot")
-            if not rb.verify():
+            # /lib and /lib64 are symlinks to these in the runtime
+            libdirs = ["/usr/lib64", "/usr/lib"] if verify_libs else None
+            if not rb.verify(libdirs=libdirs, processes=cpu_budget()):
                 sys.exit(1)
         else:
             logger.info("Skipping verify")
 
         if self.debug:
-            rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"))
+            final_pkgsizes = rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"))
+            rb.writepkgsizediff(original_pkgsizes, final_pkgsizes, joinpaths(logdir, "cleanup-pkgsizes.json"))
 
         logger.info("creating the runtime image")
         runtime = "images/install.img"
@@ -49,11 +49,13 @@ from pylorax.api.gitrpm import create_gitrpm_repo
 from pylorax.api.projects import projects_depsolve, projects_depsolve_with_size, dep_nevra
 from pylorax.api.projects import ProjectsError
 from pylorax.api.recipes import read_recipe_and_id
-from pylorax.api.timestamp import TS_CREATED, write_timestamp
+from pylorax.api.timestamp import TS_CREATED, STAGES_LOG, write_timestamp
 import pylorax.api.toml as toml
 from pylorax.base import DataHolder
-from pylorax.imgutils import default_image_name
+from pylorax.imgutils import default_image_name, image_checksums, publish_image
+from pylorax.imgutils import write_checksums_file
 from pylorax.ltmpl import LiveTemplateRunner
+from pylorax.progress import StageTimer
 from pylorax.sysutils import joinpaths, flatconfig
 
 
@@ -688,6 +690,9 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     share_dir = cfg.get("composer", "share_dir")
     lib_dir = cfg.get("composer", "lib_dir")
 
+    # The stages are written to the results directory once it has been created
+    timer = StageTimer()
+
     # Make sure compose_type is valid
     if compose_type not in compose_types(share_dir):
         raise RuntimeError("Invalid compose type (%s), must be one of %s" % (compose_type, compose_types(share_dir)))
@@ -708,13 +713,14 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     projects = sorted(set(module_nver+package_nver), key=lambda p: p[0].lower())
     deps = []
     log.info("depsolving %s", recipe["name"])
-    try:
-        # This can possibly update repodata and reset the YumBase object.
-        with dnflock.lock_check:
-            (installed_size, deps) = projects_depsolve_with_size(dnflock.dbo, projects, recipe.group_names, with_core=False)
-    except ProjectsError as e:
-        log.error("start_build depsolve: %s", str(e))
-        raise RuntimeError("Problem depsolving %s: %s" % (recipe["name"], str(e)))
+    with timer.stage("depsolve"):
+        try:
+            # This can possibly update repodata and reset the YumBase object.
+            with dnflock.lock_check:
+                (installed_size, deps) = projects_depsolve_with_size(dnflock.dbo, projects, recipe.group_names, with_core=False)
+        except ProjectsError as e:
+            log.error("start_build depsolve: %s", str(e))
+            raise RuntimeError("Problem depsolving %s: %s" % (recipe["name"], str(e)))
 
     # Read the kickstart template for this type
     ks_template_path = joinpaths(share_dir, "composer", compose_type) + ".ks"
@@ -726,12 +732,13 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     ks.readKickstartFromString(ks_template+"\n%end\n")
     pkgs = [(name, "*") for name in ks.handler.packages.packageList]
     grps = [grp.name for grp in ks.handler.packages.groupList]
-    try:
-        with dnflock.lock:
-            (template_size, _) = projects_depsolve_with_size(dnflock.dbo, pkgs, grps, with_core=not ks.handler.packages.nocore)
-    except ProjectsError as e:
-        log.error("start_build depsolve: %s", str(e))
-        raise RuntimeError("Problem depsolving %s: %s" % (recipe["name"], str(e)))
+    with timer.stage("depsolve-template"):
+        try:
+            with dnflock.lock:
+                (template_size, _) = projects_depsolve_with_size(dnflock.dbo, pkgs, grps, with_core=not ks.handler.packages.nocore)
+        except ProjectsError as e:
+            log.error("start_build depsolve: %s", str(e))
+            raise RuntimeError("Problem depsolving %s: %s" % (recipe["name"], str(e)))
     log.debug("installed_size = %d, template_size=%d", installed_size, template_size)
 
     # Minimum LMC disk size is 1GiB, and anaconda bumps the estimated size up by 10% (which doesn't always work).
@@ -742,6 +749,7 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     build_id = str(uuid4())
     results_dir = joinpaths(lib_dir, "results", build_id)
     os.makedirs(results_dir)
+    timer.set_path(joinpaths(results_dir, STAGES_LOG))
 
     # Write the recipe commit hash
     commit_path = joinpaths(results_dir, "COMMIT")
@@ -773,45 +781,47 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
         raise RuntimeError("No enabled repos, canceling build.")
 
     # Create the git rpms, if any, and return the path to the repo under results_dir
-    gitrpm_repo = create_gitrpm_repo(results_dir, recipe)
+    with timer.stage("gitrpms"):
+        gitrpm_repo = create_gitrpm_repo(results_dir, recipe)
 
     # Create the final kickstart with repos and package list
-    ks_path = joinpaths(results_dir, "final-kickstart.ks")
-    with open(ks_path, "w") as f:
-        ks_url = repo_to_ks(repos[0], "url")
-        log.debug("url = %s", ks_url)
-        f.write('url %s\n' % ks_url)
-        for idx, r in enumerate(repos[1:]):
-            ks_repo = repo_to_ks(r, "baseurl")
-            log.debug("repo composer-%s = %s", idx, ks_repo)
-            f.write('repo --name="composer-%s" %s\n' % (idx, ks_repo))
+    with timer.stage("kickstart"):
+        ks_path = joinpaths(results_dir, "final-kickstart.ks")
+        with open(ks_path, "w") as f:
+            ks_url = repo_to_ks(repos[0], "url")
+            log.debug("url = %s", ks_url)
+            f.write('url %s\n' % ks_url)
+            for idx, r in enumerate(repos[1:]):
+                ks_repo = repo_to_ks(r, "baseurl")
+                log.debug("repo composer-%s = %s", idx, ks_repo)
+                f.write('repo --name="composer-%s" %s\n' % (idx, ks_repo))
 
-        if gitrpm_repo:
-            log.debug("repo gitrpms = %s", gitrpm_repo)
-            f.write('repo --name="gitrpms" --baseurl="file://%s"\n' % gitrpm_repo)
+            if gitrpm_repo:
+                log.debug("repo gitrpms = %s", gitrpm_repo)
+                f.write('repo --name="gitrpms" --baseurl="file://%s"\n' % gitrpm_repo)
 
-        # Setup the disk for booting
-        # TODO Add GPT and UEFI boot support
-        f.write('clearpart --all --initlabel\n')
+            # Setup the disk for booting
+            # TODO Add GPT and UEFI boot support
+            f.write('clearpart --all --initlabel\n')
 
-        # Write the root partition and it's size in MB (rounded up)
-        f.write('part / --size=%d\n' % ceil(installed_size / 1024**2))
+            # Write the root partition and it's size in MB (rounded up)
+            f.write('part / --size=%d\n' % ceil(installed_size / 1024**2))
 
-        # Some customizations modify the template before writing it
-        f.write(customize_ks_template(ks_template, recipe))
+            # Some customizations modify the template before writing it
+            f.write(customize_ks_template(ks_template, recipe))
 
-        for d in deps:
-            f.write(dep_nevra(d)+"\n")
+            for d in deps:
+                f.write(dep_nevra(d)+"\n")
 
-        # Include the rpms from the gitrpm repo directory
-        if gitrpm_repo:
-            for rpm in glob(os.path.join(gitrpm_repo, "*.rpm")):
-                f.write(os.path.basename(rpm)[:-4]+"\n")
+            # Include the rpms from the gitrpm repo directory
+            if gitrpm_repo:
+                for rpm in glob(os.path.join(gitrpm_repo, "*.rpm")):
+                    f.write(os.path.basename(rpm)[:-4]+"\n")
 
-        f.write("%end\n")
+            f.write("%end\n")
 
-        # Other customizations can be appended to the kickstart
-        add_customizations(f, recipe)
+            # Other customizations can be appended to the kickstart
+            add_customizations(f, recipe)
 
     # Setup the config to pass to novirt_install
     log_dir = joinpaths(results_dir, "logs/")
@@ -831,10 +841,14 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     cfg_args["extra_boot_args"] = get_kernel_append(recipe)
 
     if "compression" not in cfg_args:
-        cfg_args["compression"] = "xz"
+        cfg_args["compression"] = cfg.get_default("compression", "type", "xz")
+        if cfg_args["make_tar"]:
+            cfg_args["image_name"] = default_image_name(cfg_args["compression"], "root.tar")
 
     if "compress_args" not in cfg_args:
-        cfg_args["compress_args"] = []
+        cfg_args["compress_args"] = cfg.get_default("compression", "args", "").split()
+
+    cfg_args["compress_threads"] = int(cfg.get_default("compression", "threads", "0"))
 
     cfg_args.update({
         "ks":               [ks_path],
@@ -1188,15 +1202,37 @@ def move_compose_results(cfg, results_dir):
     :type cfg: DataHolder
     :param results_dir: Directory to put the results into
     :type results_dir: str
+
+    The image is renamed if the compose directory is on the same filesystem as the
+    results, otherwise it is reflinked or copied (and checksummed while copying). A
+    copy must match the sha256 recorded when the image was written, if there is one.
+    The sha256 of the image is written to a CHECKSUMS file in results_dir when it was
+    calculated while the image was written or copied. The image is not read again to
+    calculate it. The tar based outputs are hashed by the compressor. qemu-img needs to
+    seek in its output, implantisomd5 changes the iso after it is written, and anaconda
+    writes the raw disk images, so these only have a checksum when they were copied
+    from another filesystem.
     """
     if cfg["make_tar"]:
-        shutil.move(joinpaths(cfg["result_dir"], cfg["image_name"]), results_dir)
+        src = joinpaths(cfg["result_dir"], cfg["image_name"])
     elif cfg["make_iso"]:
         # Output from live iso is always a boot.iso under images/, move and rename it
-        shutil.move(joinpaths(cfg["result_dir"], cfg["iso_name"]), joinpaths(results_dir, cfg["image_name"]))
+        src = joinpaths(cfg["result_dir"], cfg["iso_name"])
     elif cfg["make_disk"] or cfg["make_fsimage"]:
-        shutil.move(joinpaths(cfg["result_dir"], cfg["image_name"]), joinpaths(results_dir, cfg["image_name"]))
-
+        src = joinpaths(cfg["result_dir"], cfg["image_name"])
+    else:
+        src = None
+
+    if src:
+        dst = joinpaths(results_dir, cfg["image_name"])
+        method = publish_image(src, dst)
+        log.info("Moved %s to %s using %s", src, dst, method)
+        checksums = image_checksums(dst, compute=False)
+        if checksums:
+            log.info("%s sha256: %s", cfg["image_name"], checksums["sha256"])
+            write_checksums_file(joinpaths(results_dir, "CHECKSUMS"), {cfg["image_name"]: checksums})
+        else:
+            log.debug("No checksum of %s was calculated while it was written", cfg["image_name"])
 
     # Cleanup the compose directory, but only if it looks like a compose directory
     if os.path.basename(cfg["result_dir"]) == "compose":
@@ -19,6 +19,7 @@ import grp
 import os
 import pwd
 
+from pylorax.imgutils import COMPRESSION_TYPES
 from pylorax.sysutils import joinpaths
 
 class ComposerConfig(configparser.ConfigParser):
@@ -68,6 +69,57 @@ def configure(conf_file="/etc/lorax/composer.conf", root_dir="/", test_config=Fa
 
     return conf
 
+def check_compression(conf):
+    """Check the [compression] settings, replacing bad values with the defaults
+
+    :param conf: The configuration to check
+    :type conf: ComposerConfig
+    :returns: list of warnings about the values that were replaced
+    :rtype: list of str
+    """
+    warnings = []
+    if not conf.has_section("compression"):
+        return warnings
+
+    ctype = conf.get_default("compression", "type", "xz")
+    if ctype not in COMPRESSION_TYPES:
+        warnings.append("Unknown compression type %s, using xz" % ctype)
+        conf.set("compression", "type", "xz")
+
+    threads = conf.get_default("compression", "threads", "0")
+    try:
+        if int(threads) < 0:
+            raise ValueError
+    except ValueError:
+        warnings.append("Invalid compression threads %s, using 0 (all of the cpus)" % threads)
+        conf.set("compression", "threads", "0")
+
+    return warnings
+
+# Numeric options in the [composer] section, with their type and default
+NUMERIC_OPTIONS = [("cpus", int, "0"),
+                   ("lock_warn_seconds", float, "0"),
+                   ("profile_max", int, "500")]
+
+def check_numeric_options(conf):
+    """Check the numeric [composer] settings, replacing bad values with the defaults
+
+    :param conf: The configuration to check
+    :type conf: ComposerConfig
+    :returns: list of warnings about the values that were replaced
+    :rtype: list of str
+    """
+    warnings = []
+    for option, convert, default in NUMERIC_OPTIONS:
+        value = conf.get_default("composer", option, default)
+        try:
+            if convert(value) < 0:
+                raise ValueError
+        except ValueError:
+            warnings.append("Invalid %s %s, using %s" % (option, value, default))
+            conf.set("composer", option, default)
+    return warnings
+
 def make_owned_dir(p_dir, uid, gid):
     """Make a directory and its parents, setting owner and group
 
@@ -24,10 +24,10 @@ import dnf.logging
 from glob import glob
 import os
 import shutil
-from threading import Lock
 import time
 
 from pylorax import DEFAULT_PLATFORM_ID
+from pylorax.api.metrics import TimedLock, DNF_METADATA_REFRESH
 from pylorax.sysutils import flatconfig
 
 class DNFLock(object):
@@ -38,7 +38,7 @@ class DNFLock(object):
     """
     def __init__(self, conf, expire_secs=6*60*60):
         self._conf = conf
-        self._lock = Lock()
+        self._lock = TimedLock("dnf")
         self.dbo = get_base_object(self._conf)
         self._expire_secs = expire_secs
         self._expire_time = time.time() + self._expire_secs
@@ -63,6 +63,7 @@ class DNFLock(object):
         """
         self._expire_time = time.time() + self._expire_secs
         self.dbo.update_cache()
+        DNF_METADATA_REFRESH.inc()
         return self._lock
 
 def get_base_object(conf):
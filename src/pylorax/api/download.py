@@ -0,0 +1,290 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Send files and tar archives of the compose results
+
+Single files are sent with support for conditional and range requests, which lets
+clients resume an interrupted download of a large image, or download it in several
+pieces at the same time. Tar archives are created while they are sent, so their
+size is known before they are sent when they are not compressed.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+from calendar import timegm
+import grp
+import mimetypes
+import os
+import pwd
+import re
+import stat
+import tarfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from flask import Response
+from werkzeug.http import http_date, parse_date, quote_etag, unquote_etag
+from werkzeug.wsgi import wrap_file
+
+# Size of the blocks read from the file when sending part of it
+BLOCK_SIZE = 1024**2
+
+def file_etag(path, checksums=None):
+    """Return the entity tag for a file
+
+    :param str path: Path to the file
+    :param dict checksums: {hashname: hexdigest} of the file, or None
+    :returns: The unquoted entity tag
+    :rtype: str
+
+    The sha256 of the file is used when it is known, otherwise the tag is made
+    from the inode, size and modification time of the file.
+    """
+    if checksums and "sha256" in checksums:
+        return "sha256-%s" % checksums["sha256"]
+    st = os.stat(path)
+    return "%x-%x-%x" % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def parse_range(header, size):
+    """Parse a Range header with a single byte range
+
+    :param str header: The value of the Range header
+    :param int size: Size of the file
+    :returns: (first, last) byte positions, both included, or None to send the whole file
+    :rtype: tuple of int or None
+    :raises: ValueError if the range cannot be satisfied
+
+    Headers that cannot be parsed and multiple ranges are ignored, and the whole
+    file is sent, which is allowed by RFC 7233.
+    """
+    m = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if not m.group(1):
+        # The last N bytes
+        length = int(m.group(2))
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return (max(0, size - length), size - 1)
+    first = int(m.group(1))
+    last = int(m.group(2)) if m.group(2) else size - 1
+    if first >= size:
+        raise ValueError("Range starts after the end of the file")
+    if last < first:
+        return None
+    return (first, min(last, size - 1))
+
+def _read_range(path, first, length):
+    """Yield the bytes of part of a file"""
+    with open(path, "rb") as f:
+        f.seek(first)
+        while length > 0:
+            data = f.read(min(length, BLOCK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+def send_file_range(request, path, filename, checksums=None):
+    """Return a Response for a file download that supports Range, If-Range and ETags
+
+    :param request: The current Flask request
+    :param str path: Path to the file
+    :param str filename: Filename to save the file as, sent in the Content-Disposition header
+    :param dict checksums: {hashname: hexdigest} of the file, used for the ETag
+    :returns: A 200, 206, 304, or 416 Response
+    :rtype: flask.Response
+
+    The whole file is sent with the server's wsgi.file_wrapper if it has one, so that
+    servers that support it can use sendfile.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = file_etag(path, checksums)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    headers = [("Accept-Ranges", "bytes"),
+               ("ETag", quote_etag(etag)),
+               ("Last-Modified", http_date(st.st_mtime)),
+               ("Content-Disposition", "attachment; filename=%s;" % filename)]
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and (if_none_match.strip() == "*" or
+                          etag in [unquote_etag(t.strip())[0] for t in if_none_match.split(",")]):
+        return Response(status=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    if range_header and if_range:
+        # Only send part of the file if it has not changed
+        if if_range.strip().startswith(('"', 'W/"')):
+            if unquote_etag(if_range.strip()) != (etag, False):
+                range_header = None
+        else:
+            since = parse_date(if_range)
+            if since is None or int(st.st_mtime) > timegm(since.utctimetuple()):
+                range_header = None
+    if range_header:
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            headers.append(("Content-Range", "bytes */%d" % size))
+            return Response(status=416, headers=headers)
+
+    if byte_range is None:
+        headers.append(("Content-Length", str(size)))
+        body = wrap_file(request.environ, open(path, "rb"), BLOCK_SIZE)
+        return Response(body, status=200, mimetype=mimetype,
+                        headers=headers, direct_passthrough=True)
+
+    first, last = byte_range
+    log.debug("Sending bytes %d-%d of %s", first, last, path)
+    headers.append(("Content-Range", "bytes %d-%d/%d" % (first, last, size)))
+    headers.append(("Content-Length", str(last - first + 1)))
+    return Response(_read_range(path, first, last - first + 1), status=206,
+                    mimetype=mimetype, headers=headers,
+                    direct_passthrough=True)
+
+# Compressions supported by TarStream, and the suffix and mime type of the archive
+TAR_COMPRESSIONS = {None:   (".tar", "application/x-tar"),
+                    "gzip": (".tar.gz", "application/gzip"),
+                    "zstd": (".tar.zst", "application/zstd")}
+
+class TarStream(object):
+    """A tar archive that is created while it is read
+
+    :param str root: Directory the paths are relative to
+    :param list paths: Files and directories to include, relative to root. Directories
+                       are included with all of their contents.
+    :param str compression: None, "gzip", or "zstd"
+    :raises: ValueError if the compression is not supported
+
+    The members are found and their headers are created when the object is created, so
+    that the size of an uncompressed archive is known before it is sent. Iterating over
+    it returns the archive's data. A file that changes size while it is being sent is
+    truncated or padded with zeros to the size it had when it was added, so that the
+    archive is still valid and the size is still correct.
+    """
+    def __init__(self, root, paths, compression=None):
+        if compression not in TAR_COMPRESSIONS:
+            raise ValueError("Unknown compression: %s" % compression)
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression is not available, python3-zstandard is not installed")
+        self.compression = compression
+        self.members = []
+        for path in paths:
+            self._add(root, path)
+
+        # The archive ends with two zero blocks, and is padded to a full record like tar does
+        self._tar_size = sum(len(header) + self._padded(member.size) for member, header, _ in self.members)
+        self._tar_size += 2 * tarfile.BLOCKSIZE
+        self._end_padding = 2 * tarfile.BLOCKSIZE + (-self._tar_size % tarfile.RECORDSIZE)
+        self._tar_size += -self._tar_size % tarfile.RECORDSIZE
+
+    @staticmethod
+    def _padded(size):
+        return size + (-size % tarfile.BLOCKSIZE)
+
+    def _add(self, root, path):
+        full_path = os.path.join(root, path)
+        st = os.lstat(full_path)
+        member = tarfile.TarInfo(path)
+        if stat.S_ISREG(st.st_mode):
+            member.size = st.st_size
+        elif stat.S_ISDIR(st.st_mode):
+            member.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            member.type = tarfile.SYMTYPE
+            member.linkname = os.readlink(full_path)
+        else:
+            # Sockets, devices and fifos are not expected in the results
+            log.debug("Skipping %s, unsupported file type %o", full_path, st.st_mode)
+            return
+        member.mode = stat.S_IMODE(st.st_mode)
+        member.mtime = int(st.st_mtime)
+        member.uid = st.st_uid
+        member.gid = st.st_gid
+        try:
+            member.uname = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError:
+            pass
+        try:
+            member.gname = grp.getgrgid(st.st_gid).gr_name
+        except KeyError:
+            pass
+
+        header = member.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+        self.members.append((member, header, full_path))
+        if member.isdir():
+            for name in sorted(os.listdir(full_path)):
+                self._add(root, os.path.join(path, name))
+
+    @property
+    def size(self):
+        """Size of the archive, or None if it is compressed"""
+        if self.compression is None:
+            return self._tar_size
+        return None
+
+    @property
+    def filename_suffix(self):
+        return TAR_COMPRESSIONS[self.compression][0]
+
+    @property
+    def mimetype(self):
+        return TAR_COMPRESSIONS[self.compression][1]
+
+    def _tar_data(self):
+        """Yield the uncompressed tar archive"""
+        for member, header, full_path in self.members:
+            yield header
+            if not member.isreg():
+                continue
+            remaining = member.size
+            with open(full_path, "rb") as f:
+                while remaining > 0:
+                    data = f.read(min(remaining, BLOCK_SIZE))
+                    if not data:
+                        log.warning("%s is shorter than when the archive was started", full_path)
+                        break
+                    remaining -= len(data)
+                    yield data
+            if remaining > 0:
+                yield bytes(remaining)
+            if member.size % tarfile.BLOCKSIZE:
+                yield bytes(tarfile.BLOCKSIZE - member.size % tarfile.BLOCKSIZE)
+        yield bytes(self._end_padding)
+
+    def __iter__(self):
+        if self.compression is None:
+            return self._tar_data()
+        return self._compressed_data()
+
+    def _compressed_data(self):
+        """Yield the compressed tar archive"""
+        if self.compression == "gzip":
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        else:
+            compressor = zstandard.ZstdCompressor().compressobj()
+        for data in self._tar_data():
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
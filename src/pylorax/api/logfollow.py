@@ -0,0 +1,326 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Follow the log of a compose as it is written
+
+The log that is followed switches between the anaconda log, the packaging log
+and the combined log as the compose progresses, see uuid_log_path(). The offset
+reached in each of them is kept in a cursor string so that a client can reconnect
+and continue where it stopped, without the server sending the same data again.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+
+# lorax-composer runs under gevent, waiting with its select and sleep lets
+# the other requests be handled while a log is being followed.
+try:
+    from gevent.select import select
+    from gevent import sleep
+except ImportError:
+    from select import select
+    from time import sleep
+
+from pylorax.api.queue import RUNNING_LOGS, uuid_log_path
+from pylorax.sysutils import joinpaths
+
+# Events from inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event without the name: wd, mask, cookie, len
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+# Seconds between checks when inotify is not available
+POLL_INTERVAL = 1
+
+# Largest amount of log, in bytes, sent in one event
+MAX_CHUNK = 1024**2
+
+LOG_NAMES = ("anaconda", "packaging", "combined")
+
+class Inotify(object):
+    """Wait for files in a set of directories to change
+
+    inotify is used through ctypes. When it is not available wait() sleeps for
+    POLL_INTERVAL and returns False, so the caller falls back to polling the files.
+    """
+    def __init__(self):
+        self.fd = None
+        self.watches = {}
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            log.debug("inotify is not available, polling the logs: %s", e)
+            return
+        if fd < 0:
+            log.debug("inotify_init1 failed, polling the logs: %s", os.strerror(ctypes.get_errno()))
+            return
+        self.fd = fd
+
+    def watch(self, path):
+        """Watch a directory for files being written, created, or removed
+
+        :param str path: Path to the directory
+
+        Directories that are already watched, or that do not exist yet, are skipped.
+        """
+        if self.fd is None or path in self.watches.values() or not os.path.isdir(path):
+            return
+        wd = self._libc.inotify_add_watch(self.fd, path.encode("utf-8"), IN_WATCH_MASK)
+        if wd < 0:
+            log.debug("Cannot watch %s: %s", path, os.strerror(ctypes.get_errno()))
+            return
+        self.watches[wd] = path
+
+    def wait(self, names, timeout):
+        """Wait for one of the named files to change
+
+        :param names: Filenames, without the directory, to wait for
+        :type names: set of str
+        :param float timeout: Maximum number of seconds to wait
+        :returns: True if one of the files changed, False if the timeout was reached
+                  or inotify is not available
+        :rtype: bool
+        """
+        if self.fd is None:
+            sleep(min(timeout, POLL_INTERVAL))
+            return False
+
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            changed = False
+            offset = 0
+            while offset + _INOTIFY_EVENT.size <= len(data):
+                _wd, _mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = data[offset:offset+length].rstrip(b"\0").decode("utf-8", "replace")
+                offset += length
+                if name in names:
+                    changed = True
+            if changed:
+                return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def parse_cursor(cursor):
+    """Parse a log cursor
+
+    :param str cursor: The cursor, eg. "packaging:1234,anaconda:5678"
+    :returns: Offsets of the logs, the first one is the log that was being followed
+    :rtype: OrderedDict
+    :raises: ValueError if the cursor is not valid
+    """
+    offsets = OrderedDict()
+    for part in cursor.split(","):
+        name, _, offset = part.partition(":")
+        if name not in LOG_NAMES or not offset.isdigit():
+            raise ValueError("Invalid log cursor: %s" % cursor)
+        offsets[name] = int(offset)
+    return offsets
+
+def format_cursor(current, offsets):
+    """Return the cursor string for the offsets of the logs
+
+    :param str current: Name of the log being followed, it is listed first
+    :param dict offsets: Offset of each of the logs
+    :returns: The cursor, eg. "packaging:1234,anaconda:5678"
+    :rtype: str
+    """
+    names = [current] + [name for name in offsets if name != current]
+    return ",".join("%s:%d" % (name, offsets[name]) for name in names)
+
+def tail_offset(path, size):
+    """Return the offset of the first complete line in the last `size` KiB of a file
+
+    :param str path: Path to the file
+    :param int size: Number of KiB
+    :returns: The offset
+    :rtype: int
+    """
+    with open(path, "rb") as f:
+        end = f.seek(0, 2)
+        if end <= size * 1024:
+            return 0
+        f.seek(end - size * 1024)
+        f.readline()
+        return f.tell()
+
+def read_new(path, offset, final=False):
+    """Read the complete lines that have been added to a file
+
+    :param str path: Path to the file
+    :param int offset: Offset to start reading at
+    :param bool final: Also return a partial last line, the file will not be written to again
+    :returns: The text and the offset to read from next time
+    :rtype: tuple of str and int
+
+    If the file is shorter than the offset it has been replaced and it is read from
+    the start. At most MAX_CHUNK bytes are read.
+    """
+    with open(path, "rb") as f:
+        end = f.seek(0, 2)
+        if end < offset:
+            offset = 0
+        f.seek(offset)
+        data = f.read(min(end - offset, MAX_CHUNK))
+    if not final:
+        # A line longer than MAX_CHUNK is returned in pieces
+        newline = data.rfind(b"\n")
+        if newline >= 0 or len(data) < MAX_CHUNK:
+            data = data[:newline+1]
+    return (data.decode("utf-8", "replace"), offset + len(data))
+
+def _moved_log_path(uuid_dir, name):
+    """Return the path anaconda moves one of the RUNNING_LOGS to when it exits"""
+    return joinpaths(uuid_dir, "logs", "anaconda", os.path.basename(RUNNING_LOGS[name]))
+
+def follow_log(cfg, uuid, cursor=None, size=1024, poll=5, keepalive=15):
+    """Follow the most relevant log of a compose until the compose has finished
+
+    :param cfg: Configuration settings
+    :type cfg: ComposerConfig
+    :param str uuid: The UUID of the build
+    :param str cursor: Cursor returned by an earlier call, None to start at the end of the log
+    :param int size: KiB from the end of a log to start at when it has not been read before
+    :param float poll: Maximum number of seconds to wait before checking the status again
+    :param float keepalive: Seconds without new log data after which a keepalive event is returned
+    :returns: Tuples of (event, data, cursor)
+    :rtype: generator
+    :raises: ValueError if the cursor is not valid
+
+    The events are:
+
+    * log: data is the new text of the log, it ends on a line boundary
+    * switch: data is the name of the log that is now being followed
+    * keepalive: data is empty, nothing has been written to the log
+    * end: data is the final status of the compose, no more events follow
+
+    While the compose is WAITING only keepalive events are returned. inotify is used to
+    wait for the logs and the compose's STATUS file to change, when it is not available
+    they are polled.
+    """
+    offsets = parse_cursor(cursor) if cursor else OrderedDict()
+    current = next(iter(offsets), None)
+    uuid_dir = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid)
+    names = set(os.path.basename(path) for path in RUNNING_LOGS.values()) | {"combined.log", "STATUS"}
+
+    watcher = Inotify()
+    try:
+        watcher.watch(uuid_dir)
+        for path in RUNNING_LOGS.values():
+            watcher.watch(os.path.dirname(path))
+        last_event = time.monotonic()
+        while True:
+            # Only the STATUS is needed, uuid_status() would also parse the blueprint
+            try:
+                status = {"queue_status": open(joinpaths(uuid_dir, "STATUS")).read().strip()}
+            except OSError:
+                # The compose has been deleted
+                yield ("end", "DELETED", format_cursor(current, offsets) if current else "")
+                return
+            finished = status["queue_status"] not in ("WAITING", "RUNNING")
+
+            if status["queue_status"] != "WAITING":
+                name, path = uuid_log_path(cfg, uuid, status)
+                if current in RUNNING_LOGS and name != current:
+                    # Read what is left of the log being switched away from, anaconda moves
+                    # its logs into the results when it exits.
+                    old_path = RUNNING_LOGS[current]
+                    moved = not os.path.exists(old_path)
+                    if moved:
+                        old_path = _moved_log_path(uuid_dir, current)
+                    try:
+                        text, offsets[current] = read_new(old_path, offsets[current], final=moved)
+                    except OSError:
+                        text = ""
+                    if text:
+                        last_event = time.monotonic()
+                        yield ("log", text, format_cursor(current, offsets))
+                        continue
+
+                if name != current:
+                    if name not in offsets:
+                        try:
+                            offsets[name] = tail_offset(path, size)
+                        except OSError:
+                            offsets[name] = 0
+                    if current is not None:
+                        yield ("switch", name, format_cursor(name, offsets))
+                    current = name
+                    watcher.watch(os.path.dirname(path))
+
+                try:
+                    text, offsets[name] = read_new(path, offsets[name], final=finished)
+                except OSError:
+                    text = ""
+                if text:
+                    last_event = time.monotonic()
+                    yield ("log", text, format_cursor(name, offsets))
+                    continue
+
+            if finished:
+                yield ("end", status["queue_status"], format_cursor(current, offsets) if current else "")
+                return
+
+            if not watcher.wait(names, poll) and time.monotonic() - last_event >= keepalive:
+                last_event = time.monotonic()
+                yield ("keepalive", "", format_cursor(current, offsets) if current else "")
+    finally:
+        watcher.close()
+
+def sse_event(event, data, cursor):
+    """Format an event as a Server-Sent Event
+
+    :param str event: The event name
+    :param str data: The event's data, each line is sent as a data field
+    :param str cursor: The cursor, sent as the event's id
+    :returns: The event
+    :rtype: str
+
+    keepalive events are sent as a comment, which clients ignore.
+    """
+    if event == "keepalive":
+        return ": keepalive\n\n"
+    lines = ["event: %s" % event]
+    if cursor:
+        lines.append("id: %s" % cursor)
+    lines.extend("data: %s" % line for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
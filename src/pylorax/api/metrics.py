@@ -0,0 +1,395 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Metrics for /api/metrics in the Prometheus text exposition format
+
+The metrics are kept in a Registry in the process that updates them. The API
+server's metrics are in REGISTRY. The queue monitor runs in its own process, its
+metrics are in MONITOR_REGISTRY and it writes them to MONITOR_METRICS_FILE in
+the lib_dir, which the API server adds to its own when /api/metrics is requested.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+# Mime type of the text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of the histogram buckets, in seconds. +Inf is added to them.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LONG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 7200)
+
+# File in the lib_dir that the queue monitor writes its metrics to
+MONITOR_METRICS_FILE = "monitor.prom"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (n, _escape(v)) for n, v in pairs) + "}"
+
+class Registry(object):
+    """A set of metrics that are exposed together"""
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in (m.name for m in self._metrics):
+                raise ValueError("Duplicate metric: %s" % metric.name)
+            self._metrics.append(metric)
+
+    def exposition(self):
+        """Return all of the metrics in the text exposition format
+
+        :returns: The metrics
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        return "".join(m.expose() for m in metrics)
+
+REGISTRY = Registry()
+MONITOR_REGISTRY = Registry()
+
+class _Metric(object):
+    """Base class of the metrics
+
+    :param str name: Name of the metric
+    :param str documentation: The help text of the metric
+    :param labelnames: Names of the labels the values are split by
+    :type labelnames: tuple of str
+    :param registry: The Registry to add the metric to
+    :type registry: Registry
+
+    The labels are passed to the methods as keyword arguments, all of them
+    must be included.
+    """
+    typ = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("%s needs the labels %s" % (self.name, ", ".join(self.labelnames)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _samples(self):
+        """Return (suffix, labelvalues, extra label, value) for each sample"""
+        raise NotImplementedError
+
+    def expose(self):
+        """Return the metric in the text exposition format"""
+        lines = ["# HELP %s %s" % (self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n")),
+                 "# TYPE %s %s" % (self.name, self.typ)]
+        with self._lock:
+            samples = list(self._samples())
+        for suffix, values, extra, value in samples:
+            lines.append("%s%s%s %s" % (self.name, suffix, _format_labels(self.labelnames, values, extra),
+                                        _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def get(self, **labels):
+        """Return the current value for the labels, or None if there is none"""
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+class Counter(_Metric):
+    """A value that only goes up"""
+    typ = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        for values, value in sorted(self._values.items()):
+            yield ("", values, None, value)
+
+class Gauge(_Metric):
+    """A value that can go up and down"""
+    typ = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        for values, value in sorted(self._values.items()):
+            yield ("", values, None, value)
+
+class Histogram(_Metric):
+    """Count observations in buckets, and keep their sum and count
+
+    :param buckets: Upper bounds of the buckets, in increasing order
+    :type buckets: tuple of float
+
+    The other parameters are the same as for the other metrics.
+    """
+    typ = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(float(b) for b in buckets) + (float("inf"),)
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # The count in each bucket, the sum, and the count
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes to run"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def get(self, **labels):
+        """Return the (sum, count) for the labels, or None if there is none"""
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return (counts[1], counts[2]) if counts else None
+
+    def _samples(self):
+        for values, (buckets, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for le, n in zip(self.buckets, buckets):
+                cumulative += n
+                yield ("_bucket", values, ("le", _format_value(le)), cumulative)
+            yield ("_sum", values, None, total)
+            yield ("_count", values, None, count)
+
+def write_metrics_file(registry, path):
+    """Write the metrics to a file, replacing it in one step
+
+    :param registry: The metrics to write
+    :type registry: Registry
+    :param str path: Path of the file
+
+    Errors are logged, they should not stop the caller.
+    """
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=".metrics.", dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            f.write(registry.exposition())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.error("Writing the metrics to %s failed: %s", path, e)
+
+def read_metrics_file(path):
+    """Return the metrics written by write_metrics_file(), or "" if there are none"""
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+# Holding a TimedLock for longer than this many seconds logs a warning, 0 disables it
+_lock_warn_seconds = 0
+
+# All of the TimedLocks, for lock_status()
+_timed_locks = weakref.WeakSet()
+
+def set_lock_warn_seconds(seconds):
+    """Log a warning when a lock is held for longer than this
+
+    :param float seconds: Number of seconds, 0 to not log the warnings
+    """
+    global _lock_warn_seconds
+    _lock_warn_seconds = seconds
+
+def _lock_holder(frame):
+    """Return the name of what is taking a lock
+
+    This is the route of the API request being handled, or the module and
+    function that took the lock when it is taken outside of a request.
+    """
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            if request.url_rule:
+                return request.url_rule.rule
+            return request.path
+    except ImportError:
+        pass
+    return "%s.%s" % (frame.f_globals.get("__name__", "?"), frame.f_code.co_name)
+
+class TimedLock(object):
+    """A Lock that records how long it is waited for and held, and who holds it
+
+    :param str name: Name of the lock, used as the lock label of the metrics
+    :param lock: The lock to wrap, a new threading.Lock if it is None
+
+    The wait time is added to LOCK_WAIT_SECONDS, and the hold time is added to
+    LOCK_HOLD_SECONDS along with the holder, see _lock_holder(). A warning is logged
+    if it is held for longer than set_lock_warn_seconds().
+    """
+    def __init__(self, name, lock=None):
+        self.name = name
+        self._lock = lock or threading.Lock()
+        self.holder = None
+        self.acquired_time = None
+        self.waiting = 0
+        # The longest hold, (seconds, holder)
+        self.max_hold = (0, None)
+        _timed_locks.add(self)
+
+    def _acquire(self, holder, blocking=True, timeout=-1):
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            acquired = self._lock.acquire(blocking, timeout)
+        finally:
+            self.waiting -= 1
+        if acquired:
+            self.acquired_time = time.monotonic()
+            self.holder = holder
+            LOCK_WAIT_SECONDS.observe(self.acquired_time - start, lock=self.name)
+        return acquired
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(_lock_holder(sys._getframe(1)), blocking, timeout)
+
+    def release(self):
+        held = time.monotonic() - self.acquired_time
+        holder = self.holder
+        self.holder = None
+        self.acquired_time = None
+        self._lock.release()
+
+        LOCK_HOLD_SECONDS.observe(held, lock=self.name, holder=holder)
+        if held > self.max_hold[0]:
+            self.max_hold = (held, holder)
+        if _lock_warn_seconds and held > _lock_warn_seconds:
+            log.warning("The %s lock was held for %.2fs by %s", self.name, held, holder)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def status(self):
+        """Return the state of the lock
+
+        :returns: The name, the holder and how long it has held the lock, the number
+                  of waiters, and the longest hold
+        :rtype: dict
+        """
+        acquired_time = self.acquired_time
+        return {"name": self.name,
+                "locked": self.locked(),
+                "holder": self.holder,
+                "held_seconds": time.monotonic() - acquired_time if acquired_time is not None else 0,
+                "waiting": self.waiting,
+                "max_hold_seconds": self.max_hold[0],
+                "max_hold_holder": self.max_hold[1]}
+
+    def __enter__(self):
+        self._acquire(_lock_holder(sys._getframe(1)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+def lock_status():
+    """Return the status of all of the TimedLocks
+
+    :returns: TimedLock.status() of each lock, sorted by name
+    :rtype: list of dicts
+    """
+    return sorted((lock.status() for lock in list(_timed_locks)), key=lambda s: s["name"])
+
+# The API server's metrics
+HTTP_REQUESTS = Counter("lorax_composer_http_requests_total",
+                        "Number of API requests, by route, method and status code",
+                        ("route", "method", "code"))
+HTTP_REQUEST_SECONDS = Histogram("lorax_composer_http_request_duration_seconds",
+                                 "Time taken to start the response to API requests, by route",
+                                 ("route",))
+LOCK_WAIT_SECONDS = Histogram("lorax_composer_lock_wait_seconds",
+                              "Time spent waiting for the dnf and git locks",
+                              ("lock",))
+LOCK_HOLD_SECONDS = Histogram("lorax_composer_lock_hold_seconds",
+                              "Time the dnf and git locks are held, by the route or function holding them",
+                              ("lock", "holder"))
+DEPSOLVE_SECONDS = Histogram("lorax_composer_depsolve_duration_seconds",
+                             "Time taken by dnf to resolve the dependencies of a set of packages")
+DNF_METADATA_REFRESH = Counter("lorax_composer_dnf_metadata_refresh_total",
+                               "Number of times the dnf metadata was refreshed")
+QUEUE_DEPTH = Gauge("lorax_composer_queue_depth",
+                    "Number of composes waiting (new) and running (run)",
+                    ("queue",))
+# The parsed templates are cached by start_build, which runs in the API server
+TEMPLATE_CACHE = Counter("lorax_composer_template_cache_lookups_total",
+                         "Lookups of parsed template commands, by result (hit or miss)",
+                         ("result",))
+
+# The queue monitor's metrics
+COMPOSES = Counter("lorax_composer_composes_total",
+                   "Number of composes that have been run, by type and final status",
+                   ("compose_type", "status"), registry=MONITOR_REGISTRY)
+COMPOSE_SECONDS = Histogram("lorax_composer_compose_duration_seconds",
+                            "Time taken to run a compose, by type",
+                            ("compose_type",), registry=MONITOR_REGISTRY, buckets=LONG_BUCKETS)
+COMPOSE_STAGE_SECONDS = Histogram("lorax_composer_compose_stage_duration_seconds",
+                                  "Time taken by each stage of the composes",
+                                  ("stage",), registry=MONITOR_REGISTRY, buckets=LONG_BUCKETS)
@@ -0,0 +1,280 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Profile API requests with cProfile
+
+Profiling is off unless profile_requests is set in the [composer] section of the
+configuration, or a request sets the X-Composer-Profile header and the uid of the
+client connected to the socket is in profile_uids. The stats of each profiled
+request are saved in the profiles directory of the lib_dir, named with the time,
+method and route of the request, eg.::
+
+    20191018-120102.123-GET-api_v0_blueprints_changes_blueprint_names.prof
+
+They can be read with the pstats module, and report() adds them together to show
+where the time was spent across many requests.
+
+cProfile profiles a thread, and the requests are all run by greenlets in the same
+thread. When a profiled request waits, eg. on a lock or the socket, and gevent
+switches to another request, the other request's work is recorded in the profile
+too. The number of greenlet switches seen while profiling is logged with each
+profile, and added up by report(). When it is not 0 the stats include the work of
+other requests.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+import cProfile
+import glob
+import io
+import os
+import pstats
+import pwd
+import re
+import socket
+import struct
+import time
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+from pylorax.sysutils import joinpaths
+
+# Directory under the lib_dir the profiles are saved in
+PROFILES_DIR = "profiles"
+
+# The header a client sets to ask for a request to be profiled
+PROFILE_HEADER = "X-Composer-Profile"
+
+# The WSGI environ key lorax-composer stores the uid of the client in
+PEER_UID_ENVIRON = "lorax.peer_uid"
+
+def peer_uid(sock):
+    """Return the uid of the process connected to a Unix socket
+
+    :param sock: A connected AF_UNIX socket
+    :returns: The uid, or None if it cannot be found
+    :rtype: int or None
+    """
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    except (OSError, AttributeError):
+        return None
+    _pid, uid, _gid = struct.unpack("3i", creds)
+    return uid
+
+def parse_uids(value):
+    """Parse a comma separated list of user names and uids
+
+    :param str value: eg. "root, 1000"
+    :returns: The uids, unknown users are logged and skipped
+    :rtype: set of int
+    """
+    uids = set()
+    for user in value.split(","):
+        user = user.strip()
+        if not user:
+            continue
+        if user.isdigit():
+            uids.add(int(user))
+            continue
+        try:
+            uids.add(pwd.getpwnam(user).pw_uid)
+        except KeyError:
+            log.warning("Unknown user %s in profile_uids", user)
+    return uids
+
+def route_filename(route):
+    """Convert a route rule into a string that can be used in a filename
+
+    :param str route: The route's rule, eg. /api/v0/blueprints/info/<blueprint_names>
+    :returns: eg. api_v0_blueprints_info_blueprint_names
+    :rtype: str
+    """
+    return re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "unknown"
+
+class RequestProfiler(object):
+    """Decide which requests to profile, and save and report on their stats
+
+    :param str profiles_dir: Directory to save the profiles in
+    :param bool always: Profile every request
+    :param set uids: uids of the clients allowed to ask for a profile with the header
+    :param int max_profiles: Number of profiles to keep, the oldest are removed
+
+    Only one request is profiled at a time, cProfile can only profile one thing at
+    a time in each thread and the requests are all run by greenlets in the same thread.
+    Other requests are still served while one is profiled, so the greenlet switches
+    are counted to show when the stats include their work.
+    """
+    def __init__(self, profiles_dir, always=False, uids=None, max_profiles=500):
+        self.profiles_dir = profiles_dir
+        self.always = always
+        self.uids = uids or set()
+        self.max_profiles = max_profiles
+        self._active = None
+        self._switches = 0
+        self._switch_counts = {}
+        self._old_trace = None
+
+    @property
+    def enabled(self):
+        """True if any requests can be profiled"""
+        return self.always or bool(self.uids)
+
+    def wanted(self, environ, headers):
+        """Return True if the request should be profiled
+
+        :param dict environ: The request's WSGI environ
+        :param headers: The request's headers
+        :rtype: bool
+        """
+        if self.always:
+            return True
+        if not self.uids or headers.get(PROFILE_HEADER, "").strip().lower() not in ("1", "yes", "true"):
+            return False
+        uid = environ.get(PEER_UID_ENVIRON)
+        if uid not in self.uids:
+            log.debug("Not profiling request from uid %s, it is not in profile_uids", uid)
+            return False
+        return True
+
+    def start(self):
+        """Start profiling a request
+
+        :returns: The profile, or None if another request is being profiled
+        :rtype: cProfile.Profile or None
+        """
+        if self._active is not None:
+            log.debug("Not profiling request, another request is being profiled")
+            return None
+        self._switches = 0
+        if greenlet is not None:
+            self._old_trace = greenlet.settrace(self._count_switch)
+        self._active = cProfile.Profile()
+        self._active.enable()
+        return self._active
+
+    def _count_switch(self, event, args):
+        """greenlet trace function, counts the switches while a request is profiled"""
+        if event in ("switch", "throw"):
+            self._switches += 1
+        if self._old_trace is not None:
+            self._old_trace(event, args)
+
+    def finish(self, profile, route, method):
+        """Stop profiling a request and save its stats
+
+        :param profile: The profile returned by start()
+        :type profile: cProfile.Profile
+        :param str route: The route's rule
+        :param str method: The request's method
+        :returns: The path to the saved stats, or None if they could not be saved
+        :rtype: str or None
+        """
+        profile.disable()
+        if profile is not self._active:
+            return None
+        self._active = None
+        if greenlet is not None:
+            greenlet.settrace(self._old_trace)
+            self._old_trace = None
+        switches = self._switches
+
+        now = time.time()
+        name = "%s.%03d-%s-%s.prof" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+                                       int(now * 1000) % 1000, method, route_filename(route))
+        path = joinpaths(self.profiles_dir, name)
+        try:
+            os.makedirs(self.profiles_dir, exist_ok=True)
+            profile.dump_stats(path)
+        except OSError as e:
+            log.error("Failed to save the profile of %s %s: %s", method, route, e)
+            return None
+        self._switch_counts[path] = switches
+        if switches:
+            log.info("Profile of %s %s saw %d greenlet switches, it includes the work of other requests",
+                     method, route, switches)
+        self._expire()
+        return path
+
+    def _expire(self):
+        """Remove the oldest profiles when there are more than max_profiles"""
+        if not self.max_profiles:
+            return
+        for path in self.profiles()[:-self.max_profiles]:
+            self._switch_counts.pop(path, None)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def profiles(self, route=None):
+        """Return the saved profiles, oldest first
+
+        :param str route: Only return the profiles of this route's rule, or None for all of them
+        :returns: Paths to the profiles
+        :rtype: list of str
+        """
+        pattern = "*-%s.prof" % route_filename(route) if route else "*.prof"
+        return sorted(glob.glob(joinpaths(self.profiles_dir, pattern)))
+
+    def report(self, route=None, sort="cumulative", limit=40):
+        """Add the saved profiles together and return a report
+
+        :param str route: Only include the profiles of this route's rule, or None for all of them
+        :param str sort: The pstats sort key, eg. cumulative, tottime, or calls
+        :param int limit: Number of functions to list
+        :returns: The report, starting with the number of requests and time for each route
+        :rtype: str
+        :raises: KeyError if sort is not a pstats sort key
+
+        The switches column is the number of greenlet switches seen while the route's
+        requests were profiled, only for the profiles saved since lorax-composer started.
+        """
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise KeyError(sort)
+
+        out = io.StringIO()
+        stats = None
+        routes = {}
+        for path in self.profiles(route):
+            try:
+                profile = pstats.Stats(path, stream=out)
+            except (OSError, TypeError, ValueError, EOFError) as e:
+                log.debug("Skipping profile %s: %s", path, e)
+                continue
+            # The filename is time-method-route.prof
+            key = os.path.basename(path)[:-5].split("-", 3)[2:]
+            count, seconds, switches = routes.get(tuple(key), (0, 0.0, 0))
+            routes[tuple(key)] = (count + 1, seconds + profile.total_tt, switches + self._switch_counts.get(path, 0))
+            if stats is None:
+                stats = profile
+            else:
+                stats.add(profile)
+
+        if stats is None:
+            return "No profiles in %s\n" % self.profiles_dir
+
+        out.write("%-8s %-60s %8s %12s %12s %9s\n" % ("method", "route", "requests", "seconds", "average", "switches"))
+        for (method, name), (count, seconds, switches) in sorted(routes.items(), key=lambda r: -r[1][1]):
+            out.write("%-8s %-60s %8d %12.3f %12.3f %9d\n" % (method, name, count, seconds, seconds / count, switches))
+        out.write("\n")
+        # Don't list every profile's filename before the stats
+        stats.files = []
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
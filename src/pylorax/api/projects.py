@@ -24,6 +24,7 @@ import os
 import time
 
 from pylorax.api.bisect import insort_left
+from pylorax.api.metrics import DEPSOLVE_SECONDS
 
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
@@ -274,7 +275,8 @@ def projects_depsolve(dbo, projects, groups):
     _depsolve(dbo, projects, groups)
 
     try:
-        dbo.resolve()
+        with DEPSOLVE_SECONDS.time():
+            dbo.resolve()
     except dnf.exceptions.DepsolveError as e:
         raise ProjectsError("There was a problem depsolving %s: %s" % (projects, str(e)))
 
@@ -324,7 +326,8 @@ def projects_depsolve_with_size(dbo, projects, groups, with_core=True):
         dbo.group_install("core", ['mandatory', 'default', 'optional'])
 
     try:
-        dbo.resolve()
+        with DEPSOLVE_SECONDS.time():
+            dbo.resolve()
     except dnf.exceptions.DepsolveError as e:
         raise ProjectsError("There was a problem depsolving %s: %s" % (projects, str(e)))
 
@@ -26,18 +26,26 @@ import multiprocessing as mp
 import pwd
 import shutil
 import subprocess
-from subprocess import Popen, PIPE
 import time
 
 from pylorax import find_templates
 from pylorax.api.compose import move_compose_results
+from pylorax.api.download import TarStream
+from pylorax.api.metrics import MONITOR_REGISTRY, MONITOR_METRICS_FILE, write_metrics_file
+from pylorax.api.metrics import COMPOSES, COMPOSE_SECONDS, COMPOSE_STAGE_SECONDS
 from pylorax.api.recipes import recipe_from_file
-from pylorax.api.timestamp import TS_CREATED, TS_STARTED, TS_FINISHED, write_timestamp, timestamp_dict
+from pylorax.api.timestamp import TS_CREATED, TS_STARTED, TS_FINISHED, STAGES_LOG, write_timestamp, timestamp_dict
+from pylorax.api.timestamp import stage_times
 import pylorax.api.toml as toml
 from pylorax.base import DataHolder
 from pylorax.creator import run_creator
+from pylorax.imgutils import read_checksums_file
+from pylorax.progress import read_progress, StageTimer
 from pylorax.sysutils import joinpaths, read_tail
 
+# Progress of the installation, written by run_creator
+PROGRESS_LOG = "progress.jsonl"
+
 def check_queues(cfg):
     """Check to make sure the new and run queue symlinks are correct
 
@@ -116,12 +124,16 @@ def monitor(cfg):
 
     If the system is restarted while a compose is running it will move any old symlinks
     from ./queue/run/ to ./queue/new/ and rerun them.
+
+    The metrics of the composes are written to MONITOR_METRICS_FILE after each one.
     """
     def queue_sort(uuid):
         """Sort the queue entries by their mtime, not their names"""
         return os.stat(joinpaths(cfg.composer_dir, "queue/new", uuid)).st_mtime
 
+    metrics_path = joinpaths(cfg.composer_dir, MONITOR_METRICS_FILE)
     check_queues(cfg)
+    write_metrics_file(MONITOR_REGISTRY, metrics_path)
     while True:
         uuids = sorted(os.listdir(joinpaths(cfg.composer_dir, "queue/new")), key=queue_sort)
 
@@ -157,6 +169,7 @@ def monitor(cfg):
 
             log.info("Starting new compose: %s", dst)
             open(joinpaths(dst, "STATUS"), "w").write("RUNNING\n")
+            start = time.monotonic()
 
             try:
                 make_compose(cfg, os.path.realpath(dst))
@@ -177,8 +190,27 @@ def monitor(cfg):
                         logger.removeHandler(handler)
                     handler.close()
 
+            record_compose_metrics(os.path.realpath(dst), time.monotonic() - start)
+            write_metrics_file(MONITOR_REGISTRY, metrics_path)
             os.unlink(dst)
 
+def record_compose_metrics(results_dir, duration):
+    """Add a finished compose to the queue monitor's metrics
+
+    :param str results_dir: The compose's results directory
+    :param float duration: Number of seconds the compose took
+    """
+    try:
+        compose_type = get_compose_type(results_dir)
+        status = open(joinpaths(results_dir, "STATUS")).read().strip()
+    except (OSError, RuntimeError) as e:
+        log.error("Cannot record the metrics of %s: %s", results_dir, e)
+        return
+    COMPOSES.inc(compose_type=compose_type, status=status)
+    COMPOSE_SECONDS.observe(duration, compose_type=compose_type)
+    for stage in stage_times(results_dir):
+        COMPOSE_STAGE_SECONDS.observe(stage["duration"], stage=stage["stage"])
+
 def make_compose(cfg, results_dir):
     """Run anaconda with the final-kickstart.ks from results_dir
 
@@ -238,6 +270,11 @@ def make_compose(cfg, results_dir):
     cfg_dict["result_dir"] = joinpaths(results_dir, "compose")
     os.makedirs(cfg_dict["result_dir"])
 
+    # Record the installation's progress for the status API
+    cfg_dict["progress_log"] = joinpaths(results_dir, PROGRESS_LOG)
+    cfg_dict["stage_log"] = joinpaths(results_dir, STAGES_LOG)
+    timer = StageTimer(cfg_dict["stage_log"])
+
     install_cfg = DataHolder(**cfg_dict)
 
     # Some kludges for the 99-copy-logs %post, failure in it will crash the build
@@ -267,7 +304,8 @@ def make_compose(cfg, results_dir):
             run_creator(install_cfg, cancel_func=cancel_build)
 
             # Extract the results of the compose into results_dir and cleanup the compose directory
-            move_compose_results(install_cfg, results_dir)
+            with timer.stage("move-results"):
+                move_compose_results(install_cfg, results_dir)
     finally:
         # Make sure any remaining temporary directories are removed (eg. if there was an exception)
         for d in glob(joinpaths(cfg.tmp, "lmc-*")):
@@ -315,6 +353,8 @@ def compose_detail(results_dir):
     * blueprint - Blueprint name
     * version - Blueprint version
     * image_size - Size of the image, if finished. 0 otherwise.
+    * progress - The progress of the installation, see `pylorax.progress.read_progress`, or
+      None if the installation has not started
 
     Various timestamps are also included in the dict.  These are all Unix UTC timestamps.
     It is possible for these timestamps to not always exist, in which case they will be
@@ -346,7 +386,8 @@ def compose_detail(results_dir):
             "compose_type": compose_type,
             "blueprint":    blueprint["name"],
             "version":      blueprint["version"],
-            "image_size":   image_size
+            "image_size":   image_size,
+            "progress":     read_progress(joinpaths(results_dir, PROGRESS_LOG))
             }
 
 def queue_status(cfg):
@@ -533,6 +574,10 @@ def uuid_info(cfg, uuid):
     * deps - The NEVRA of all of the dependencies used in the composition
     * compose_type - The type of output generated (tar, iso, etc.)
     * queue_status - The final status of the composition (FINISHED or FAILED)
+    * image_size - The size of the output image, 0 if it has not been created yet
+    * checksums - {image_name: {"sha256": hexdigest}} of the finished image, or {}
+    * progress - The progress of the installation, or None if it has not started
+    * stages - The time taken by each stage of the build, see `pylorax.progress.read_stage_times`
     """
     uuid_dir = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid)
     if not os.path.exists(uuid_dir):
@@ -568,10 +613,13 @@ def uuid_info(cfg, uuid):
             "deps":         deps_dict,
             "compose_type": details["compose_type"],
             "queue_status": details["queue_status"],
-            "image_size":   details["image_size"]
+            "image_size":   details["image_size"],
+            "checksums":    read_checksums_file(joinpaths(uuid_dir, "CHECKSUMS")),
+            "progress":     details["progress"],
+            "stages":       stage_times(uuid_dir)
     }
 
-def uuid_tar(cfg, uuid, metadata=False, image=False, logs=False):
+def uuid_tar(cfg, uuid, metadata=False, image=False, logs=False, compression=None):
     """Return a tar of the build data
 
     :param cfg: Configuration settings
@@ -584,12 +632,15 @@ def uuid_tar(cfg, uuid, metadata=False, image=False, logs=False):
     :type image: bool
     :param logs: Set to true to include the logs from the build
     :type logs: bool
-    :returns: A stream of bytes from tar
-    :rtype: A generator
+    :param compression: None, "gzip", or "zstd"
+    :type compression: str
+    :returns: The tar archive, iterating over it yields its data
+    :rtype: TarStream
     :raises: RuntimeError if there was a problem (eg. missing config file)
+    :raises: ValueError if the compression is not supported
 
-    This yields an uncompressed tar's data to the caller. It includes
-    the selected data to the caller by returning the Popen stdout from the tar process.
+    The archive is created while it is sent, its size is in the size attribute when
+    it is not compressed.
     """
     uuid_dir = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid)
     if not os.path.exists(uuid_dir):
@@ -608,10 +659,9 @@ def uuid_tar(cfg, uuid, metadata=False, image=False, logs=False):
         if f.endswith(image_name):
             return image
         return metadata
-    filenames = [os.path.basename(f) for f in glob(joinpaths(uuid_dir, "*")) if include_file(f)]
+    filenames = sorted(os.path.basename(f) for f in glob(joinpaths(uuid_dir, "*")) if include_file(f))
 
-    tar = Popen(["tar", "-C", uuid_dir, "-cf-"] + filenames, stdout=PIPE)
-    return tar.stdout
+    return TarStream(uuid_dir, filenames, compression)
 
 def uuid_image(cfg, uuid):
     """Return the filename and full path of the build's image file
@@ -649,6 +699,45 @@ def get_image_name(uuid_dir):
 
     return (image_name, joinpaths(uuid_dir, image_name))
 
+# The logs that uuid_log_path() chooses between, and where they are while a compose is running
+RUNNING_LOGS = {"anaconda": "/tmp/anaconda.log",
+                "packaging": "/tmp/packaging.log"}
+
+def uuid_log_path(cfg, uuid, status):
+    """Return the most relevant log for the current progress of a compose
+
+    :param cfg: Configuration settings
+    :type cfg: ComposerConfig
+    :param uuid: The UUID of the build
+    :type uuid: str
+    :param status: The compose's status, as returned by uuid_status()
+    :type status: dict
+    :returns: The name of the log (anaconda, packaging, or combined) and its path
+    :rtype: tuple of str
+
+    While a build is running the logs will be in /tmp/anaconda.log and /tmp/packaging.log,
+    when it has finished they will be in the results directory and the combined log is
+    returned.
+    """
+    combined_log = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid, "logs", "combined.log")
+    anaconda_log = RUNNING_LOGS["anaconda"]
+    packaging_log = RUNNING_LOGS["packaging"]
+    if status["queue_status"] != "RUNNING" or not os.path.isfile(anaconda_log):
+        return ("combined", combined_log)
+    if not os.path.isfile(packaging_log):
+        return ("anaconda", anaconda_log)
+    try:
+        anaconda_mtime = os.stat(anaconda_log).st_mtime
+        packaging_mtime = os.stat(packaging_log).st_mtime
+        # If the packaging log exists and its last message is at least 15
+        # seconds newer than the anaconda log, return the packaging log.
+        if packaging_mtime > anaconda_mtime + 15:
+            return ("packaging", packaging_log)
+        return ("anaconda", anaconda_log)
+    except OSError:
+        # Return the combined log if anaconda_log or packaging_log disappear
+        return ("combined", combined_log)
+
 def uuid_log(cfg, uuid, size=1024):
     """Return `size` KiB from the end of the most currently relevant log for a
     given compose
@@ -678,29 +767,8 @@ def uuid_log(cfg, uuid, size=1024):
     if status is None:
         raise RuntimeError("Status is missing for %s" % uuid)
 
-    def get_log_path():
-        # Try to return the most relevant log at any given time during the
-        # compose. If the compose is not running, return the composer log.
-        anaconda_log = "/tmp/anaconda.log"
-        packaging_log = "/tmp/packaging.log"
-        combined_log = joinpaths(uuid_dir, "logs", "combined.log")
-        if status["queue_status"] != "RUNNING" or not os.path.isfile(anaconda_log):
-            return combined_log
-        if not os.path.isfile(packaging_log):
-            return anaconda_log
-        try:
-            anaconda_mtime = os.stat(anaconda_log).st_mtime
-            packaging_mtime = os.stat(packaging_log).st_mtime
-            # If the packaging log exists and its last message is at least 15
-            # seconds newer than the anaconda log, return the packaging log.
-            if packaging_mtime > anaconda_mtime + 15:
-                return packaging_log
-            return anaconda_log
-        except OSError:
-            # Return the combined log if anaconda_log or packaging_log disappear
-            return combined_log
     try:
-        tail = read_tail(get_log_path(), size)
+        tail = read_tail(uuid_log_path(cfg, uuid, status)[1], size)
     except OSError as e:
         raise RuntimeError("No log available.") from e
     return tail
@@ -18,14 +18,18 @@ import logging
 log = logging.getLogger("lorax-composer")
 
 from collections import namedtuple
-from flask import Flask, jsonify, redirect, send_from_directory
+from flask import Flask, Response, g, jsonify, redirect, request, send_from_directory
 from glob import glob
 import os
+import time
 import werkzeug
 
 from pylorax import vernum
 from pylorax.api.errors import HTTP_ERROR
+from pylorax.api.metrics import REGISTRY, CONTENT_TYPE, MONITOR_METRICS_FILE, read_metrics_file
+from pylorax.api.metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS, QUEUE_DEPTH, TEMPLATE_CACHE, lock_status
 from pylorax.api.v0 import v0_api
+from pylorax.ltmpl import template_cache_stats
 from pylorax.sysutils import joinpaths
 
 GitLock = namedtuple("GitLock", ["repo", "lock", "dir"])
@@ -79,6 +83,127 @@ def v0_status():
                    db_supported=True,
                    msgs=server.config["TEMPLATE_ERRORS"])
 
+@server.route("/api/metrics")
+def api_metrics():
+    """
+    `/api/metrics`
+    ^^^^^^^^^^^^^^
+    Return the server's metrics in the Prometheus text exposition format, eg.::
+
+          # HELP lorax_composer_queue_depth Number of composes waiting (new) and running (run)
+          # TYPE lorax_composer_queue_depth gauge
+          lorax_composer_queue_depth{queue="new"} 2
+          lorax_composer_queue_depth{queue="run"} 1
+
+    The metrics include the number of requests and their latency for each route, the time
+    spent waiting for the dnf and git locks, depsolve times, the queue depth, and the
+    parsed template cache lookups made while starting composes. The number of composes,
+    their durations, and the duration of each stage of the composes come from the queue
+    monitor.
+    """
+    lib_dir = server.config["COMPOSER_CFG"].get("composer", "lib_dir")
+    for queue in ("new", "run"):
+        QUEUE_DEPTH.set(len(glob(joinpaths(lib_dir, "queue", queue, "*"))), queue=queue)
+    # Catch up with the lookups made since the last time
+    for result, count in template_cache_stats().items():
+        TEMPLATE_CACHE.inc(count - (TEMPLATE_CACHE.get(result=result) or 0), result=result)
+
+    metrics = REGISTRY.exposition() + read_metrics_file(joinpaths(lib_dir, MONITOR_METRICS_FILE))
+    return Response(metrics, content_type=CONTENT_TYPE)
+
+@server.route("/api/debug/locks")
+def api_debug_locks():
+    """
+    `/api/debug/locks`
+    ^^^^^^^^^^^^^^^^^^
+    Return the state of the dnf and git locks::
+
+          { "locks": [
+              { "name": "dnf",
+                "locked": true,
+                "holder": "/api/v0/compose",
+                "held_seconds": 2.5316,
+                "waiting": 1,
+                "max_hold_seconds": 41.0723,
+                "max_hold_holder": "/api/v0/projects/depsolve/<project_names>" },
+              { "name": "git",
+                "locked": false,
+                "holder": null,
+                "held_seconds": 0,
+                "waiting": 0,
+                "max_hold_seconds": 0.0231,
+                "max_hold_holder": "/api/v0/blueprints/new" }
+            ]
+          }
+
+    The holder is the route of the request holding the lock, or the module and function
+    that took it outside of a request. The wait and hold time histograms are in /api/metrics.
+    """
+    return jsonify(locks=lock_status())
+
+@server.route("/api/debug/profiles")
+def api_debug_profiles():
+    """
+    `/api/debug/profiles[?route=<rule>&sort=cumulative&limit=40]`
+    ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+    Return a report of the requests that have been profiled, as plain text. The
+    profiles are added together, the report lists the number of requests and the
+    time they took for each route, then the functions they spent the most time in::
+
+        method   route                                          requests      seconds      average
+        GET      api_v0_blueprints_changes_blueprint_names             3        4.212        1.404
+
+                 81234 function calls (80012 primitive calls) in 4.212 seconds
+        ...
+
+    `route` limits the report to one route's rule, eg. /api/v0/projects/info/<project_names>.
+    `sort` is a pstats sort key, eg. cumulative, tottime, or calls. `limit` is the
+    number of functions to list.
+
+    Requests are only profiled when profile_requests or profile_uids are set in the
+    [composer] section of the configuration, a 400 error is returned when they are not.
+    """
+    profiler = server.config.get("PROFILER")
+    if profiler is None or not profiler.enabled:
+        return jsonify(status=False, errors=[{"id": HTTP_ERROR, "code": 400,
+                                              "msg": "Request profiling is not enabled"}]), 400
+    try:
+        limit = int(request.args.get("limit", "40"))
+        report = profiler.report(request.args.get("route"), request.args.get("sort", "cumulative"), limit)
+    except (KeyError, ValueError) as e:
+        return jsonify(status=False, errors=[{"id": HTTP_ERROR, "code": 400,
+                                              "msg": "Invalid sort or limit: %s" % e}]), 400
+    return Response(report, content_type="text/plain; charset=utf-8")
+
+@server.before_request
+def start_request_timer():
+    g.request_start = time.monotonic()
+
+@server.before_request
+def start_request_profile():
+    profiler = server.config.get("PROFILER")
+    if profiler is not None and profiler.enabled and profiler.wanted(request.environ, request.headers):
+        g.request_profile = profiler.start()
+
+@server.after_request
+def record_request_metrics(response):
+    # Use the route's rule, not the path, so the uuids and names in it are not labels
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    HTTP_REQUESTS.inc(route=route, method=request.method, code=response.status_code)
+    if "request_start" in g:
+        HTTP_REQUEST_SECONDS.observe(time.monotonic() - g.request_start, route=route)
+    return response
+
+@server.teardown_request
+def save_request_profile(_exception):
+    # Run even when the request fails, the slow requests are often the failing ones
+    profile = g.pop("request_profile", None)
+    if profile is not None:
+        route = request.url_rule.rule if request.url_rule else "unknown"
+        path = server.config["PROFILER"].finish(profile, route, request.method)
+        if path:
+            log.debug("Saved the profile of %s %s to %s", request.method, route, path)
+
 @server.errorhandler(werkzeug.exceptions.HTTPException)
 def bad_request(error):
     return jsonify(status=False, errors=[{ "id": HTTP_ERROR, "code": error.code, "msg": error.name }]), error.code
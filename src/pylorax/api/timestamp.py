@@ -17,6 +17,7 @@
 
 import time
 
+from pylorax.progress import read_stage_times
 from pylorax.sysutils import joinpaths
 import pylorax.api.toml as toml
 
@@ -24,6 +25,9 @@ TS_CREATED  = "created"
 TS_STARTED  = "started"
 TS_FINISHED = "finished"
 
+# The stages of the build are appended to this by a pylorax.progress.StageTimer
+STAGES_LOG = "stages.jsonl"
+
 def write_timestamp(destdir, ty):
     path = joinpaths(destdir, "times.toml")
 
@@ -49,3 +53,6 @@ def timestamp_dict(destdir):
         return toml.loads(open(path, "r").read())
     except IOError:
         return toml.loads("")
+
+def stage_times(destdir):
+    return read_stage_times(joinpaths(destdir, STAGES_LOG))
@@ -52,14 +52,17 @@ import logging
 log = logging.getLogger("lorax-composer")
 
 import os
-from flask import jsonify, request, Response, send_file
+from flask import jsonify, request, Response
 from flask import current_app as api
 
+from pylorax.imgutils import read_checksums_file
 from pylorax.sysutils import joinpaths
 from pylorax.api.checkparams import checkparams
 from pylorax.api.compose import start_build, compose_types
 from pylorax.api.errors import *                               # pylint: disable=wildcard-import
 from pylorax.api.flask_blueprint import BlueprintSkip
+from pylorax.api.download import send_file_range
+from pylorax.api.logfollow import follow_log, parse_cursor, sse_event
 from pylorax.api.projects import projects_list, projects_info, projects_depsolve
 from pylorax.api.projects import modules_list, modules_info, ProjectsError, repo_to_source
 from pylorax.api.projects import get_repo_sources, delete_repo_source, source_to_repo, dnf_repo_to_file_repo
@@ -88,6 +91,30 @@ def take_limits(iterable, offset, limit):
     """
     return iterable[offset:][:limit]
 
+def tar_response(uuid, filename, metadata=False, image=False, logs=False):
+    """Return a Response with a tar of the build data
+
+    :param uuid: The UUID of the build
+    :type uuid: str
+    :param filename: Filename of the archive, without the .tar suffix
+    :type filename: str
+    :returns: The Response, or an error Response if the compression parameter is not supported
+    :rtype: flask.Response
+
+    The archive is compressed if the request's compression parameter is gzip or zstd.
+    The Content-Length is included when it is not compressed.
+    """
+    try:
+        tar = uuid_tar(api.config["COMPOSER_CFG"], uuid, metadata=metadata, image=image, logs=logs,
+                       compression=request.args.get("compression") or None)
+    except ValueError as e:
+        return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
+
+    headers = [("Content-Disposition", "attachment; filename=%s%s;" % (filename, tar.filename_suffix))]
+    if tar.size is not None:
+        headers.append(("Content-Length", str(tar.size)))
+    return Response(tar, mimetype=tar.mimetype, headers=headers, direct_passthrough=True)
+
 def blueprint_exists(branch, blueprint_name):
     """Return True if the blueprint exists
 
@@ -1678,10 +1705,36 @@ def v0_compose_status(uuids):
       Return the details for each of the comma-separated list of uuids. A uuid of '*' will return
       details for all composes.
 
+      The progress of the installation is included once it has started, it has the current
+      phase of the installation, when it started, and the number of packages that have been
+      installed. It is null for composes that have not started yet.
+
       Example::
 
           {
             "uuids": [
+              {
+                "id": "b27c5a7b-d1f6-4c8c-8526-6d6de464f1c7",
+                "blueprint": "http-server",
+                "queue_status": "RUNNING",
+                "job_created": 1517523644.2384307,
+                "job_started": 1517523644.2551234,
+                "job_finished": null,
+                "progress": {
+                  "packages_done": 212,
+                  "packages_total": 417,
+                  "phase": "install",
+                  "phase_started": 1517523701.1219764,
+                  "phases": [
+                    {"phase": "setup", "started": 1517523650.3352981},
+                    {"phase": "download", "started": 1517523661.8719301},
+                    {"phase": "transaction", "started": 1517523697.2206417},
+                    {"phase": "install", "started": 1517523701.1219764}
+                  ],
+                  "updated": 1517523742.5610487
+                },
+                "version": "0.0.2"
+              },
               {
                 "id": "8c8435ef-d6bd-4c68-9bf1-a2ef832e6b1a",
                 "blueprint": "http-server",
@@ -1836,10 +1889,25 @@ def v0_compose_info(uuid):
         * deps - The NEVRA of all of the dependencies used in the composition
         * compose_type - The type of output generated (tar, iso, etc.)
         * queue_status - The final status of the composition (FINISHED or FAILED)
+        * image_size - The size of the output image, 0 if it has not been created yet
+        * checksums - The sha256 of the finished image, also in the CHECKSUMS file of the metadata.
+          It is only calculated while the image is written or copied, so it is set for the
+          tar based types (tar, oci, vagrant, ...) and for images that were copied to the results
+          from another filesystem. Otherwise it is empty, the image is not read again to calculate it.
+        * progress - The progress of the installation, see /compose/status, or null if it has not started
+        * stages - How long each stage of the build took, a list of objects with the stage name,
+          when it started, its duration in seconds, and whether it failed. The stages include
+          depsolve, kickstart, anaconda (and anaconda-PHASE for each phase of the installation),
+          setfiles, fstrim, qemu-img, compress, and move-results.
 
       Example::
 
           {
+            "checksums": {
+              "root.tar.xz": {
+                "sha256": "3e4d2e5a3d4c5b3fb1b0d1e1d3c1aa8b0b3e0b4d2cdf9b4bd1e1c5e1f6b2a9c0"
+              }
+            },
             "commit": "7078e521a54b12eae31c3fd028680da7a0815a4d",
             "compose_type": "tar",
             "config": {
@@ -1866,7 +1934,22 @@ def v0_compose_info(uuid):
             "blueprint": {
               "description": "An example kubernetes master",
               ...
-            }
+            },
+            "stages": [
+              {
+                "duration": 4.213,
+                "failed": false,
+                "stage": "depsolve",
+                "started": 1517523644.2384307
+              },
+              {
+                "duration": 611.562,
+                "failed": false,
+                "stage": "anaconda",
+                "started": 1517523650.3352981
+              },
+              ...
+            ]
           }
     """
     if VALID_API_STRING.match(uuid) is None:
@@ -1888,7 +1971,7 @@ def v0_compose_info(uuid):
 def v0_compose_metadata(uuid):
     """Return a tar of the metadata for the build
 
-    **/api/v0/compose/metadata/<uuid>**
+    **/api/v0/compose/metadata/<uuid>[?compression=gzip|zstd]**
 
       Returns a .tar of the metadata used for the build. This includes all the
       information needed to reproduce the build, including the final kickstart
@@ -1897,7 +1980,9 @@ def v0_compose_metadata(uuid):
       The mime type is set to 'application/x-tar' and the filename is set to
       UUID-metadata.tar
 
-      The .tar is uncompressed, but is not large.
+      The .tar is uncompressed, but is not large. It is compressed if the compression
+      parameter is set, and the mime type and filename are changed to match, eg.
+      'application/gzip' and UUID-metadata.tar.gz.
     """
     if VALID_API_STRING.match(uuid) is None:
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
@@ -1908,10 +1993,7 @@ def v0_compose_metadata(uuid):
     if status["queue_status"] not in ["FINISHED", "FAILED"]:
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s not in FINISHED or FAILED state." % uuid}]), 400
     else:
-        return Response(uuid_tar(api.config["COMPOSER_CFG"], uuid, metadata=True, image=False, logs=False),
-                        mimetype="application/x-tar",
-                        headers=[("Content-Disposition", "attachment; filename=%s-metadata.tar;" % uuid)],
-                        direct_passthrough=True)
+        return tar_response(uuid, uuid + "-metadata", metadata=True)
 
 @v0_api.route("/compose/results", defaults={'uuid': ""})
 @v0_api.route("/compose/results/<uuid>")
@@ -1919,15 +2001,16 @@ def v0_compose_metadata(uuid):
 def v0_compose_results(uuid):
     """Return a tar of the metadata and the results for the build
 
-    **/api/v0/compose/results/<uuid>**
+    **/api/v0/compose/results/<uuid>[?compression=gzip|zstd]**
 
       Returns a .tar of the metadata, logs, and output image of the build. This
       includes all the information needed to reproduce the build, including the
       final kickstart populated with repository and package NEVRA. The output image
-      is already in compressed form so the returned tar is not compressed.
+      is already in compressed form so the returned tar is not compressed, unless
+      the compression parameter is set.
 
       The mime type is set to 'application/x-tar' and the filename is set to
-      UUID.tar
+      UUID.tar. The Content-Length of an uncompressed tar is included.
     """
     if VALID_API_STRING.match(uuid) is None:
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
@@ -1938,10 +2021,7 @@ def v0_compose_results(uuid):
     elif status["queue_status"] not in ["FINISHED", "FAILED"]:
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s not in FINISHED or FAILED state." % uuid}]), 400
     else:
-        return Response(uuid_tar(api.config["COMPOSER_CFG"], uuid, metadata=True, image=True, logs=True),
-                        mimetype="application/x-tar",
-                        headers=[("Content-Disposition", "attachment; filename=%s.tar;" % uuid)],
-                        direct_passthrough=True)
+        return tar_response(uuid, uuid, metadata=True, image=True, logs=True)
 
 @v0_api.route("/compose/logs", defaults={'uuid': ""})
 @v0_api.route("/compose/logs/<uuid>")
@@ -1949,10 +2029,10 @@ def v0_compose_results(uuid):
 def v0_compose_logs(uuid):
     """Return a tar of the metadata for the build
 
-    **/api/v0/compose/logs/<uuid>**
+    **/api/v0/compose/logs/<uuid>[?compression=gzip|zstd]**
 
       Returns a .tar of the anaconda build logs. The tar is not compressed, but is
-      not large.
+      not large. The compression parameter can be used to compress it.
 
       The mime type is set to 'application/x-tar' and the filename is set to
       UUID-logs.tar
@@ -1966,10 +2046,7 @@ def v0_compose_logs(uuid):
     elif status["queue_status"] not in ["FINISHED", "FAILED"]:
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s not in FINISHED or FAILED state." % uuid}]), 400
     else:
-        return Response(uuid_tar(api.config["COMPOSER_CFG"], uuid, metadata=False, image=False, logs=True),
-                        mimetype="application/x-tar",
-                        headers=[("Content-Disposition", "attachment; filename=%s-logs.tar;" % uuid)],
-                        direct_passthrough=True)
+        return tar_response(uuid, uuid + "-logs", logs=True)
 
 @v0_api.route("/compose/image", defaults={'uuid': ""})
 @v0_api.route("/compose/image/<uuid>")
@@ -1997,10 +2074,10 @@ def v0_compose_image(uuid):
         if not os.path.exists(image_path):
             return jsonify(status=False, errors=[{"id": BUILD_MISSING_FILE, "msg": "Build %s is missing image file %s" % (uuid, image_name)}]), 400
 
-        # Make the image name unique
+        # Make the image name unique, and use its checksum for the ETag if it is known
+        checksums = read_checksums_file(joinpaths(os.path.dirname(image_path), "CHECKSUMS")).get(image_name)
         image_name = uuid + "-" + image_name
-        # XXX - Will mime type guessing work for all our output?
-        return send_file(image_path, as_attachment=True, attachment_filename=image_name, add_etags=False)
+        return send_file_range(request, image_path, image_name, checksums)
 
 @v0_api.route("/compose/log", defaults={'uuid': ""})
 @v0_api.route("/compose/log/<uuid>")
@@ -2008,7 +2085,7 @@ def v0_compose_image(uuid):
 def v0_compose_log_tail(uuid):
     """Return the tail of the most currently relevant log
 
-    **/api/v0/compose/log/<uuid>[?size=KiB]**
+    **/api/v0/compose/log/<uuid>[?size=KiB][&follow=1[&cursor=CURSOR]]**
 
       Returns the end of either the anaconda log, the packaging log, or the
       composer logs, depending on the progress of the compose. The size
@@ -2016,6 +2093,30 @@ def v0_compose_log_tail(uuid):
       returned data is raw text from the end of the log file, starting on a
       line boundary.
 
+      With follow=1 the log is streamed as Server-Sent Events (text/event-stream)
+      until the compose has finished. It starts with the last size KiB of the log, or
+      where a previous request stopped if its cursor is passed in the cursor parameter
+      or the Last-Event-ID header. Only new data is sent, as it is written. The events are:
+
+      * log: The new lines of the log. The id of the event is the cursor to reconnect with.
+      * switch: The data is the log that is now being followed, anaconda, packaging, or combined.
+      * end: The data is the final status of the compose. The stream is closed after it.
+
+      A comment is sent every 15 seconds when nothing has been written to the log.
+      Following is also possible while the compose is WAITING.
+
+      Example::
+
+          event: log
+          id: anaconda:104557
+          data: 12:59:50,782 INFO anaconda: Running post-installation scripts
+          data: 12:59:50,784 INFO anaconda: Thread Done: AnaConfigurationThread (140629395244800)
+          data:
+
+          event: switch
+          id: combined:2093,anaconda:104557
+          data: combined
+
       Example::
 
           12:59:24,222 INFO anaconda: Running Thread: AnaConfigurationThread (140629395244800)
@@ -2042,9 +2143,22 @@ def v0_compose_log_tail(uuid):
     except ValueError as e:
         return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
 
+    follow = request.args.get("follow", "0") in ("1", "true")
+    cursor = request.args.get("cursor") or request.headers.get("Last-Event-ID")
+    if follow and cursor:
+        try:
+            parse_cursor(cursor)
+        except ValueError as e:
+            return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
+
     status = uuid_status(api.config["COMPOSER_CFG"], uuid)
     if status is None:
         return jsonify(status=False, errors=[{"id": UNKNOWN_UUID, "msg": "%s is not a valid build uuid" % uuid}]), 400
+    elif follow:
+        events = follow_log(api.config["COMPOSER_CFG"], uuid, cursor, size)
+        return Response((sse_event(*e) for e in events), mimetype="text/event-stream",
+                        headers=[("Cache-Control", "no-cache"), ("X-Accel-Buffering", "no")],
+                        direct_passthrough=True)
     elif status["queue_status"] == "WAITING":
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s has not started yet. No logs to view" % uuid}])
     try:
@@ -79,6 +79,13 @@ def lorax_parser(dracut_default=""):
                         help="Top level temporary directory" )
     optional.add_argument("--cachedir", default=None, type=os.path.abspath,
                         help="DNF cache directory. Default is a temporary dir.")
+    optional.add_argument("--pkgcache", default=None, type=os.path.abspath,
+                        help="Directory to keep the downloaded packages in between runs. "
+                             "Their checksums are checked before they are used again. "
+                             "Default is the pkgcache setting in lorax.conf, or no cache.")
+    optional.add_argument("--max-parallel-downloads", default=None, type=int, metavar="N",
+                        help="Number of packages to download at the same time. "
+                             "Default is the max_parallel_downloads setting in lorax.conf, or dnf's default.")
     optional.add_argument("--workdir", default=None, type=os.path.abspath,
                         help="Work directory, overrides --tmp. Default is a temporary dir under /var/tmp/lorax")
     optional.add_argument("--force", default=False, action="store_true",
@@ -97,6 +104,8 @@ def lorax_parser(dracut_default=""):
                         default=[])
     optional.add_argument("--noverify", action="store_false", default=True, dest="verify",
                         help="Do not verify the install root")
+    optional.add_argument("--verify-libs", action="store_true", default=False,
+                        help="Also verify the libraries in /usr/lib64 and /usr/lib of the install root")
     optional.add_argument("--sharedir", metavar="SHAREDIR", type=os.path.abspath,
                           help="Directory containing all the templates. Overrides config file sharedir")
     optional.add_argument("--enablerepo", action="append", default=[], dest="enablerepos",
@@ -111,6 +120,9 @@ def lorax_parser(dracut_default=""):
                           help="Enable a DNF plugin by name/glob, or * to enable all of them.")
     optional.add_argument("--squashfs-only", action="store_true", default=False,
                           help="Use a plain squashfs filesystem for the runtime.")
+    optional.add_argument("--profile-templates", action="store_true", default=False,
+                          help="Write the time, files and bytes used by each template command to "
+                               "template-profile.json and template-profile.txt next to the logfile")
 
     # dracut arguments
     dracut_group = parser.add_argument_group("dracut arguments")
@@ -193,6 +205,9 @@ def lmc_parser(dracut_default=""):
     parser.add_argument("--lorax-templates", default=None,
                         type=os.path.abspath,
                         help="Path to mako templates for lorax")
+    parser.add_argument("--profile-templates", action="store_true", default=False,
+                        help="Write the time, files and bytes used by each template command to "
+                             "template-profile.json and template-profile.txt next to the logfile")
     parser.add_argument("--tmp", default="/var/tmp", type=os.path.abspath,
                         help="Top level temporary directory")
     parser.add_argument("--resultdir", default=None, dest="result_dir",
@@ -232,9 +247,11 @@ def lmc_parser(dracut_default=""):
     image_group.add_argument("--qcow2-arg", action="append", dest="qemu_args", default=[],
                              help="Arguments to pass to qemu-img. Pass once for each argument, they will be used for ALL calls to qemu-img.")
     image_group.add_argument("--compression", default="xz",
-                             help="Compression binary for make-tar. xz, lzma, gzip, and bzip2 are supported. xz is the default.")
+                             help="Compression binary for make-tar. xz, lzma, gzip, bzip2, and zstd are supported. xz is the default.")
     image_group.add_argument("--compress-arg", action="append", dest="compress_args", default=[],
                              help="Arguments to pass to compression. Pass once for each argument")
+    image_group.add_argument("--compress-threads", type=int, default=0,
+                             help="Number of threads to use for compression. Defaults to the number of cpus allowed by the cpu affinity and cgroup limits.")
     # Group of arguments for appliance creation
     app_group = parser.add_argument_group("appliance arguments")
     app_group.add_argument("--app-name", default=None,
@@ -307,6 +324,11 @@ def lmc_parser(dracut_default=""):
                         help="additional squashfs args")
     parser.add_argument("--timeout", default=None, type=int,
                         help="Cancel installer after X minutes")
+    parser.add_argument("--progress-log", default=None,
+                        help="Write the progress of the installation to this file as JSON lines")
+    parser.add_argument("--log-error-pattern", action="append", dest="log_error_patterns",
+                        help="Python regex of an installer log line that means the installation "
+                             "failed. Replaces the default patterns, may be passed more than once.")
 
     # add the show version option
     parser.add_argument("-V", help="show program's version number and exit",
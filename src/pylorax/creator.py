@@ -21,7 +21,6 @@ import os
 import tempfile
 import subprocess
 import shutil
-import hashlib
 import glob
 
 # Use Mako templates for appliance builder descriptions
@@ -38,13 +37,14 @@ from pylorax import ArchData
 from pylorax.base import DataHolder
 from pylorax.executils import execWithRedirect, runcmd
 from pylorax.imgutils import PartitionMount
-from pylorax.imgutils import mount, umount, Mount
-from pylorax.imgutils import mksquashfs, mkrootfsimg
-from pylorax.imgutils import copytree
+from pylorax.imgutils import mount, umount, Mount, OverlayMount
+from pylorax.imgutils import mksquashfs, mkrootfsimg, zero_free_blocks
+from pylorax.imgutils import copytree, image_checksums, publish_image, record_checksums
 from pylorax.installer import novirt_install, virt_install, InstallError
+from pylorax.progress import StageTimer
 from pylorax.treebuilder import TreeBuilder, RuntimeBuilder
 from pylorax.treebuilder import findkernels
-from pylorax.sysutils import joinpaths, remove
+from pylorax.sysutils import joinpaths, remove, publish_tree, run_stages
 
 
 # Default parameters for rebuilding initramfs, override with --dracut-args
@@ -153,17 +153,12 @@ def make_appliance(disk_img, name, template, outfile, networks=None, ram=1024,
     if not arch:
         arch = "x86_64"
 
-    log.info("Calculating SHA256 checksum of %s", disk_img)
-    sha256 = hashlib.sha256()
-    with open(disk_img, "rb") as f:
-        while True:
-            data = f.read(1024**2)
-            if not data:
-                break
-            sha256.update(data)
-    log.info("SHA256 of %s is %s", disk_img, sha256.hexdigest())
+    # Use the checksum calculated while the image was written or copied, if there is one.
+    # The raw disk images written by anaconda are read once here, the appliance needs it.
+    sha256 = image_checksums(disk_img)["sha256"]
+    log.info("SHA256 of %s is %s", disk_img, sha256)
     disk_info = DataHolder(name=os.path.basename(disk_img), format="raw",
-                           checksum_type="sha256", checksum=sha256.hexdigest())
+                           checksum_type="sha256", checksum=sha256)
     try:
         result = Template(filename=template).render(disks=[disk_info], name=name,
                           arch=arch, memory=ram, vcpus=vcpus, networks=networks,
@@ -310,7 +305,7 @@ def create_pxe_config(template, images_dir, live_image_name, add_args = None):
         f.write(result)
 
 
-def make_livecd(opts, mount_dir, work_dir):
+def make_livecd(opts, mount_dir, work_dir, make_runtime_func=None):
     """
     Take the content from the disk image and make a livecd out of it
 
@@ -318,12 +313,18 @@ def make_livecd(opts, mount_dir, work_dir):
     :type opts: argparse options
     :param str mount_dir: Directory tree to compress
     :param str work_dir: Output compressed image to work_dir+images/install.img
+    :param make_runtime_func: Function that creates work_dir+images/install.img
+    :type make_runtime_func: function
 
     This uses wwood's squashfs live initramfs method:
      * put the real / into LiveOS/rootfs.img
      * make a squashfs of the LiveOS/rootfs.img tree
      * This is loaded by dracut when the cmdline is passed to the kernel:
        root=live:CDLABEL=<volid> rd.live.image
+
+    mount_dir is not modified, the initrds are rebuilt in an overlay on top of
+    it. This allows make_runtime_func to read mount_dir while they are rebuilt,
+    the boot.iso is built when both have finished.
     """
     kernel_arch = get_arch(mount_dir)
 
@@ -332,32 +333,11 @@ def make_livecd(opts, mount_dir, work_dir):
     product = DataHolder(name=opts.project, version=opts.releasever, release="",
                             variant="", bugurl="", isfinal=False)
 
-    # Link /images to work_dir/images to make the templates happy
-    if os.path.islink(joinpaths(mount_dir, "images")):
-        os.unlink(joinpaths(mount_dir, "images"))
-    execWithRedirect("/bin/ln", ["-s", joinpaths(work_dir, "images"),
-                                 joinpaths(mount_dir, "images")])
-
-    # The templates expect the config files to be in /tmp/config_files
-    # I think these should be release specific, not from lorax, but for now
-    configdir = joinpaths(opts.lorax_templates,"live/config_files/")
-    configdir_path = "tmp/config_files"
-    fullpath = joinpaths(mount_dir, configdir_path)
-    if os.path.exists(fullpath):
-        remove(fullpath)
-    copytree(configdir, fullpath)
-
     isolabel = opts.volid or "{0.name}-{0.version}-{1.basearch}".format(product, arch)
     if len(isolabel) > 32:
         isolabel = isolabel[:32]
         log.warning("Truncating isolabel to 32 chars: %s", isolabel)
 
-    tb = TreeBuilder(product=product, arch=arch, domacboot=opts.domacboot,
-                     inroot=mount_dir, outroot=work_dir,
-                     runtime=RUNTIME, isolabel=isolabel,
-                     templatedir=joinpaths(opts.lorax_templates,"live/"),
-                     extra_boot_args=opts.extra_boot_args)
-    log.info("Rebuilding initrds")
     if not opts.dracut_args:
         dracut_args = DRACUT_DEFAULT
     else:
@@ -365,9 +345,43 @@ def make_livecd(opts, mount_dir, work_dir):
         for arg in opts.dracut_args:
             dracut_args += arg.split(" ", 1)
     log.info("dracut args = %s", dracut_args)
-    tb.rebuild_initrds(add_args=dracut_args)
-    log.info("Building boot.iso")
-    tb.build()
+
+    with OverlayMount(mount_dir, tmpdir=opts.tmp) as overlay_dir:
+        # Link /images to work_dir/images to make the templates happy
+        if os.path.islink(joinpaths(overlay_dir, "images")):
+            os.unlink(joinpaths(overlay_dir, "images"))
+        execWithRedirect("/bin/ln", ["-s", joinpaths(work_dir, "images"),
+                                     joinpaths(overlay_dir, "images")])
+
+        # The templates expect the config files to be in /tmp/config_files
+        # I think these should be release specific, not from lorax, but for now
+        configdir = joinpaths(opts.lorax_templates,"live/config_files/")
+        configdir_path = "tmp/config_files"
+        fullpath = joinpaths(overlay_dir, configdir_path)
+        if os.path.exists(fullpath):
+            remove(fullpath)
+        copytree(configdir, fullpath)
+
+        tb = TreeBuilder(product=product, arch=arch, domacboot=opts.domacboot,
+                         inroot=overlay_dir, outroot=work_dir,
+                         runtime=RUNTIME, isolabel=isolabel,
+                         templatedir=joinpaths(opts.lorax_templates,"live/"),
+                         extra_boot_args=opts.extra_boot_args)
+
+        def rebuild_initrds():
+            log.info("Rebuilding initrds")
+            tb.rebuild_initrds(add_args=dracut_args)
+
+        def build_iso():
+            log.info("Building boot.iso")
+            tb.build()
+
+        stages = {"initramfs": (rebuild_initrds, []),
+                  "boot.iso":  (build_iso, ["initramfs"])}
+        if make_runtime_func:
+            stages["runtime"] = (make_runtime_func, [])
+            stages["boot.iso"][1].append("runtime")
+        run_stages(stages)
 
     return work_dir
 
@@ -401,13 +415,14 @@ def mount_boot_part_over_root(img_mount):
     remove(tmp_mount_dir)
     return sysroot_boot_dir
 
-def make_squashfs(opts, disk_img, work_dir):
+def make_squashfs(opts, disk_img, work_dir, zero_blocks=True):
     """
     Create a squashfs image of an unpartitioned filesystem disk image
 
     :param str disk_img: Path to the unpartitioned filesystem disk image
     :param str work_dir: Output compressed image to work_dir+images/install.img
-    :param str compression: Compression type to use
+    :param bool zero_blocks: Zero the free blocks of disk_img first. Pass False when the
+                             caller has already done it, eg. because disk_img is mounted.
     :returns: True if squashfs creation was successful. False if there was an error.
     :rtype: bool
 
@@ -415,12 +430,12 @@ def make_squashfs(opts, disk_img, work_dir):
     tree into work_dir+images/install.img
 
     fsck.ext4 is run on the disk image to make sure there are no errors and to zero
-    out any deleted blocks to make it compress better. If this fails for any reason
-    it will return False and log the error.
+    out any deleted blocks to make it compress better, unless the image was just
+    created or trimmed by lorax. If this fails for any reason it will return False
+    and log the error.
     """
     # Make sure free blocks are actually zeroed so it will compress
-    rc = execWithRedirect("/usr/sbin/fsck.ext4", ["-y", "-f", "-E", "discard", disk_img])
-    if rc != 0:
+    if zero_blocks and not zero_free_blocks(disk_img):
         log.error("Problem zeroing free blocks of %s", disk_img)
         return False
 
@@ -545,8 +560,9 @@ def make_live_images(opts, work_dir, disk_img):
     :rtype: str
 
     fsck.ext4 is run on the rootfs_image to make sure there are no errors and to zero
-    out any deleted blocks to make it compress better. If this fails for any reason
-    it will return None and log the error.
+    out any deleted blocks to make it compress better, unless the image was just
+    created or trimmed by lorax. If this fails for any reason it will return None
+    and log the error.
     """
     sys_root = ""
 
@@ -588,31 +604,41 @@ def make_live_images(opts, work_dir, disk_img):
     log.debug("sys_root = %s", sys_root)
 
     # Make sure free blocks are actually zeroed so it will compress
-    rc = execWithRedirect("/usr/sbin/fsck.ext4", ["-y", "-f", "-E", "discard", rootfs_img])
-    if rc != 0:
+    if not zero_free_blocks(rootfs_img):
         log.error("Problem zeroing free blocks of %s", disk_img)
         return None
 
-    log.info("Packing live rootfs image")
     add_pxe_args = []
     live_image_name = "live-rootfs.squashfs.img"
-    compression, compressargs = squashfs_args(opts)
-    mksquashfs(squashfs_root_dir, joinpaths(work_dir, live_image_name), compression, compressargs)
-
-    log.info("Rebuilding initramfs for live")
-    with Mount(rootfs_img, opts="loop") as mnt_dir:
-        try:
-            mount(joinpaths(mnt_dir, "boot"), opts="bind", mnt=joinpaths(mnt_dir, sys_root, "boot"))
-            rebuild_initrds_for_live(opts, joinpaths(mnt_dir, sys_root), work_dir)
-        finally:
-            umount(joinpaths(mnt_dir, sys_root, "boot"), delete=False)
-
-    remove(squashfs_root_dir)
-
     if opts.ostree:
         add_pxe_args.append("ostree=/%s" % sys_root)
     template = joinpaths(opts.lorax_templates, "pxe-live/pxe-config.tmpl")
-    create_pxe_config(template, work_dir, live_image_name, add_pxe_args)
+
+    def pack_rootfs():
+        log.info("Packing live rootfs image")
+        compression, compressargs = squashfs_args(opts)
+        mksquashfs(squashfs_root_dir, joinpaths(work_dir, live_image_name), compression, compressargs)
+
+    def rebuild_initramfs():
+        # Changes dracut makes to the image go into an overlay so that it can be
+        # packed at the same time
+        log.info("Rebuilding initramfs for live")
+        with Mount(rootfs_img, opts="loop,ro") as mnt_dir:
+            with OverlayMount(mnt_dir, tmpdir=opts.tmp) as root_dir:
+                try:
+                    mount(joinpaths(root_dir, "boot"), opts="bind", mnt=joinpaths(root_dir, sys_root, "boot"))
+                    rebuild_initrds_for_live(opts, joinpaths(root_dir, sys_root), work_dir)
+                finally:
+                    umount(joinpaths(root_dir, sys_root, "boot"), delete=False)
+
+    def pxe_config():
+        create_pxe_config(template, work_dir, live_image_name, add_pxe_args)
+
+    run_stages({"squashfs":   (pack_rootfs, []),
+                "initramfs":  (rebuild_initramfs, []),
+                "pxe-config": (pxe_config, ["initramfs"])})
+
+    remove(squashfs_root_dir)
 
     return work_dir
 
@@ -671,8 +697,11 @@ def run_creator(opts, cancel_func=None):
     See the cmdline --help for livemedia-creator for the possible options
 
     (Yes, this is not ideal, but we can fix that later)
+
+    If opts.stage_log is set the time taken by each stage is appended to it.
     """
     result_dir = None
+    timer = StageTimer(getattr(opts, "stage_log", None))
 
     # Parse the kickstart
     if opts.ks:
@@ -715,22 +744,31 @@ def run_creator(opts, cancel_func=None):
             # Create iso from a filesystem image
             disk_img = opts.fs_image or disk_img
 
-            if not make_squashfs(opts, disk_img, work_dir):
-                log.error("squashfs.img creation failed")
-                raise RuntimeError("squashfs.img creation failed")
+            # fsck.ext4 cannot run while the image is mounted, so the free blocks are
+            # zeroed here and make_squashfs is told not to do it again below
+            with timer.stage("zero-free-blocks"):
+                if not zero_free_blocks(disk_img):
+                    log.error("Problem zeroing free blocks of %s", disk_img)
+                    raise RuntimeError("squashfs.img creation failed")
 
             if cancel_func and cancel_func():
                 raise RuntimeError("ISO creation canceled")
 
-            with Mount(disk_img, opts="loop") as mount_dir:
-                result_dir = make_livecd(opts, mount_dir, work_dir)
+            def make_runtime_squashfs():
+                if not make_squashfs(opts, disk_img, work_dir, zero_blocks=False):
+                    log.error("squashfs.img creation failed")
+                    raise RuntimeError("squashfs.img creation failed")
+
+            with timer.stage("livecd"), Mount(disk_img, opts="loop,ro") as mount_dir:
+                result_dir = make_livecd(opts, mount_dir, work_dir, make_runtime_squashfs)
         else:
             # Create iso from a partitioned disk image
             disk_img = opts.disk_image or disk_img
-            with PartitionMount(disk_img) as img_mount:
+            with timer.stage("livecd"), PartitionMount(disk_img) as img_mount:
                 if img_mount and img_mount.mount_dir:
-                    make_runtime(opts, img_mount.mount_dir, work_dir, calculate_disk_size(opts, ks)/1024.0)
-                    result_dir = make_livecd(opts, img_mount.mount_dir, work_dir)
+                    size = calculate_disk_size(opts, ks)/1024.0
+                    result_dir = make_livecd(opts, img_mount.mount_dir, work_dir,
+                                             lambda: make_runtime(opts, img_mount.mount_dir, work_dir, size))
 
         # --iso-only removes the extra build artifacts, keeping only the boot.iso
         if opts.iso_only and result_dir:
@@ -740,7 +778,7 @@ def run_creator(opts, cancel_func=None):
             else:
                 iso_dir = tempfile.mkdtemp(prefix="lmc-result-")
                 dest_file = joinpaths(iso_dir, opts.iso_name or "boot.iso")
-                shutil.move(boot_iso, dest_file)
+                publish_image(boot_iso, dest_file)
                 shutil.rmtree(result_dir)
                 result_dir = iso_dir
 
@@ -764,14 +802,18 @@ def run_creator(opts, cancel_func=None):
         disk_img = opts.fs_image or opts.disk_image or disk_img
         log.debug("disk image is %s", disk_img)
 
-        result_dir = make_live_images(opts, work_dir, disk_img)
+        with timer.stage("pxe-live"):
+            result_dir = make_live_images(opts, work_dir, disk_img)
         if result_dir is None:
             log.error("Creating PXE live image failed.")
             raise RuntimeError("Creating PXE live image failed.")
 
     if opts.result_dir != opts.tmp and result_dir:
-        copytree(result_dir, opts.result_dir, preserve=False)
-        shutil.rmtree(result_dir)
+        with timer.stage("publish"):
+            # Keep the checksums of the files that had to be copied
+            for relpath, digest in publish_tree(result_dir, opts.result_dir).items():
+                record_checksums(joinpaths(opts.result_dir, relpath), {"sha256": digest})
+            shutil.rmtree(result_dir)
         result_dir = None
 
     return (result_dir, disk_img)
@@ -17,6 +17,7 @@ import logging
 log = logging.getLogger("pylorax")
 
 import dnf
+import hashlib
 import os
 import shutil
 
@@ -26,7 +27,8 @@ from pylorax.sysutils import flatconfig
 def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
                         enablerepos=None, disablerepos=None,
                         tempdir="/var/tmp", proxy=None, releasever="29",
-                        cachedir=None, logdir=None, sslverify=True, dnfplugins=None):
+                        cachedir=None, logdir=None, sslverify=True, dnfplugins=None,
+                        max_parallel_downloads=None, pkgcache=None):
     """ Create a dnf Base object and setup the repositories and installroot
 
         :param string installroot: Full path to the installroot
@@ -39,9 +41,15 @@ def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
         :param string releasever: Release version to pass to dnf
         :param string cachedir: Directory to use for caching packages
         :param bool noverifyssl: Set to True to ignore the CA of ssl certs. eg. use self-signed ssl for https repos.
+        :param int max_parallel_downloads: Number of packages to download at the same time, None uses dnf's default
+        :param string pkgcache: Directory to keep downloaded packages in between runs, None to not keep them
 
         If tempdir is not set /var/tmp is used.
         If cachedir is None a dnf.cache directory is created inside tmpdir
+
+        The packages in pkgcache are kept in a subdirectory for each repository, dnf
+        verifies their checksums against the repository metadata before using them
+        and downloads them again if they do not match.
     """
     def sanitize_repo(repo):
         """Convert bare paths to file:/// URIs, and silently reject protocols unhandled by yum"""
@@ -101,6 +109,10 @@ def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
     if sslverify == False:
         conf.sslverify = False
 
+    if max_parallel_downloads:
+        conf.max_parallel_downloads = max_parallel_downloads
+    log.info("Downloading up to %d packages at a time", conf.max_parallel_downloads)
+
     # DNF 3.2 needs to have module_platform_id set, otherwise depsolve won't work correctly
     if not os.path.exists("/etc/os-release"):
         log.warning("/etc/os-release is missing, cannot determine platform id, falling back to %s", DEFAULT_PLATFORM_ID)
@@ -179,7 +191,44 @@ def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
             repolist.disable()
             log.info("Disabled repo %s", r)
 
+    if pkgcache:
+        use_package_cache(dnfbase, pkgcache)
+
     dnfbase.fill_sack(load_system_repo=False)
     dnfbase.read_comps()
 
     return dnfbase
+
+def repo_cache_name(repo):
+    """Return the name of the package cache subdirectory for a repository
+
+    :param repo: The dnf repository
+    :type repo: dnf.repo.Repo
+    :returns: The repo id and a hash of the repository's urls
+    :rtype: str
+
+    The repositories added with --source are numbered in the order they are passed
+    on the cmdline, including the urls in the name keeps the same packages from
+    being used for a different repository.
+    """
+    urls = list(repo.baseurl or []) + [repo.mirrorlist or "", repo.metalink or ""]
+    digest = hashlib.sha1(" ".join(urls).encode("utf-8")).hexdigest()[:12]
+    return "%s-%s" % (repo.id, digest)
+
+def use_package_cache(dbo, pkgcache):
+    """Download the packages of the enabled repositories into a persistent cache
+
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :param str pkgcache: Directory to keep the packages in
+
+    dnf checks the checksums of the cached packages before the transaction, and
+    only downloads the ones that are missing or do not match.
+    """
+    dbo.conf.keepcache = True
+    for repo in dbo.repos.iter_enabled():
+        pkgdir = os.path.join(pkgcache, repo_cache_name(repo))
+        if not os.path.isdir(pkgdir):
+            os.makedirs(pkgdir)
+        repo.pkgdir = pkgdir
+        log.info("Using %s as the package cache for %s", pkgdir, repo.id)
@@ -51,8 +51,19 @@ class LoraxDownloadCallback(dnf.callback.DownloadProgress):
         self.pkgno = 0
         self.total = 0
 
+        # Per-repo download statistics, {repoid: [files, bytes, first seen, last finished]}
+        self.repo_stats = collections.OrderedDict()
+        self.start_time = None
+
         self.output = output.LoraxOutput()
 
+    def _repo_stats(self, payload):
+        pkg = getattr(payload, "pkg", None)
+        repoid = getattr(pkg, "reponame", None) or "unknown"
+        if repoid not in self.repo_stats:
+            self.repo_stats[repoid] = [0, 0, time.time(), None]
+        return self.repo_stats[repoid]
+
     @_paced
     def _update(self):
         msg = "Downloading %(pkgno)s / %(total_files)s RPMs, " \
@@ -72,12 +83,17 @@ class LoraxDownloadCallback(dnf.callback.DownloadProgress):
         if status is dnf.callback.STATUS_OK:
             self.downloads[nevra] = payload.download_size
             self.pkgno += 1
+            stats = self._repo_stats(payload)
+            stats[0] += 1
+            stats[1] += payload.download_size
+            stats[3] = time.time()
             self._update()
             return
         logger.critical("Failed to download '%s': %d - %s", nevra, status, msg)
 
     def progress(self, payload, done):
         nevra = str(payload)
+        self._repo_stats(payload)
         self.downloads[nevra] = done
         self._update()
 
@@ -86,6 +102,34 @@ class LoraxDownloadCallback(dnf.callback.DownloadProgress):
     def start(self, total_files, total_size, total_drpms=0):
         self.total_files = total_files
         self.total_size = total_size
+        self.start_time = time.time()
+
+    def log_summary(self, total_pkgs=None):
+        """Log the download throughput of each repository
+
+        :param int total_pkgs: Number of packages in the transaction, used to report
+                               how many were already cached or in a local repository
+
+        With parallel downloads the time for a repository is from the first progress
+        report of one of its packages to the last one that finished.
+        """
+        def rate(size, seconds):
+            return size / 1024**2 / max(seconds, 0.001)
+
+        if self.start_time is None:
+            logger.info("No packages needed to be downloaded")
+        else:
+            elapsed = time.time() - self.start_time
+            downloaded = sum(stats[1] for stats in self.repo_stats.values())
+            logger.info("Downloaded %d packages, %0.1f MiB in %0.1fs (%0.1f MiB/s)",
+                        self.pkgno, downloaded / 1024**2, elapsed, rate(downloaded, elapsed))
+            for repoid, (files, size, first, last) in self.repo_stats.items():
+                seconds = (last or first) - first
+                logger.info("  %s: %d packages, %0.1f MiB in %0.1fs (%0.1f MiB/s)",
+                            repoid, files, size / 1024**2, seconds, rate(size, seconds))
+        if total_pkgs is not None:
+            logger.info("%d of %d packages did not need to be downloaded",
+                        total_pkgs - self.total_files, total_pkgs)
 
 
 class LoraxRpmCallback(dnf.callback.TransactionProgress):
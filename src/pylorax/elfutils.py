@@ -0,0 +1,392 @@
+#
+# elfutils.py - read the dynamic linking information of ELF files
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.elfutils")
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import os
+import stat
+import struct
+
+ELF_MAGIC = b'\x7fELF'
+
+# Values from elf.h
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# struct formats for the ELF header (after e_ident), program headers and dynamic entries
+_ELF_FORMATS = {
+    ELFCLASS32: ("HHIIIIIHHHHHH", "IIIIIIII", "iI"),
+    ELFCLASS64: ("HHIQQQIHHHHHH", "IIQQQQQQ", "qQ"),
+}
+
+class ElfError(Exception):
+    pass
+
+ElfInfo = namedtuple("ElfInfo", ["elfclass", "machine", "interp", "needed", "rpath", "runpath", "soname"])
+
+def read_elf(path):
+    """Read the dynamic linking information from an ELF file
+
+    :param str path: Path to the file
+    :returns: The class, machine, interpreter, DT_NEEDED, DT_RPATH, DT_RUNPATH and DT_SONAME
+              of the file, or None if it is not an ELF file
+    :rtype: ElfInfo
+    :raises: ElfError if the file is truncated or corrupt
+
+    Statically linked files have an empty list of needed libraries and no interpreter.
+    """
+    with open(path, "rb") as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            return None
+        elfclass = ident[4]
+        if elfclass not in _ELF_FORMATS or ident[5] not in (1, 2):
+            raise ElfError("%s has an unknown ELF class or data encoding" % path)
+        endian = "<" if ident[5] == 1 else ">"
+        ehdr_fmt, phdr_fmt, dyn_fmt = (endian + fmt for fmt in _ELF_FORMATS[elfclass])
+
+        def read_struct(fmt, offset):
+            f.seek(offset)
+            data = f.read(struct.calcsize(fmt))
+            if len(data) != struct.calcsize(fmt):
+                raise ElfError("%s is truncated" % path)
+            return struct.unpack(fmt, data)
+
+        ehdr = read_struct(ehdr_fmt, 16)
+        machine, phoff, phentsize, phnum = ehdr[1], ehdr[4], ehdr[8], ehdr[9]
+
+        loads = []
+        dynamic = None
+        interp = None
+        for i in range(phnum):
+            phdr = read_struct(phdr_fmt, phoff + i * phentsize)
+            if elfclass == ELFCLASS32:
+                p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[1], phdr[2], phdr[4]
+            else:
+                p_type, p_offset, p_vaddr, p_filesz = phdr[0], phdr[2], phdr[3], phdr[5]
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+            elif p_type == PT_INTERP:
+                f.seek(p_offset)
+                interp = os.fsdecode(f.read(p_filesz).split(b"\0", 1)[0])
+
+        if dynamic is None:
+            return ElfInfo(elfclass, machine, interp, [], [], [], None)
+
+        entries = []
+        entsize = struct.calcsize(dyn_fmt)
+        for i in range(dynamic[1] // entsize):
+            tag, val = read_struct(dyn_fmt, dynamic[0] + i * entsize)
+            if tag == DT_NULL:
+                break
+            entries.append((tag, val))
+
+        # DT_STRTAB is an address, find where it is in the file
+        strtab = None
+        for tag, val in entries:
+            if tag == DT_STRTAB:
+                for vaddr, offset, filesz in loads:
+                    if vaddr <= val < vaddr + filesz:
+                        strtab = val - vaddr + offset
+                        break
+        if strtab is None:
+            raise ElfError("%s has no string table for its dynamic section" % path)
+
+        def read_string(offset):
+            f.seek(strtab + offset)
+            data = b""
+            while b"\0" not in data:
+                chunk = f.read(256)
+                if not chunk:
+                    raise ElfError("%s is truncated" % path)
+                data += chunk
+            return os.fsdecode(data.split(b"\0", 1)[0])
+
+        strings = dict((tag, []) for tag in (DT_NEEDED, DT_RPATH, DT_RUNPATH, DT_SONAME))
+        for tag, val in entries:
+            if tag in strings:
+                strings[tag].append(read_string(val))
+
+    split_paths = lambda values: [p for v in values for p in v.split(":") if p]
+    return ElfInfo(elfclass, machine, interp, strings[DT_NEEDED],
+                   split_paths(strings[DT_RPATH]), split_paths(strings[DT_RUNPATH]),
+                   (strings[DT_SONAME] or [None])[0])
+
+def expand_search_dirs(dirs, origin, elfclass):
+    """Expand the dynamic string tokens in DT_RPATH or DT_RUNPATH directories
+
+    :param list dirs: Directories from DT_RPATH or DT_RUNPATH
+    :param str origin: Directory of the ELF file, for $ORIGIN
+    :param int elfclass: ELFCLASS32 or ELFCLASS64, for $LIB
+    :returns: The directories with $ORIGIN and $LIB replaced
+    :rtype: list of str
+    """
+    lib = "lib64" if elfclass == ELFCLASS64 else "lib"
+    return [d.replace("$ORIGIN", origin).replace("${ORIGIN}", origin)
+             .replace("$LIB", lib).replace("${LIB}", lib) for d in dirs]
+
+def _read_elf_quietly(path):
+    """Read an ELF file in a worker process, returning the error instead of raising it"""
+    try:
+        return read_elf(path)
+    except (ElfError, OSError) as e:
+        return e
+
+class LibraryIndex(object):
+    """Find the shared libraries needed by ELF files in a root directory
+
+    :param str root: The root directory, libraries are searched for relative to it
+
+    Libraries are searched for like ld.so does it, in the DT_RPATH, DT_RUNPATH,
+    the directories from /etc/ld.so.conf and the default directories, skipping
+    libraries for a different class or machine. Symlinks are resolved inside
+    the root. The ELF files, directory listings and results are cached, so
+    checking many files that use the same libraries is cheap.
+    """
+    def __init__(self, root):
+        self.root = root.rstrip("/")
+        self._elf = {}
+        self._listdir = {}
+        self._realpath = {}
+        self._needed = {}
+        self._ldconf = None
+
+    def realpath(self, path):
+        """Resolve the symlinks in a path inside the root
+
+        :param str path: Absolute path inside the root
+        :returns: The resolved path inside the root, or None if it does not exist
+        :rtype: str
+        """
+        if path not in self._realpath:
+            self._realpath[path] = self._resolve(path)
+        return self._realpath[path]
+
+    def _resolve(self, path):
+        parts = [p for p in path.split("/") if p]
+        resolved = "/"
+        links = 0
+        while parts:
+            part = parts.pop(0)
+            if part == ".":
+                continue
+            if part == "..":
+                resolved = os.path.dirname(resolved)
+                continue
+            candidate = os.path.join(resolved, part)
+            try:
+                st = os.lstat(self.root + candidate)
+            except OSError:
+                return None
+            if stat.S_ISLNK(st.st_mode):
+                links += 1
+                if links > 40:
+                    return None
+                target = os.readlink(self.root + candidate)
+                if target.startswith("/"):
+                    resolved = "/"
+                parts = [p for p in target.split("/") if p] + parts
+            else:
+                resolved = candidate
+        return resolved
+
+    def elf(self, path):
+        """Return the ELF information of a file inside the root
+
+        :param str path: Resolved path inside the root
+        :returns: The ELF information or None if it is not an ELF file
+        :rtype: ElfInfo
+        :raises: ElfError or OSError if it cannot be read
+        """
+        if path not in self._elf:
+            self._elf[path] = _read_elf_quietly(self.root + path)
+        if isinstance(self._elf[path], Exception):
+            raise self._elf[path]
+        return self._elf[path]
+
+    def preload(self, paths, processes=None):
+        """Read ELF files using a pool of processes
+
+        :param list paths: Resolved paths inside the root
+        :param int processes: Number of processes to use, None uses the number of cpus
+
+        This is only worth doing for large trees, reading the ELF headers is cheap.
+        """
+        paths = [p for p in paths if p not in self._elf]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            full_paths = [self.root + p for p in paths]
+            for path, info in zip(paths, executor.map(_read_elf_quietly, full_paths, chunksize=64)):
+                self._elf[path] = info
+
+    def _listing(self, directory):
+        if directory not in self._listdir:
+            try:
+                self._listdir[directory] = frozenset(os.listdir(self.root + directory))
+            except OSError:
+                self._listdir[directory] = frozenset()
+        return self._listdir[directory]
+
+    def ld_so_conf(self):
+        """Return the library directories listed in /etc/ld.so.conf of the root
+
+        :returns: Directories in the order they are listed
+        :rtype: list of str
+        """
+        if self._ldconf is None:
+            self._ldconf = []
+            self._read_ld_so_conf("/etc/ld.so.conf", set())
+        return self._ldconf
+
+    def _read_ld_so_conf(self, path, seen):
+        if path in seen:
+            return
+        seen.add(path)
+        try:
+            lines = open(self.root + path, "r", encoding="latin-1").readlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.split("#", 1)[0].strip()
+            if not line or line.startswith("hwcap "):
+                continue
+            if line.startswith("include "):
+                for pattern in line.split()[1:]:
+                    if not pattern.startswith("/"):
+                        pattern = os.path.join(os.path.dirname(path), pattern)
+                    for conf in sorted(glob.glob(self.root + pattern)):
+                        self._read_ld_so_conf(conf[len(self.root):], seen)
+            else:
+                self._ldconf.extend(d for d in line.replace(",", " ").split() if d.startswith("/"))
+
+    def search_path(self, info, origin, inherited_rpath=None):
+        """Return the directories to search for the libraries needed by an ELF file
+
+        :param ElfInfo info: The ELF file
+        :param str origin: Directory of the ELF file, for $ORIGIN
+        :param list inherited_rpath: DT_RPATH of the executable that loads it
+        :returns: Directories to search in order
+        :rtype: list of str
+        """
+        lib = "lib64" if info.elfclass == ELFCLASS64 else "lib"
+        dirs = []
+        if not info.runpath:
+            dirs += expand_search_dirs(info.rpath, origin, info.elfclass) + (inherited_rpath or [])
+        dirs += expand_search_dirs(info.runpath, origin, info.elfclass)
+        dirs += self.ld_so_conf()
+        dirs += ["/%s" % lib, "/usr/%s" % lib]
+        return dirs
+
+    def find(self, name, info, origin, inherited_rpath=None):
+        """Find a library needed by an ELF file
+
+        :param str name: The DT_NEEDED name of the library
+        :param ElfInfo info: The ELF file needing it
+        :param str origin: Directory of the ELF file, for $ORIGIN
+        :param list inherited_rpath: DT_RPATH of the executable that loads it
+        :returns: Resolved path of the library inside the root, or None
+        :rtype: str
+        """
+        if "/" in name:
+            candidates = [name if name.startswith("/") else os.path.join(origin, name)]
+        else:
+            candidates = []
+            for d in self.search_path(info, origin, inherited_rpath):
+                directory = self.realpath(d)
+                if directory and name in self._listing(directory):
+                    candidates.append(os.path.join(directory, name))
+        for candidate in candidates:
+            path = self.realpath(candidate)
+            if not path:
+                continue
+            try:
+                lib_info = self.elf(path)
+            except (ElfError, OSError):
+                continue
+            if lib_info and (lib_info.elfclass, lib_info.machine) == (info.elfclass, info.machine):
+                return path
+        return None
+
+    def missing(self, path):
+        """Find the libraries, and interpreter, needed by an ELF file that do not exist
+
+        :param str path: Path of the ELF file inside the root
+        :returns: (library name, path of the file that needs it) for each missing library,
+                  empty if nothing is missing or it is not a dynamically linked ELF file
+        :rtype: list of tuple
+        :raises: ElfError or OSError if the file cannot be read
+
+        All the libraries loaded by the file are checked, not just the ones it
+        directly depends on.
+        """
+        path = self.realpath(path)
+        info = self.elf(path)
+        if not info:
+            return []
+        missing = []
+        if info.interp and not self.realpath(info.interp):
+            missing.append((info.interp, path))
+
+        inherited_rpath = []
+        if not info.runpath:
+            inherited_rpath = expand_search_dirs(info.rpath, os.path.dirname(path), info.elfclass)
+
+        # Walk all of the libraries that get loaded, checking each one once.
+        # ld.so uses an already loaded library with the same name or soname even if
+        # it is not in the search path of the file needing it.
+        seen = set([path])
+        loaded = set()
+        unresolved = []
+        todo = [path]
+        while todo:
+            obj = todo.pop()
+            for name, lib in self._resolve_needed(obj, tuple(inherited_rpath)):
+                if lib is None:
+                    unresolved.append((name, obj))
+                    continue
+                loaded.add(name)
+                if lib not in seen:
+                    seen.add(lib)
+                    todo.append(lib)
+                    loaded.add(self.elf(lib).soname)
+        missing += [(name, obj) for name, obj in unresolved if name not in loaded]
+        return missing
+
+    def _resolve_needed(self, path, inherited_rpath):
+        """Return [(name, resolved path or None)] for the DT_NEEDED of a file"""
+        key = (path, inherited_rpath)
+        if key not in self._needed:
+            info = self.elf(path)
+            origin = os.path.dirname(path)
+            self._needed[key] = [(name, self.find(name, info, origin, list(inherited_rpath)))
+                                  for name in info.needed]
+        return self._needed[key]
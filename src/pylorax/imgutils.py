@@ -26,24 +26,221 @@ from subprocess import Popen, PIPE, CalledProcessError
 import sys
 import time
 import traceback
-import multiprocessing
+import stat
+import re
+import hashlib
+import threading
+import lzma
+import gzip
+import bz2
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 import shutil
 
-from pylorax.sysutils import cpfile
+from pylorax.sysutils import cpfile, cpu_budget, publish_file
 from pylorax.executils import execWithRedirect, execWithCapture
 from pylorax.executils import runcmd, runcmd_output
 
+######## Image checksums #################################################
+
+# Digests of images computed while they were being written, keyed by the real
+# path of the image. The size and mtime are saved with them so that a file that
+# has been changed since then is not trusted.
+_image_checksums = {}
+
+class HashingWriter(object):
+    """Write to a file object, hashing the data on the way through
+
+    :param fobj: File object to write to
+    :param hashnames: hashlib algorithms to use
+    :type hashnames: tuple of str
+    """
+    def __init__(self, fobj, hashnames=("sha256",)):
+        self._fobj = fobj
+        self._hashes = [(name, hashlib.new(name)) for name in hashnames]
+
+    def write(self, data):
+        for _name, h in self._hashes:
+            h.update(data)
+        return self._fobj.write(data)
+
+    def flush(self):
+        self._fobj.flush()
+
+    def hexdigests(self):
+        """Return the digests of the data written so far
+
+        :returns: {hashname: hexdigest}
+        :rtype: dict
+        """
+        return dict((name, h.hexdigest()) for name, h in self._hashes)
+
+def record_checksums(path, digests):
+    """Remember the digests of a file that were calculated while writing it
+
+    :param str path: Path to the file
+    :param dict digests: {hashname: hexdigest}
+    """
+    st = os.stat(path)
+    _image_checksums[os.path.realpath(path)] = (st.st_size, st.st_mtime_ns, dict(digests))
+
+def move_checksums(src, dst):
+    """Move the remembered digests of a file that has been renamed
+
+    :param str src: Old path of the file
+    :param str dst: New path of the file
+    """
+    entry = _image_checksums.pop(os.path.realpath(src), None)
+    if entry:
+        record_checksums(dst, entry[2])
+
+def publish_image(src, dst):
+    """Move an image to its final location, keeping or recording its sha256
+
+    :param str src: Path of the image to move
+    :param str dst: Path of the destination, it is replaced if it exists
+    :returns: How the image was moved, see publish_file
+    :rtype: str
+    :raises: OSError if a copy does not match the sha256 recorded for src
+
+    A rename or reflink keeps the digests recorded for src. When the image has to
+    be copied to another filesystem it is checksummed while it is copied.
+    """
+    recorded = image_checksums(src, compute=False).get("sha256")
+    method, digest = publish_file(src, dst, "sha256", expected=recorded)
+    move_checksums(src, dst)
+    if digest:
+        record_checksums(dst, {"sha256": digest})
+    return method
+
+def image_checksums(path, hashnames=("sha256",), compute=True):
+    """Return the digests of a file
+
+    :param str path: Path to the file
+    :param hashnames: hashlib algorithms to return
+    :type hashnames: tuple of str
+    :param bool compute: Read the file to calculate digests that were not recorded
+    :returns: {hashname: hexdigest}, empty if compute is False and nothing was recorded
+    :rtype: dict
+
+    The digests recorded while writing the file are used if the file has not
+    changed since then, otherwise the whole file is read.
+    """
+    st = os.stat(path)
+    entry = _image_checksums.get(os.path.realpath(path))
+    if entry and entry[:2] == (st.st_size, st.st_mtime_ns) and all(h in entry[2] for h in hashnames):
+        return dict((h, entry[2][h]) for h in hashnames)
+    if not compute:
+        return {}
+
+    logger.info("Calculating %s of %s", ", ".join(hashnames), path)
+    hashed = HashingWriter(open(os.devnull, "wb"), hashnames)
+    with open(path, "rb") as f:
+        shutil.copyfileobj(f, hashed, 1024**2)
+    record_checksums(path, hashed.hexdigests())
+    return hashed.hexdigests()
+
+def write_checksums_file(path, checksums):
+    """Write the digests of several files in the BSD style used by 'sha256sum --tag'
+
+    :param str path: Path of the CHECKSUMS file to write
+    :param dict checksums: {filename: {hashname: hexdigest}}
+    """
+    with open(path, "w") as f:
+        for filename in sorted(checksums):
+            for hashname in sorted(checksums[filename]):
+                f.write("%s (%s) = %s\n" % (hashname.upper(), filename, checksums[filename][hashname]))
+
+def read_checksums_file(path):
+    """Read a CHECKSUMS file written by write_checksums_file
+
+    :param str path: Path of the CHECKSUMS file
+    :returns: {filename: {hashname: hexdigest}}, empty if the file does not exist
+    :rtype: dict
+    """
+    checksums = {}
+    if not os.path.exists(path):
+        return checksums
+    with open(path, "r") as f:
+        for line in f:
+            m = re.match(r"^(\w+) \((.*)\) = ([0-9a-f]+)$", line.strip())
+            if m:
+                checksums.setdefault(m.group(2), {})[m.group(1).lower()] = m.group(3)
+    return checksums
+
+######## Image provenance ################################################
+
+# Filesystem images whose free blocks are known to be holes, because they were
+# just created on a sparse file or have been trimmed. Keyed by (st_dev, st_ino)
+# so that hardlinks to the image are recognized, with the size and mtime saved
+# so that an image that has been changed since then is not trusted.
+_trimmed_images = {}
+
+def mark_image_trimmed(path):
+    """Remember that the free blocks of a filesystem image do not hold any data
+
+    :param str path: Path to the filesystem image
+    """
+    st = os.stat(path)
+    _trimmed_images[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns)
+
+def image_is_trimmed(path):
+    """Check whether the free blocks of a filesystem image are known to be empty
+
+    :param str path: Path to the filesystem image, or a hardlink to it
+    :returns: True if the image was marked and has not been modified since
+    :rtype: bool
+    """
+    st = os.stat(path)
+    return _trimmed_images.get((st.st_dev, st.st_ino)) == (st.st_size, st.st_mtime_ns)
+
+def zero_free_blocks(fsimage):
+    """Make sure the free blocks of an ext4 image are zeroed so it will compress
+
+    :param str fsimage: Path to the ext4 filesystem image
+    :returns: True if the free blocks are zeroed, False if fsck.ext4 failed
+    :rtype: bool
+
+    fsck.ext4 is used to check the image and discard the free blocks, which punches
+    holes in the image file. This reads the whole image, so it is skipped for
+    images that were just created by mkfsimage or were trimmed after installation.
+    """
+    if image_is_trimmed(fsimage):
+        logger.info("Skipping fsck.ext4 of %s, its free blocks are already discarded", fsimage)
+        return True
+
+    start = time.time()
+    rc = execWithRedirect("/usr/sbin/fsck.ext4", ["-y", "-f", "-E", "discard", fsimage])
+    logger.info("fsck.ext4 discard of %s took %0.1fs", fsimage, time.time() - start)
+    if rc != 0:
+        return False
+    mark_image_trimmed(fsimage)
+    return True
+
 ######## Functions for making container images (cpio, tar, squashfs) ##########
 
-def compress(command, root, outfile, compression="xz", compressargs=None):
-    '''Make a compressed archive of the given rootdir or file.
-    command is a list of the archiver commands to run
-    compression should be "xz", "gzip", "lzma", "bzip2", or None.
-    compressargs will be used on the compression commandline.'''
-    if compression not in (None, "xz", "gzip", "lzma", "bzip2"):
+# Supported compression types, None means no compression
+COMPRESSION_TYPES = (None, "xz", "gzip", "lzma", "bzip2", "zstd")
+
+def compressor_cmd(compression, compressargs=None, threads=None):
+    """Return the commandline for a compression program
+
+    :param str compression: "xz", "gzip", "lzma", "bzip2", "zstd", or None
+    :param list compressargs: Arguments to pass to the compressor, defaults to -9 (-10 for zstd)
+    :param int threads: Number of threads for the compressor to use, defaults to cpu_budget()
+    :returns: argv of the compressor, reading stdin and writing stdout
+    :rtype: list of str
+
+    If the compression type is None "cat" is used. Multi-threaded compressors
+    (pigz, pbzip2) are used when possible. zstd uses long distance matching.
+    """
+    if compression not in COMPRESSION_TYPES:
         raise ValueError("Unknown compression type %s" % compression)
-    compressargs = compressargs or ["-9"]
+    if compression == "zstd":
+        compressargs = list(compressargs or ["-10"])
+    else:
+        compressargs = list(compressargs or ["-9"])
+    threads = threads or cpu_budget()
     if compression == "xz":
         compressargs.insert(0, "--check=crc32")
     if compression is None:
@@ -52,62 +249,317 @@ def compress(command, root, outfile, compression="xz", compressargs=None):
 
     # make compression run with multiple threads if possible
     if compression in ("xz", "lzma"):
-        compressargs.insert(0, "-T%d" % multiprocessing.cpu_count())
+        compressargs.insert(0, "-T%d" % threads)
     elif compression == "gzip":
         compression = "pigz"
-        compressargs.insert(0, "-p%d" % multiprocessing.cpu_count())
+        compressargs.insert(0, "-p%d" % threads)
     elif compression == "bzip2":
         compression = "pbzip2"
-        compressargs.insert(0, "-p%d" % multiprocessing.cpu_count())
+        compressargs.insert(0, "-p%d" % threads)
+    elif compression == "zstd":
+        compressargs = ["-T%d" % threads, "--long"] + compressargs
+
+    return [compression] + compressargs
+
+def log_compression(outfile, insize, start):
+    """Log the compression ratio and throughput of a finished image
+
+    :param str outfile: Path to the compressed file
+    :param int insize: Number of uncompressed bytes
+    :param float start: time.time() when the compression started
+    """
+    outsize = os.path.getsize(outfile)
+    elapsed = max(time.time() - start, 0.001)
+    logger.info("Compressed %s: %d bytes to %d bytes, ratio %0.2f, %0.1f MiB/s in %0.1fs",
+                outfile, insize, outsize, insize / max(outsize, 1), insize / 1024**2 / elapsed, elapsed)
+
+def run_compressor(comp_cmd, outfile, feed):
+    """Run a compressor, checksumming its output as it is written
+
+    :param list comp_cmd: argv of the compressor, see compressor_cmd
+    :param str outfile: Path of the file to write
+    :param feed: Function that writes the uncompressed data to the file object
+                 passed to it and returns the number of bytes written
+    :returns: The return code of the compressor
+    :rtype: int
+    :raises: OSError if the compressor cannot be run or exits early, or the output
+             cannot be written
+
+    The sha256 of the output is recorded, see image_checksums. It is only recorded
+    when the compressor and the writing of its output both succeed.
+    """
+    start = time.time()
+    with open(outfile, "wb") as out_fp:
+        hashed = HashingWriter(out_fp)
+        comp = Popen(comp_cmd, stdin=PIPE, stdout=PIPE)
+        writer_errors = []
+
+        def write_output():
+            try:
+                shutil.copyfileobj(comp.stdout, hashed, 1024**2)
+            except Exception as e:      # pylint: disable=broad-except
+                # Nothing reads the compressor's output now, stop it so that feed()
+                # fails instead of blocking forever on a full pipe
+                writer_errors.append(e)
+                comp.kill()
+                try:
+                    comp.stdin.close()
+                except (OSError, ValueError):
+                    pass
+
+        writer = threading.Thread(target=write_output)
+        writer.start()
+        feed_error = None
+        try:
+            insize = feed(comp.stdin)
+        except Exception as e:
+            comp.kill()
+            feed_error = e
+        finally:
+            try:
+                comp.stdin.close()
+            except (OSError, ValueError):
+                pass
+            comp.wait()
+            writer.join()
+            comp.stdout.close()
+
+    # A failed write is the reason feed() failed, report it instead
+    if writer_errors:
+        raise writer_errors[0]
+    if feed_error is not None:
+        raise feed_error
+
+    if comp.returncode == 0:
+        record_checksums(outfile, hashed.hexdigests())
+        log_compression(outfile, insize, start)
+    return comp.returncode
+
+def compress(command, root, outfile, compression="xz", compressargs=None, threads=None):
+    '''Make a compressed archive of the given rootdir or file.
+    command is a list of the archiver commands to run
+    compression should be "xz", "gzip", "lzma", "bzip2", "zstd", or None.
+    compressargs will be used on the compression commandline.
+    threads is the number of threads the compressor should use.'''
+    comp_cmd = compressor_cmd(compression, compressargs, threads)
 
-    find, archive, comp = None, None, None
+    find, archive = None, None
 
     try:
         if os.path.isdir(root):
-            logger.debug("find %s -print0 |%s | %s %s > %s", root, " ".join(command),
-                    compression, " ".join(compressargs), outfile)
+            logger.debug("find %s -print0 |%s | %s > %s", root, " ".join(command),
+                         " ".join(comp_cmd), outfile)
 
             find = Popen(["find", ".", "-print0"], stdout=PIPE, cwd=root)
             archive = Popen(command, stdin=find.stdout, stdout=PIPE, cwd=root)
         else:
-            logger.debug("echo %s |%s | %s %s > %s", root, " ".join(command),
-                         compression, " ".join(compressargs), outfile)
+            logger.debug("echo %s |%s | %s > %s", root, " ".join(command),
+                         " ".join(comp_cmd), outfile)
 
             archive = Popen(command, stdin=PIPE, stdout=PIPE, cwd=os.path.dirname(root))
             archive.stdin.write(os.path.basename(root).encode("utf-8") + b"\0")
             archive.stdin.close()
 
-        comp = Popen([compression] + compressargs,
-                     stdin=archive.stdout, stdout=open(outfile, "wb"))
-        comp.wait()
-        return comp.returncode
+        def feed(comp_stdin):
+            # Pass the archive to the compressor, counting the uncompressed size
+            insize = 0
+            while True:
+                data = archive.stdout.read(1024**2)
+                if not data:
+                    break
+                comp_stdin.write(data)
+                insize += len(data)
+            return insize
+        return run_compressor(comp_cmd, outfile, feed)
     except OSError as e:
         logger.error(e)
         # Kill off any hanging processes
-        list(p.kill() for p in (find, archive, comp) if p)
+        list(p.kill() for p in (find, archive) if p)
+        return 1
+
+class CpioWriter(object):
+    """Write a newc format cpio archive, optionally compressed
+
+    :param fobj: Binary file object to write the archive to
+    :param str compression: None, "xz", "gzip", or "bzip2"
+    :param int level: Compression level
+
+    The archive is written as entries are added, nothing is spawned and the
+    data is never held in memory. The compression is done in-process; xz uses
+    a crc32 check so that the kernel can unpack it. Closing the writer does
+    not close fobj, so it can be used to append to an existing initrd::
+
+        with open(initrd, "ab") as f:
+            with CpioWriter(f, compression="xz") as cpio:
+                cpio.add("/path/to/ks.cfg", "ks.cfg")
+
+    Hardlinks are stored as separate copies of the file.
+    """
+    TRAILER = "TRAILER!!!"
+
+    def __init__(self, fobj, compression=None, level=9):
+        if compression == "xz":
+            self._fobj = lzma.LZMAFile(fobj, "wb", check=lzma.CHECK_CRC32, preset=level)
+        elif compression == "gzip":
+            self._fobj = gzip.GzipFile(fileobj=fobj, mode="wb", compresslevel=level, mtime=0)
+        elif compression == "bzip2":
+            self._fobj = bz2.BZ2File(fobj, "wb", compresslevel=level)
+        elif compression is None:
+            self._fobj = fobj
+        else:
+            raise ValueError("Unknown compression type %s" % compression)
+        self._compressed = compression is not None
+        self._offset = 0
+        self._ino = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tracebk):
+        self.close()
+
+    @property
+    def size(self):
+        """Number of bytes of (uncompressed) archive written so far"""
+        return self._offset
+
+    def _write(self, data):
+        self._fobj.write(data)
+        self._offset += len(data)
+
+    def _pad(self):
+        if self._offset % 4:
+            self._write(b"\0" * (4 - self._offset % 4))
+
+    def _header(self, name, mode, size, uid=0, gid=0, mtime=0, rdev=0):
+        if size > 0xFFFFFFFF:
+            raise ValueError("%s is too large for a cpio archive" % name)
+        name = name.encode("utf-8") + b"\0"
+        self._ino += 1
+        fields = (self._ino, mode, uid, gid, 1, int(mtime), size, 0, 0,
+                  os.major(rdev), os.minor(rdev), len(name), 0)
+        self._write(b"070701" + "".join("%08X" % f for f in fields).encode("ascii") + name)
+        self._pad()
+
+    def add_data(self, arcname, data, mode=0o644, mtime=None):
+        """Add a regular file to the archive from a bytes object
+
+        :param str arcname: Path of the file in the archive
+        :param bytes data: Contents of the file
+        :param int mode: Permissions of the file
+        :param int mtime: Modification time, defaults to now
+        """
+        if mtime is None:
+            mtime = time.time()
+        self._header(arcname, stat.S_IFREG | mode, len(data), mtime=mtime)
+        self._write(data)
+        self._pad()
+
+    def add(self, path, arcname=None):
+        """Add a file, directory, symlink or device to the archive
+
+        :param str path: Path to the file to add
+        :param str arcname: Path of the file in the archive, defaults to path
+
+        Directories are not recursed into, use add_tree for that.
+        """
+        arcname = arcname or path
+        st = os.lstat(path)
+        if stat.S_ISREG(st.st_mode):
+            self._header(arcname, st.st_mode, st.st_size, st.st_uid, st.st_gid, st.st_mtime)
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self._fobj, 1024**2)
+            self._offset += st.st_size
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(path).encode("utf-8")
+            self._header(arcname, st.st_mode, len(target), st.st_uid, st.st_gid, st.st_mtime)
+            self._write(target)
+        else:
+            self._header(arcname, st.st_mode, 0, st.st_uid, st.st_gid, st.st_mtime, st.st_rdev)
+        self._pad()
+
+    def add_tree(self, root):
+        """Add the contents of a directory to the archive
+
+        :param str root: Directory to add
+
+        Paths are stored relative to root, which is stored as ".", in the same
+        order as "find ." would list them.
+        """
+        self.add(root, ".")
+        for top, dirs, files in os.walk(root):
+            reltop = os.path.relpath(top, root)
+            for f in sorted(dirs + files):
+                path = join(top, f)
+                self.add(path, f if reltop == "." else join(reltop, f))
+            dirs.sort()
+
+    def close(self):
+        """Write the trailer and finish the compressed stream"""
+        if self._closed:
+            return
+        self._header(self.TRAILER, 0, 0)
+        # Pad the archive to a 512 byte block, like cpio does
+        if self._offset % 512:
+            self._write(b"\0" * (512 - self._offset % 512))
+        if self._compressed:
+            self._fobj.close()
+        else:
+            self._fobj.flush()
+        self._closed = True
+
+def mkcpio(root, outfile, compression="xz", compressargs=None, threads=None):
+    '''Make a newc cpio archive of the given rootdir or file.
+    The archive is written in-process with CpioWriter and piped into the
+    compression program, see compressor_cmd for the supported types.'''
+    comp_cmd = compressor_cmd(compression, compressargs, threads)
+    logger.debug("cpio %s | %s > %s", root, " ".join(comp_cmd), outfile)
+
+    try:
+        if compression is None:
+            with open(outfile, "wb") as out_fp:
+                hashed = HashingWriter(out_fp)
+                _write_cpio(hashed, root)
+            record_checksums(outfile, hashed.hexdigests())
+            return 0
+        return run_compressor(comp_cmd, outfile, lambda comp_stdin: _write_cpio(comp_stdin, root))
+    except OSError as e:
+        logger.error(e)
         return 1
 
-def mkcpio(root, outfile, compression="xz", compressargs=None):
-    compressargs = compressargs or ["-9"]
-    return compress(["cpio", "--null", "--quiet", "-H", "newc", "-o"],
-                    root, outfile, compression, compressargs)
+def _write_cpio(fobj, root):
+    """Write an uncompressed cpio of a directory tree or a single file to fobj
+
+    :returns: The size of the archive
+    :rtype: int
+    """
+    with CpioWriter(fobj) as cpio:
+        if os.path.isdir(root):
+            cpio.add_tree(root)
+        else:
+            cpio.add(root, os.path.basename(root))
+    return cpio.size
 
-def mktar(root, outfile, compression="xz", compressargs=None, selinux=True):
-    compressargs = compressargs or ["-9"]
+def mktar(root, outfile, compression="xz", compressargs=None, selinux=True, threads=None):
+    compressargs = compressargs or []
     tar_cmd = ["tar", "--no-recursion"]
     if selinux:
         tar_cmd += ["--selinux", "--acls", "--xattrs"]
     tar_cmd += ["-cf-", "--null", "-T-"]
-    return compress(tar_cmd, root, outfile, compression, compressargs)
+    return compress(tar_cmd, root, outfile, compression, compressargs, threads)
 
-def mksquashfs(rootdir, outfile, compression="default", compressargs=None):
-    '''Make a squashfs image containing the given rootdir.'''
+def mksquashfs(rootdir, outfile, compression="default", compressargs=None, processors=None):
+    '''Make a squashfs image containing the given rootdir.
+    processors is the number of cpus mksquashfs may use, defaults to cpu_budget()'''
     compressargs = compressargs or []
     if compression != "default":
         compressargs = ["-comp", compression] + compressargs
+    if "-processors" not in compressargs:
+        compressargs = compressargs + ["-processors", str(processors or cpu_budget())]
     return execWithRedirect("mksquashfs", [rootdir, outfile] + compressargs)
 
-def mkrootfsimg(rootdir, outfile, label, size=2, sysroot=""):
+def mkrootfsimg(rootdir, outfile, label, size=2, sysroot="", populate=True):
     """
     Make rootfs image from a directory
 
@@ -116,13 +568,14 @@ def mkrootfsimg(rootdir, outfile, label, size=2, sysroot=""):
     :param str label: Filesystem label
     :param int size: Size of the image in GiB, if None computed automatically
     :param str sysroot: path to system (deployment) root relative to physical root
+    :param bool populate: Use mkfs.ext4 -d instead of a loop mount when it is supported
     """
     if size:
         fssize = size * (1024*1024*1024) # 2GB sparse file compresses down to nothin'
     else:
         fssize = None       # Let mkext4img figure out the needed size
 
-    mkext4img(rootdir, outfile, label=label, size=fssize)
+    mkext4img(rootdir, outfile, label=label, size=fssize, populate=populate)
 
 
 ######## Utility functions ###############################################
@@ -310,28 +763,78 @@ def round_to_blocks(size, blocksize):
         size += blocksize - diff
     return size
 
+def _tree_size(path, blocksize, follow_symlinks):
+    """Return the size of everything under path, rounded up to blocksize
+
+    :param str path: Directory to scan
+    :param int blocksize: Block size to round each entry up to
+    :param bool follow_symlinks: Count symlinks as the size of their target
+    :returns: Total size in bytes
+    :rtype: int
+
+    This uses os.scandir so that each entry is only stat'ed once.
+    """
+    total = 0
+    dirs = [path]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                total += round_to_blocks(entry.stat(follow_symlinks=follow_symlinks).st_size, blocksize)
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+    return total
+
 # TODO: move filesystem data outside this function
-def estimate_size(rootdir, graft=None, fstype=None, blocksize=4096, overhead=256):
+def estimate_size(rootdir, graft=None, fstype=None, blocksize=4096, overhead=256, threads=None):
+    """Estimate the size of a filesystem image needed to hold rootdir and the grafts
+
+    :param str rootdir: Directory to estimate or None
+    :param dict graft: {"some/path/in/image": "local/file/or/dir"}
+    :param str fstype: Filesystem type, changes the overhead and blocksize
+    :param int blocksize: Filesystem block size
+    :param int overhead: Number of blocks of filesystem overhead to add
+    :param int threads: Number of threads to use to scan the top level directories
+    :returns: Estimated size in bytes
+    :rtype: int
+    """
     graft = graft or {}
-    getsize = lambda f: os.lstat(f).st_size
     if fstype == "btrfs":
         overhead = 64*1024 # don't worry, it's all sparse
     if fstype == "hfsplus":
         overhead = 200 # hack to deal with two bootloader copies
+    follow_symlinks = False
     if fstype in ("vfat", "msdos"):
         blocksize = 2048
-        getsize = lambda f: os.stat(f).st_size # no symlinks, count as copies
+        follow_symlinks = True # no symlinks, count as copies
+
+    start = time.time()
     total = overhead*blocksize
     dirlist = list(graft.values())
     if rootdir:
         dirlist.append(rootdir)
+
+    # Split the trees into their top level entries so they can be scanned in parallel
+    toplevel = []
     for root in dirlist:
-        for top, dirs, files in os.walk(root):
-            for f in files + dirs:
-                total += round_to_blocks(getsize(join(top,f)), blocksize)
+        if not os.path.isdir(root):
+            total += round_to_blocks(os.stat(root).st_size, blocksize)
+            continue
+        with os.scandir(root) as it:
+            for entry in it:
+                total += round_to_blocks(entry.stat(follow_symlinks=follow_symlinks).st_size, blocksize)
+                if entry.is_dir(follow_symlinks=False):
+                    toplevel.append(entry.path)
+
+    if threads and threads > 1 and len(toplevel) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            total += sum(executor.map(lambda d: _tree_size(d, blocksize, follow_symlinks), toplevel))
+    else:
+        total += sum(_tree_size(d, blocksize, follow_symlinks) for d in toplevel)
+
     if fstype == "btrfs":
         total = max(256*1024*1024, total) # btrfs minimum size: 256MB
-    logger.info("Size of %s block %s fs at %s estimated to be %s", blocksize, fstype, rootdir, total)
+    logger.info("Size of %s block %s fs at %s estimated to be %s (%0.2fs)", blocksize, fstype, rootdir,
+                total, time.time() - start)
     return total
 
 ######## Execution contexts - use with the 'with' statement ##############
@@ -367,6 +870,52 @@ class Mount(object):
     def __exit__(self, exc_type, exc_value, tracebk):
         umount(self.mnt)
 
+class OverlayMount(object):
+    """Mount a writable overlay on top of a directory
+
+    :param str lowerdir: Directory to overlay, it is not modified
+    :param str tmpdir: Directory to create the overlay's upper and work directories in
+    :param str mnt: Mountpoint, a temporary directory is created if it is None
+
+    Changes made under the mountpoint are discarded when it is unmounted.
+
+    If the overlay cannot be mounted, eg. overlay on overlay in a container, a copy
+    of lowerdir is made in tmpdir and used instead, and mnt is not used.
+    """
+    def __init__(self, lowerdir, tmpdir=None, mnt=None):
+        (self.lowerdir, self.tmpdir, self.mnt) = (lowerdir, tmpdir, mnt)
+        self.overlay_dir = None
+        self.copy_dir = None
+    def __enter__(self):
+        self.overlay_dir = tempfile.mkdtemp(prefix="lorax.overlay.", dir=self.tmpdir)
+        upperdir = join(self.overlay_dir, "upper")
+        workdir = join(self.overlay_dir, "work")
+        os.mkdir(upperdir)
+        os.mkdir(workdir)
+        mnt = self.mnt or tempfile.mkdtemp(prefix="lorax.imgutils.")
+        try:
+            runcmd(["mount", "-t", "overlay", "-o",
+                    "lowerdir=%s,upperdir=%s,workdir=%s" % (self.lowerdir, upperdir, workdir),
+                    "overlay", mnt])
+        except CalledProcessError as e:
+            logger.warning("Cannot mount an overlay on %s, copying it instead: %s", self.lowerdir, e)
+            if not self.mnt:
+                os.rmdir(mnt)
+            self.copy_dir = join(self.overlay_dir, "copy")
+            os.mkdir(self.copy_dir)
+            try:
+                copytree(self.lowerdir, self.copy_dir)
+            except Exception:
+                shutil.rmtree(self.overlay_dir)
+                raise
+            return self.copy_dir
+        self.mnt = mnt
+        return self.mnt
+    def __exit__(self, exc_type, exc_value, tracebk):
+        if not self.copy_dir:
+            umount(self.mnt)
+        shutil.rmtree(self.overlay_dir)
+
 def kpartx_disk_img(disk_img):
     """Attach a disk image's partitions to /dev/loopX using kpartx
 
@@ -464,17 +1013,75 @@ class PartitionMount(object):
 
 ######## Functions for making filesystem images ##########################
 
-def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="", graft=None):
+# Cache of mkfs.<fstype> -> True if it can populate the new filesystem from a directory
+_mkfs_populate = {}
+
+def mkfs_can_populate(fstype):
+    """
+    Check to see if mkfs.<fstype> can copy a directory into the new filesystem
+
+    :param str fstype: Filesystem type
+    :returns: True if "mkfs.<fstype> -d <rootdir>" is supported
+    :rtype: bool
+
+    Only the ext* filesystems (e2fsprogs >= 1.43) support this. The result of
+    checking the usage message is cached for the life of the process.
+    """
+    if fstype not in ("ext2", "ext3", "ext4"):
+        return False
+    if fstype not in _mkfs_populate:
+        try:
+            usage = execWithCapture("mkfs.%s" % fstype, [], log_output=False)
+        except OSError:
+            usage = ""
+        _mkfs_populate[fstype] = "[-d " in (usage or "")
+    return _mkfs_populate[fstype]
+
+def mkfsimage_populate(fstype, rootdir, outfile, size, mkfsargs=None):
+    """
+    Create a filesystem image populated from a directory without mounting it
+
+    :param str fstype: Filesystem type, mkfs.<fstype> must support -d
+    :param str rootdir: Directory to copy into the new filesystem
+    :param str outfile: Path of output image file
+    :param int size: Size of the image in bytes
+    :param list mkfsargs: Extra arguments to pass to mkfs
+    :returns: True if the image was created, False if mkfs failed
+    :rtype: bool
+
+    This does not need a loop device or any mount privileges, mkfs writes the
+    files directly into the image.
+    """
+    mkfsargs = mkfsargs or []
+    mksparse(outfile, size)
+    try:
+        runcmd(["mkfs.%s" % fstype] + mkfsargs + ["-d", rootdir, outfile])
+    except CalledProcessError as e:
+        logger.warning("mkfs.%s -d exited with a non-zero return code: %d", fstype, e.returncode)
+        logger.warning(e.output)
+        return False
+    return True
+
+def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="", graft=None, populate=True):
     '''Generic filesystem image creation function.
     fstype should be a filesystem type - "mkfs.${fstype}" must exist.
     graft should be a dict: {"some/path/in/image": "local/file/or/dir"};
     if the path ends with a '/' it's assumed to be a directory.
+    If populate is True and mkfs supports it the image is created directly
+    from rootdir with "mkfs -d", without using a loop device or mount.
     Will raise CalledProcessError if something goes wrong.'''
     mkfsargs = mkfsargs or []
     graft = graft or {}
     preserve = (fstype not in ("msdos", "vfat"))
     if not size:
-        size = estimate_size(rootdir, graft, fstype)
+        size = estimate_size(rootdir, graft, fstype, threads=cpu_budget())
+    if populate and rootdir and not graft and mkfs_can_populate(fstype):
+        logger.debug("Populating %s image %s from %s", fstype, outfile, rootdir)
+        if mkfsimage_populate(fstype, rootdir, outfile, size, mkfsargs):
+            mark_image_trimmed(outfile)
+            return
+        logger.warning("Falling back to populating %s using a loop device", outfile)
+
     with LoopDev(outfile, size) as loopdev:
         try:
             runcmd(["mkfs.%s" % fstype] + mkfsargs + [loopdev])
@@ -494,6 +1101,9 @@ def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="",
     # Make absolutely sure that the data has been written
     runcmd(["sync"])
 
+    # Nothing has been deleted from the new sparse image, so its free blocks are still holes
+    mark_image_trimmed(outfile)
+
 # convenience functions with useful defaults
 def mkdosimg(rootdir, outfile, size=None, label="", mountargs="shortname=winnt,umask=0077", graft=None):
     graft = graft or {}
@@ -504,10 +1114,11 @@ def mkdosimg(rootdir, outfile, size=None, label="", mountargs="shortname=winnt,u
     mkfsimage("msdos", rootdir, outfile, size, mountargs=mountargs,
               mkfsargs=mkfsargs, graft=graft)
 
-def mkext4img(rootdir, outfile, size=None, label="", mountargs="", graft=None):
+def mkext4img(rootdir, outfile, size=None, label="", mountargs="", graft=None, populate=True):
     graft = graft or {}
     mkfsimage("ext4", rootdir, outfile, size, mountargs=mountargs,
-              mkfsargs=["-L", label, "-b", "4096", "-m", "0"], graft=graft)
+              mkfsargs=["-L", label, "-b", "4096", "-m", "0"], graft=graft,
+              populate=populate)
 
 def mkbtrfsimg(rootdir, outfile, size=None, label="", mountargs="", graft=None):
     graft = graft or {}
@@ -550,5 +1161,5 @@ def default_image_name(compression, basename):
 
     If the compression is unknown it defaults to xz
     """
-    SUFFIXES = {"xz": ".xz", "gzip": ".gz", "bzip2": ".bz2", "lzma": ".lzma"}
+    SUFFIXES = {"xz": ".xz", "gzip": ".gz", "bzip2": ".bz2", "lzma": ".lzma", "zstd": ".zst"}
     return basename + SUFFIXES.get(compression, ".xz")
@@ -30,10 +30,12 @@ import tempfile
 from pylorax.executils import execWithRedirect, execReadlines
 from pylorax.imgutils import PartitionMount, mksparse, mkext4img, loop_detach
 from pylorax.imgutils import get_loop_name, dm_detach, mount, umount
-from pylorax.imgutils import mkqemu_img, mktar, mkcpio, mkfsimage_from_disk
+from pylorax.imgutils import mkqemu_img, mktar, mkfsimage_from_disk, CpioWriter
+from pylorax.imgutils import mark_image_trimmed, publish_image
 from pylorax.monitor import LogMonitor
 from pylorax.mount import IsoMountpoint
-from pylorax.sysutils import joinpaths
+from pylorax.progress import ProgressLog, StageTimer
+from pylorax.sysutils import joinpaths, clonefile, cpu_budget
 from pylorax.treebuilder import udev_escape
 
 
@@ -105,29 +107,20 @@ def append_initrd(initrd, files):
     :returns: Path to a new initrd
     :rtype: str
 
-    The files are added to the initrd by creating a cpio image
-    of the files (stored at /) and writing the cpio to the end of a
-    copy of the initrd.
+    The files are added to the initrd by writing an xz compressed cpio
+    archive of the files (stored at /) to the end of a copy of the initrd.
 
     The initrd is not changed, a copy is made before appending the
-    cpio archive.
+    cpio archive. The copy shares its data with the original when the
+    filesystem supports reflinks.
     """
     qemu_initrd = tempfile.mktemp(prefix="lmc-initrd-", suffix=".img")
-    shutil.copy2(initrd, qemu_initrd)
-    ks_dir = tempfile.mkdtemp(prefix="lmc-ksdir-")
-    for ks in files:
-        shutil.copy2(ks, ks_dir)
-    ks_initrd = tempfile.mktemp(prefix="lmc-ks-", suffix=".img")
-    mkcpio(ks_dir, ks_initrd)
-    shutil.rmtree(ks_dir)
+    method = clonefile(initrd, qemu_initrd)
+    log.debug("Copied %s to %s using %s", initrd, qemu_initrd, method)
     with open(qemu_initrd, "ab") as initrd_fp:
-        with open(ks_initrd, "rb") as ks_fp:
-            while True:
-                data = ks_fp.read(1024**2)
-                if not data:
-                    break
-                initrd_fp.write(data)
-    os.unlink(ks_initrd)
+        with CpioWriter(initrd_fp, compression="xz") as cpio:
+            for f in files:
+                cpio.add(f, os.path.basename(f))
 
     return qemu_initrd
 
@@ -336,9 +329,11 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
     :param str tar_img: For make_tar_disk, the path to final tarball to be created
 
     This method runs anaconda to create the image and then based on the opts
-    passed creates a qemu disk image or tarfile.
+    passed creates a qemu disk image or tarfile. If opts.stage_log is set the
+    time taken by each stage is appended to it.
     """
     dirinstall_path = ROOT_PATH
+    timer = StageTimer(getattr(opts, "stage_log", None))
 
     # Clean up /tmp/ from previous runs to prevent stale info from being used
     for path in ["/tmp/yum.repos.d/", "/tmp/yum.cache/"]:
@@ -381,7 +376,9 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         # Create the sparse image
         mksparse(disk_img, disk_size * 1024**2)
 
-    log_monitor = LogMonitor(timeout=opts.timeout)
+    progress = ProgressLog(opts.progress_log) if getattr(opts, "progress_log", None) else None
+    log_monitor = LogMonitor(timeout=opts.timeout, error_patterns=getattr(opts, "log_error_patterns", None),
+                             progress=progress)
     args += ["--remotelog", "%s:%s" % (log_monitor.host, log_monitor.port)]
     cancel_funcs = [log_monitor.server.log_check]
     if cancel_func is not None:
@@ -389,13 +386,21 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
 
     # Make sure anaconda has the right product and release
     log.info("Running anaconda.")
+    trimmed = False
     try:
         unshare_args = [ "--pid", "--kill-child", "--mount", "--propagation", "unchanged", "anaconda" ] + args
-        for line in execReadlines("unshare", unshare_args, reset_lang=False,
-                                  env_add={"ANACONDA_PRODUCTNAME": opts.project,
-                                           "ANACONDA_PRODUCTVERSION": opts.releasever},
-                                  callback=lambda p: not novirt_cancel_check(cancel_funcs, p)):
-            log.info(line)
+        with timer.stage("anaconda"):
+            for line in execReadlines("unshare", unshare_args, reset_lang=False,
+                                      env_add={"ANACONDA_PRODUCTNAME": opts.project,
+                                               "ANACONDA_PRODUCTVERSION": opts.releasever},
+                                      callback=lambda p: not novirt_cancel_check(cancel_funcs, p)):
+                log.info(line)
+                if progress:
+                    progress.check_lines(line)
+        if progress:
+            # Break the install down into the phases anaconda went through
+            for phase, started, duration in progress.phase_durations():
+                timer.record("anaconda-" + phase, started, duration)
 
         # Make sure the new filesystem is correctly labeled
         setfiles_args = ["-e", "/proc", "-e", "/sys",
@@ -404,26 +409,37 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         if "--dirinstall" in args:
             # setfiles may not be available, warn instead of fail
             try:
-                execWithRedirect("setfiles", setfiles_args, root=dirinstall_path)
+                with timer.stage("setfiles"):
+                    execWithRedirect("setfiles", setfiles_args, root=dirinstall_path)
             except (subprocess.CalledProcessError, OSError) as e:
                 log.warning("Running setfiles on install tree failed: %s", str(e))
+
+            if opts.make_iso or opts.make_fsimage or opts.make_pxe_live:
+                # Discard the blocks of files deleted during the install so that the
+                # fsck.ext4 pass before compressing the image can be skipped
+                with timer.stage("fstrim"):
+                    trimmed = execWithRedirect("fstrim", [dirinstall_path]) == 0
         else:
             with PartitionMount(disk_img) as img_mount:
                 if img_mount and img_mount.mount_dir:
                     try:
-                        execWithRedirect("setfiles", setfiles_args, root=img_mount.mount_dir)
+                        with timer.stage("setfiles"):
+                            execWithRedirect("setfiles", setfiles_args, root=img_mount.mount_dir)
                     except (subprocess.CalledProcessError, OSError) as e:
                         log.warning("Running setfiles on install tree failed: %s", str(e))
 
                     # For image installs, run fstrim to discard unused blocks. This way
                     # unused blocks do not need to be allocated for sparse image types
-                    execWithRedirect("fstrim", [img_mount.mount_dir])
+                    with timer.stage("fstrim"):
+                        execWithRedirect("fstrim", [img_mount.mount_dir])
 
     except (subprocess.CalledProcessError, OSError) as e:
         log.error("Running anaconda failed: %s", e)
         raise InstallError("novirt_install failed")
     finally:
         log_monitor.shutdown()
+        if progress:
+            progress.close()
 
         # Move the anaconda logs over to a log directory
         log_dir = os.path.abspath(os.path.dirname(opts.logfile))
@@ -459,10 +475,16 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         # convert the image to the selected format
         if "-O" not in qemu_args:
             qemu_args.extend(["-O", opts.image_type])
+        # qemu-img allows up to 16 parallel coroutines
+        if "-m" not in qemu_args:
+            qemu_args.extend(["-m", str(min(16, cpu_budget()))])
         qemu_img = tempfile.mktemp(prefix="lmc-disk-", suffix=".img")
-        execWithRedirect("qemu-img", ["convert"] + qemu_args + [disk_img, qemu_img], raise_err=True)
+        with timer.stage("qemu-img"):
+            execWithRedirect("qemu-img", ["convert"] + qemu_args + [disk_img, qemu_img], raise_err=True)
         if not opts.make_vagrant:
-            execWithRedirect("mv", ["-f", qemu_img, disk_img], raise_err=True)
+            # qemu-img needs to seek in its output so it cannot be hashed while it is
+            # written, it is hashed if it has to be copied to another filesystem
+            publish_image(qemu_img, disk_img)
         else:
             # Take the new qcow2 image and package it up for Vagrant
             compress_args = []
@@ -481,7 +503,9 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
                 shutil.copy2(opts.vagrantfile, joinpaths(vagrant_dir, "vagrantfile"))
 
             log.info("Creating Vagrant image")
-            rc = mktar(vagrant_dir, disk_img, opts.compression, compress_args, selinux=False)
+            with timer.stage("compress"):
+                rc = mktar(vagrant_dir, disk_img, opts.compression, compress_args, selinux=False,
+                           threads=getattr(opts, "compress_threads", None))
             if rc:
                 raise InstallError("novirt_install mktar failed: rc=%s" % rc)
             shutil.rmtree(vagrant_dir)
@@ -490,7 +514,9 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         for arg in opts.compress_args:
             compress_args += arg.split(" ", 1)
 
-        rc = mktar(dirinstall_path, disk_img, opts.compression, compress_args)
+        with timer.stage("compress"):
+            rc = mktar(dirinstall_path, disk_img, opts.compression, compress_args,
+                       threads=getattr(opts, "compress_threads", None))
         shutil.rmtree(dirinstall_path)
 
         if rc:
@@ -504,13 +530,18 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
 
         shutil.copy2(opts.oci_config, ROOT_PATH)
         shutil.copy2(opts.oci_runtime, ROOT_PATH)
-        rc = mktar(ROOT_PATH, disk_img, opts.compression, compress_args)
+        with timer.stage("compress"):
+            rc = mktar(ROOT_PATH, disk_img, opts.compression, compress_args,
+                       threads=getattr(opts, "compress_threads", None))
 
         if rc:
             raise InstallError("novirt_install mktar failed: rc=%s" % rc)
     else:
         # For raw disk images, use fallocate to deallocate unused space
-        execWithRedirect("fallocate", ["--dig-holes", disk_img], raise_err=True)
+        with timer.stage("fallocate"):
+            execWithRedirect("fallocate", ["--dig-holes", disk_img], raise_err=True)
+        if trimmed:
+            mark_image_trimmed(disk_img)
 
     # For make_tar_disk, wrap the result in a tar file, and remove the original disk image.
     if opts.make_tar_disk:
@@ -518,7 +549,9 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         for arg in opts.compress_args:
             compress_args += arg.split(" ", 1)
 
-        rc = mktar(disk_img, tar_img, opts.compression, compress_args, selinux=False)
+        with timer.stage("compress"):
+            rc = mktar(disk_img, tar_img, opts.compression, compress_args, selinux=False,
+                       threads=getattr(opts, "compress_threads", None))
 
         if rc:
             raise InstallError("novirt_install mktar failed: rc=%s" % rc)
@@ -546,7 +579,9 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
         iso_mount.umount()
         raise InstallError("ISO is missing stage2, cannot continue")
 
-    log_monitor = LogMonitor(install_log, timeout=opts.timeout)
+    progress = ProgressLog(opts.progress_log) if getattr(opts, "progress_log", None) else None
+    log_monitor = LogMonitor(install_log, timeout=opts.timeout, error_patterns=getattr(opts, "log_error_patterns", None),
+                             progress=progress)
     cancel_funcs = [log_monitor.server.log_check]
     if cancel_func is not None:
         cancel_funcs.append(cancel_func)
@@ -584,6 +619,8 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
         log.error("VirtualInstall failed: %s", e)
         raise
     finally:
+        if progress:
+            progress.close()
         log.info("unmounting the iso")
         iso_mount.umount()
 
@@ -606,7 +643,8 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
 
         with PartitionMount(diskimg_path) as img_mount:
             if img_mount and img_mount.mount_dir:
-                rc = mktar(img_mount.mount_dir, disk_img, opts.compression, compress_args)
+                rc = mktar(img_mount.mount_dir, disk_img, opts.compression, compress_args,
+                           threads=getattr(opts, "compress_threads", None))
             else:
                 rc = 1
         os.unlink(diskimg_path)
@@ -624,7 +662,8 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
             if img_mount and img_mount.temp_dir:
                 shutil.copy2(opts.oci_config, img_mount.temp_dir)
                 shutil.copy2(opts.oci_runtime, img_mount.temp_dir)
-                rc = mktar(img_mount.temp_dir, disk_img, opts.compression, compress_args)
+                rc = mktar(img_mount.temp_dir, disk_img, opts.compression, compress_args,
+                           threads=getattr(opts, "compress_threads", None))
             else:
                 rc = 1
         os.unlink(diskimg_path)
@@ -647,7 +686,8 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
         if opts.vagrantfile:
             shutil.copy2(opts.vagrantfile, joinpaths(vagrant_dir, "vagrantfile"))
 
-        rc = mktar(vagrant_dir, disk_img, opts.compression, compress_args, selinux=False)
+        rc = mktar(vagrant_dir, disk_img, opts.compression, compress_args, selinux=False,
+                   threads=getattr(opts, "compress_threads", None))
         if rc:
             raise InstallError("virt_install failed")
         shutil.rmtree(vagrant_dir)
@@ -658,7 +698,8 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
         for arg in opts.compress_args:
             compress_args += arg.split(" ", 1)
 
-        rc = mktar(disk_img, tar_img, opts.compression, compress_args, selinux=False)
+        rc = mktar(disk_img, tar_img, opts.compression, compress_args, selinux=False,
+                   threads=getattr(opts, "compress_threads", None))
 
         if rc:
             raise InstallError("virt_install mktar failed: rc=%s" % rc)
@@ -24,11 +24,17 @@ import logging
 logger = logging.getLogger("pylorax.ltmpl")
 
 import os, re, glob, shlex, fnmatch
+import copy
+import hashlib
+import json
+import stat
+import threading
+import time
 from os.path import basename, isdir
 from subprocess import CalledProcessError
 import shutil
 
-from pylorax.sysutils import joinpaths, cpfile, mvfile, replace, remove
+from pylorax.sysutils import joinpaths, cpfile, mvfile, replace_files, remove_files
 from pylorax.dnfhelper import LoraxDownloadCallback, LoraxRpmCallback
 from pylorax.base import DataHolder
 from pylorax.executils import runcmd, runcmd_output
@@ -41,6 +47,71 @@ import struct
 import dnf
 import collections
 
+# Mako lookups shared by all of the template runners in the process, keyed by the
+# template directories and the module directory. Mako keeps the compiled templates
+# in them and recompiles a template when its file changes.
+_template_lookups = {}
+# Directory to save the compiled templates in, see set_template_cache_dir()
+_template_cache_dir = None
+# Commands parsed from templates, keyed by (template path, mtime, variables key)
+_parsed_templates = {}
+# Number of lookups of _parsed_templates that were found (hit) or not (miss)
+_parsed_template_stats = {"hit": 0, "miss": 0}
+
+def set_template_cache_dir(cache_dir):
+    """Save the compiled templates so that they are not compiled again by new processes
+
+    :param str cache_dir: Directory for the compiled templates, or None to not save them
+
+    Each user gets a subdirectory because the files written by one cannot be
+    replaced by another.
+    """
+    global _template_cache_dir
+    _template_cache_dir = cache_dir
+
+def clear_template_cache():
+    """Forget the compiled and parsed templates"""
+    _template_lookups.clear()
+    _parsed_templates.clear()
+
+def template_cache_stats():
+    """Return the number of parsed template cache hits and misses
+
+    :returns: {"hit": count, "miss": count}
+    :rtype: dict
+    """
+    return dict(_parsed_template_stats)
+
+def template_lookup(directories):
+    """Return the shared Mako TemplateLookup for a list of template directories
+
+    :param list directories: Directories to look for templates in
+    :returns: The lookup to get the templates from
+    :rtype: mako.lookup.TemplateLookup
+    """
+    module_directory = None
+    if _template_cache_dir:
+        module_directory = joinpaths(_template_cache_dir, str(os.geteuid()))
+        try:
+            os.makedirs(module_directory, exist_ok=True)
+        except OSError as e:
+            logger.warning("Not saving compiled templates in %s: %s", module_directory, e)
+            module_directory = None
+
+    key = (tuple(directories), module_directory)
+    if key not in _template_lookups:
+        _template_lookups[key] = TemplateLookup(directories=directories,
+                                                module_directory=module_directory)
+    return _template_lookups[key]
+
+def _variables_key(variables):
+    """Return a key for the values of the template variables
+
+    Objects without their own repr, like the dnf base object, only match themselves.
+    """
+    text = repr(sorted((k, repr(v)) for k, v in variables.items()))
+    return hashlib.sha1(text.encode("utf-8", "surrogateescape")).hexdigest()
+
 class LoraxTemplate(object):
     def __init__(self, directories=None):
         directories = directories or ["/usr/share/lorax"]
@@ -48,10 +119,31 @@ class LoraxTemplate(object):
         # file includes won't work properly for absolute paths
         self.directories = ["/"] + directories
 
-    def parse(self, template_file, variables):
-        lookup = TemplateLookup(directories=self.directories)
+    def parse(self, template_file, variables, cache=False):
+        """Render a template and split it into commands
+
+        :param str template_file: The template to parse
+        :param dict variables: Variables to pass to the template
+        :param bool cache: Reuse the commands parsed earlier from the same template and variables
+        :returns: The commands, a list of arguments for each one
+        :rtype: list of lists
+
+        cache should only be used for templates that do not look at anything
+        besides their variables, like the filesystem. Changes to files included
+        by the template are not noticed.
+        """
+        lookup = template_lookup(self.directories)
         template = lookup.get_template(template_file)
 
+        key = None
+        if cache and template.filename:
+            key = (template.filename, os.stat(template.filename).st_mtime_ns, _variables_key(variables))
+            if key in _parsed_templates:
+                _parsed_template_stats["hit"] += 1
+                logger.debug("using cached commands for %s", template_file)
+                return copy.deepcopy(_parsed_templates[key])
+            _parsed_template_stats["miss"] += 1
+
         try:
             textbuf = template.render(**variables)
         except:
@@ -76,8 +168,131 @@ class LoraxTemplate(object):
         except Exception as e:
             logger.error('shlex error processing "%s": %s', line, str(e))
             raise
+
+        if key:
+            _parsed_templates[key] = copy.deepcopy(expanded_lines)
         return expanded_lines
 
+# The active TemplateProfiler, see enable_template_profiler()
+_profiler = None
+
+def _path_usage(path):
+    """Return the number of files under a path and their size, without following symlinks"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return (0, 0)
+    if not stat.S_ISDIR(st.st_mode):
+        return (1, st.st_size)
+    files, size = 0, 0
+    for root, dirs, filenames in os.walk(path):
+        for name in dirs + filenames:
+            try:
+                st = os.lstat(joinpaths(root, name))
+            except OSError:
+                continue
+            size += st.st_size
+            if not stat.S_ISDIR(st.st_mode):
+                files += 1
+    return (files, size)
+
+class TemplateProfiler(object):
+    """Record the time taken by each template line and the files it copies or removes
+
+    The commands that copy, move, edit or remove files report them with
+    TemplateRunner._profile_files() before changing them.
+    """
+    def __init__(self):
+        self.lines = []
+        self._local = threading.local()
+
+    def start(self, templatefile, num, line):
+        """Start timing a template line
+
+        num is the command's position in the rendered template, after the
+        mako directives, comments and blank lines have been removed, so it is
+        not the line number in the template file.
+        """
+        entry = {"template": templatefile, "command_index": num, "command": line[0].lstrip("-"),
+                 "args": " ".join(line[1:]), "seconds": 0.0, "files": 0, "bytes": 0}
+        self.lines.append(entry)
+        self._local.entry = entry
+        self._local.start = time.time()
+        self._local.excluded = 0.0
+
+    def finish(self):
+        """Finish timing the current template line"""
+        entry = getattr(self._local, "entry", None)
+        if entry is not None:
+            entry["seconds"] = max(0.0, time.time() - self._local.start - self._local.excluded)
+            self._local.entry = None
+
+    def add_files(self, *paths):
+        """Count the files and bytes under paths against the current template line
+
+        The time spent walking the paths is not counted as the line's time.
+        """
+        entry = getattr(self._local, "entry", None)
+        if entry is None:
+            return
+        walk_start = time.time()
+        for path in paths:
+            files, size = _path_usage(path)
+            entry["files"] += files
+            entry["bytes"] += size
+        self._local.excluded += time.time() - walk_start
+
+    def commands(self):
+        """Return the totals for each type of command
+
+        :returns: {command: {"count": N, "seconds": S, "files": F, "bytes": B}}
+        :rtype: dict
+        """
+        totals = {}
+        for entry in self.lines:
+            total = totals.setdefault(entry["command"], {"count": 0, "seconds": 0.0, "files": 0, "bytes": 0})
+            total["count"] += 1
+            for k in ("seconds", "files", "bytes"):
+                total[k] += entry[k]
+        return totals
+
+    def write(self, logdir, slowest=50):
+        """Write template-profile.json and template-profile.txt to logdir
+
+        :param str logdir: Directory to write the reports to
+        :param int slowest: Number of the slowest lines to list in the text report
+        """
+        commands = self.commands()
+        with open(joinpaths(logdir, "template-profile.json"), "w") as f:
+            json.dump({"commands": commands, "lines": self.lines}, f, indent=2)
+
+        with open(joinpaths(logdir, "template-profile.txt"), "w") as f:
+            f.write("%-20s %8s %10s %10s %14s\n" % ("command", "count", "seconds", "files", "bytes"))
+            for cmd, total in sorted(commands.items(), key=lambda c: -c[1]["seconds"]):
+                f.write("%-20s %8d %10.2f %10d %14d\n" % (cmd, total["count"], total["seconds"],
+                                                          total["files"], total["bytes"]))
+            f.write("\nSlowest template lines:\n")
+            for entry in sorted(self.lines, key=lambda e: -e["seconds"])[:slowest]:
+                f.write("%8.2fs %8d files %14d bytes  %s command %d: %s %s\n" % (entry["seconds"],
+                        entry["files"], entry["bytes"], basename(entry["template"]), entry["command_index"],
+                        entry["command"], entry["args"]))
+        logger.info("Template profile written to %s", logdir)
+
+def enable_template_profiler():
+    """Profile the template commands run from now on
+
+    :returns: The profiler, call its write() method to save the reports
+    :rtype: TemplateProfiler
+    """
+    global _profiler
+    _profiler = TemplateProfiler()
+    return _profiler
+
+def disable_template_profiler():
+    """Stop profiling the template commands"""
+    global _profiler
+    _profiler = None
+
 def split_and_expand(line):
     return [exp for word in shlex.split(line) for exp in brace_expand(word)]
 
@@ -131,6 +346,10 @@ class TemplateRunner(object):
     * Parsing and execution are *separate* passes - so you can't use the result
       of a command in an %if statement (or any other control statements)!
     '''
+    # Set by runners whose templates only depend on their variables, so the
+    # parsed commands can be reused
+    cache_parsed = False
+
     def __init__(self, fatalerrors=True, templatedir=None, defaults=None, builtins=None):
         self.fatalerrors = fatalerrors
         self.templatedir = templatedir or "/usr/share/lorax"
@@ -145,7 +364,7 @@ class TemplateRunner(object):
         logger.debug("executing %s with variables=%s", templatefile, variables)
         self.templatefile = templatefile
         t = LoraxTemplate(directories=[self.templatedir])
-        commands = t.parse(templatefile, variables)
+        commands = t.parse(templatefile, variables, cache=self.cache_parsed)
         self._run(commands)
 
 
@@ -160,6 +379,9 @@ class TemplateRunner(object):
             if cmd.startswith('-'):
                 cmd = cmd[1:]
                 skiperror = True
+            profiler = _profiler
+            if profiler:
+                profiler.start(self.templatefile, num, line)
             try:
                 # grab the method named in cmd and pass it the given arguments
                 f = getattr(self, cmd, None)
@@ -183,6 +405,14 @@ class TemplateRunner(object):
                     logger.debug("  %s", _line)
                 if self.fatalerrors:
                     raise
+            finally:
+                if profiler:
+                    profiler.finish()
+
+    def _profile_files(self, *paths):
+        """Count paths against the current template line when profiling, call before changing them"""
+        if _profiler:
+            _profiler.add_files(*paths)
 
 
 # TODO: operate inside an actual chroot for safety? Not that RPM bothers..
@@ -231,6 +461,20 @@ class LoraxTemplateRunner(TemplateRunner):
 
     def _out(self, path):
         return joinpaths(self.outroot, path)
+
+    def _rglob_all(self, fileglobs):
+        """Expand a list of globs inside the output root
+
+        :param fileglobs: Globs relative to the output root
+        :returns: The matching paths, without duplicates, in the order they were found
+        :rtype: list
+        """
+        files = collections.OrderedDict()
+        for g in fileglobs:
+            for f in rglob(self._out(g)):
+                files[f] = None
+        return list(files)
+
     def _in(self, path):
         return joinpaths(self.inroot, path)
 
@@ -293,6 +537,7 @@ class LoraxTemplateRunner(TemplateRunner):
             install /usr/share/myconfig/grub.conf.in /boot/grub.conf
         '''
         for src in rglob(self._in(srcglob), fatal=True):
+            self._profile_files(src)
             try:
                 cpfile(src, self._out(dest))
             except shutil.Error as e:
@@ -361,13 +606,12 @@ class LoraxTemplateRunner(TemplateRunner):
           Example:
             replace @VERSION@ ${product.version} /boot/grub.conf /boot/isolinux.cfg
         '''
-        match = False
-        for g in fileglobs:
-            for f in rglob(self._out(g)):
-                match = True
-                replace(f, pat, repl)
-        if not match:
+        files = self._rglob_all(fileglobs)
+        if not files:
             raise IOError("no files matched %s" % " ".join(fileglobs))
+        self._profile_files(*files)
+        changed = replace_files(files, pat, repl)
+        logger.debug("replace %s: changed %i/%i files", pat, len(changed), len(files))
 
     def append(self, filename, data):
         '''
@@ -456,6 +700,7 @@ class LoraxTemplateRunner(TemplateRunner):
           If DEST doesn't exist, SRC will be copied to a file with
           that name, if the path leading to it exists.
         '''
+        self._profile_files(self._out(src))
         try:
             cpfile(self._out(src), self._out(dest))
         except shutil.Error as e:
@@ -466,6 +711,7 @@ class LoraxTemplateRunner(TemplateRunner):
         move SRC DEST
           Move SRC to DEST.
         '''
+        self._profile_files(self._out(src))
         mvfile(self._out(src), self._out(dest))
 
     def remove(self, *fileglobs):
@@ -474,10 +720,13 @@ class LoraxTemplateRunner(TemplateRunner):
           Remove all the named files or directories.
           Will *not* raise exceptions if the file(s) are not found.
         '''
-        for g in fileglobs:
-            for f in rglob(self._out(g)):
-                remove(f)
-                logger.debug("removed %s", f)
+        files = self._rglob_all(fileglobs)
+        if not files:
+            return
+        self._profile_files(*files)
+        remove_files(files)
+        for f in files:
+            logger.debug("removed %s", f)
 
     def chmod(self, fileglob, mode):
         '''
@@ -651,6 +900,7 @@ class LoraxTemplateRunner(TemplateRunner):
         except dnf.exceptions.DownloadError as e:
             logger.error("Failed to download the following packages: %s", e)
             raise
+        progress.log_summary(len(pkgs_to_download))
 
         logger.info("Preparing transaction from installation source")
         try:
@@ -758,11 +1008,12 @@ class LoraxTemplateRunner(TemplateRunner):
                 matches.update(m)
             else:
                 logger.debug("removekmod %s: no files matched!", g)
-        remove_files = filelist.difference(matches)
+        remove_kmods = filelist.difference(matches)
 
-        if remove_files:
-            logger.debug("removekmod: removing %d files", len(remove_files))
-            list(remove(f) for f in remove_files)
+        if remove_kmods:
+            logger.debug("removekmod: removing %d files", len(remove_kmods))
+            self._profile_files(*remove_kmods)
+            remove_files(remove_kmods)
         else:
             logger.debug("removekmod %s: no files to remove!", cmd)
 
@@ -815,6 +1066,9 @@ class LiveTemplateRunner(TemplateRunner):
       It is meant to be used with the live-install.tmpl which lists the per-arch
       pacages needed to build the live-iso output.
     """
+    # live-install.tmpl only depends on basearch
+    cache_parsed = True
+
     def __init__(self, dbo, fatalerrors=True, templatedir=None, defaults=None):
         self.dbo = dbo
         self.pkgs = []
@@ -20,12 +20,47 @@
 import logging
 log = logging.getLogger("livemedia-creator")
 
+import codecs
 import re
 import socket
 import socketserver
 import threading
 import time
 
+# Log lines that indicate that the installation failed, as regexes
+ERROR_PATTERNS = [re.escape(t) for t in [
+    "Traceback (",
+    "traceback script(s) have been run",
+    "Out of memory:",
+    "Call Trace:",
+    "insufficient disk space:",
+    "Not enough disk space to download the packages",
+    "error populating transaction after",
+    "crashed on signal",
+    "packaging: Missed: NoSuchPackage",
+    "packaging: Installation failed",
+    "The following error occurred while installing.  This is a fatal error"
+]] + [
+    r"packaging: base repo .* not valid",
+    r"packaging: .* requires .*"
+]
+
+# Lines that contain this are never treated as errors
+IGNORE_MARKER = "IGNORED"
+
+def compile_error_patterns(patterns):
+    """Combine the error patterns into one regex
+
+    :param list patterns: Python regexes, they are matched against a single line
+    :returns: The compiled regex
+    :rtype: re.Pattern
+    :raises: re.error if one of the patterns is not valid
+
+    The regex is compiled with re.MULTILINE so that it can search a block of lines at
+    once, ^ and $ match at the start and end of each line.
+    """
+    return re.compile("|".join("(?:%s)" % p for p in patterns), re.MULTILINE)
+
 class LogRequestHandler(socketserver.BaseRequestHandler):
     """
     Handle monitoring and saving the logfiles from the virtual install
@@ -33,32 +68,18 @@ class LogRequestHandler(socketserver.BaseRequestHandler):
     Incoming data is written to self.server.log_path and each line is checked
     for patterns that would indicate that the installation failed.
     self.server.log_error is set True when this happens.
-    """
 
-    simple_tests = [
-        "Traceback (",
-        "traceback script(s) have been run",
-        "Out of memory:",
-        "Call Trace:",
-        "insufficient disk space:",
-        "Not enough disk space to download the packages",
-        "error populating transaction after",
-        "crashed on signal",
-        "packaging: Missed: NoSuchPackage",
-        "packaging: Installation failed",
-        "The following error occurred while installing.  This is a fatal error"
-    ]
-
-    re_tests = [
-        r"packaging: base repo .* not valid",
-        r"packaging: .* requires .*"
-    ]
+    The data is written to the log as it is received, and it is decoded as
+    UTF-8 incrementally so that characters split between reads are kept intact.
+    All the complete lines that have been received are checked with a single
+    search of self.server.error_re.
+    """
 
     def setup(self):
         """Start writing to self.server.log_path"""
 
         if self.server.log_path:
-            self.fp = open(self.server.log_path, "w") # pylint: disable=attribute-defined-outside-init
+            self.fp = open(self.server.log_path, "wb") # pylint: disable=attribute-defined-outside-init
         else:
             self.fp = None
         self.request.settimeout(10)
@@ -70,32 +91,37 @@ class LogRequestHandler(socketserver.BaseRequestHandler):
         Split incoming data into lines and check for any Tracebacks or other
         errors that indicate that the install failed.
 
-        Loops until self.server.kill is True
+        Loops until self.server.kill is True, or the installer closes the connection
         """
         log.info("Processing logs from %s", self.client_address)
-        line = ""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        partial = ""
         while True:
             if self.server.kill:
                 break
 
             try:
-                data = str(self.request.recv(4096), "utf8")
+                data = self.request.recv(65536)
                 if self.fp:
                     self.fp.write(data)
                     self.fp.flush()
 
-                # check the data for errors and set error flag
-                # need to assemble it into lines so we can test for the error
-                # string.
-                while data:
-                    more = data.split("\n", 1)
-                    line += more[0]
-                    if len(more) > 1:
-                        self.iserror(line)
-                        line = ""
-                        data = more[1]
-                    else:
-                        data = None
+                if not data:
+                    # The installer closed the connection, check the last line
+                    partial += decoder.decode(b"", final=True)
+                    self.check_lines(partial)
+                    if self.server.progress:
+                        self.server.progress.check_lines(partial)
+                    break
+
+                # Only check complete lines, keep the last partial line for the next read
+                text = partial + decoder.decode(data)
+                end = text.rfind("\n") + 1
+                if end:
+                    self.check_lines(text[:end])
+                    if self.server.progress:
+                        self.server.progress.check_lines(text[:end])
+                partial = text[end:]
 
             except socket.timeout:
                 pass
@@ -109,27 +135,40 @@ class LogRequestHandler(socketserver.BaseRequestHandler):
         if self.fp:
             self.fp.close()
 
-    def iserror(self, line):
+    def check_lines(self, text):
         """
-        Check a line to see if it contains an error indicating installation failure
+        Check a block of lines for an error indicating installation failure
 
-        :param str line: log line to check for failure
+        :param str text: log lines to check for failure
 
-        If the line contains IGNORED it will be skipped.
+        Lines that contain IGNORE_MARKER are skipped. The first line with an
+        error is saved in self.server.error_line.
         """
-        if "IGNORED" in line:
-            return
-
-        for t in self.simple_tests:
-            if t in line:
-                self.server.log_error = True
-                self.server.error_line = line
+        pos = 0
+        while True:
+            m = self.server.error_re.search(text, pos)
+            if not m:
                 return
-        for t in self.re_tests:
-            if re.search(t, line):
+            start = text.rfind("\n", 0, m.start()) + 1
+            end = text.find("\n", m.end())
+            if end == -1:
+                end = len(text)
+            line = text[start:end]
+            if IGNORE_MARKER not in line:
                 self.server.log_error = True
                 self.server.error_line = line
                 return
+            pos = end + 1
+
+    def iserror(self, line):
+        """
+        Check a line to see if it contains an error indicating installation failure
+
+        :param str line: log line to check for failure
+
+        If the line contains IGNORED it will be skipped.
+        """
+        self.check_lines(line)
 
 
 class LogServer(socketserver.TCPServer):
@@ -143,11 +182,17 @@ class LogServer(socketserver.TCPServer):
         Setup the log server
 
         :param str log_path: Path to the log file to write
+        :param list error_patterns: Regexes of the log lines that mean the installation failed,
+                                    defaults to ERROR_PATTERNS
+        :param progress: Where to record the progress of the installation, or None
+        :type progress: pylorax.progress.ProgressLog
         """
         self.kill = False
         self.log_error = False
         self.error_line = ""
         self.log_path = log_path
+        self.error_re = compile_error_patterns(kwargs.pop("error_patterns", None) or ERROR_PATTERNS)
+        self.progress = kwargs.pop("progress", None)
         self._timeout = kwargs.pop("timeout", None)
         if self._timeout:
             self._start_time = time.time()
@@ -176,13 +221,18 @@ class LogMonitor(object):
     This needs to be running before the virt-install runs, it expects
     there to be a listener on the port used for the virtio log port.
     """
-    def __init__(self, log_path=None, host="localhost", port=0, timeout=None, log_request_handler_class=LogRequestHandler):
+    def __init__(self, log_path=None, host="localhost", port=0, timeout=None, log_request_handler_class=LogRequestHandler,
+                 error_patterns=None, progress=None):
         """
         Start a thread to monitor the logs.
 
         :param str log_path: Path to the logfile to write
         :param str host: Host to bind to. Default is localhost.
         :param int port: Port to listen to or 0 to pick a port
+        :param list error_patterns: Regexes of the log lines that mean the installation failed.
+                                    Default is ERROR_PATTERNS.
+        :param progress: Where to record the progress of the installation, or None
+        :type progress: pylorax.progress.ProgressLog
 
         If 0 is passed for the port the dynamically assigned port will be
         available as self.port
@@ -190,7 +240,8 @@ class LogMonitor(object):
         If log_path isn't set then it only monitors the logs, instead of
         also writing them to disk.
         """
-        self.server = LogServer(log_path, (host, port), log_request_handler_class, timeout=timeout)
+        self.server = LogServer(log_path, (host, port), log_request_handler_class, timeout=timeout,
+                                error_patterns=error_patterns, progress=progress)
         self.host, self.port = self.server.server_address
         self.log_path = log_path
         self.server_thread = threading.Thread(target=self.server.handle_request)
@@ -0,0 +1,280 @@
+#
+# progress.py
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Record the progress of an installation as JSON lines
+
+The installer's output and remote log are checked for the start of each phase of
+the installation, and for the count of packages that have been installed. Each
+change is written to the progress log as a JSON object on a line of its own:
+
+    {"time": 1570000000.0, "event": "phase", "phase": "download"}
+    {"time": 1570000060.0, "event": "packages", "done": 120, "total": 400}
+
+The time taken by each stage of a build, eg. depsolving or compressing the image,
+is recorded by a StageTimer, it appends each stage to a log in the same format.
+"""
+import logging
+log = logging.getLogger("livemedia-creator")
+
+from contextlib import contextmanager
+import json
+import re
+import threading
+import time
+
+# Phases of the installation, in the order they happen, and the log lines that start them
+PROGRESS_PHASES = [
+    ("setup",        r"Starting installer|anaconda \S+ for .* started"),
+    ("storage",      r"Configuring storage|Creating \S+ on /dev/"),
+    ("download",     r"Downloading packages|Downloading \d+ RPMs"),
+    ("transaction",  r"Preparing transaction from installation source"),
+    ("install",      r"Starting package installation process"),
+    ("post-install", r"Performing post-installation setup tasks"),
+    ("configure",    r"Configuring installed system"),
+    ("bootloader",   r"Installing boot loader"),
+    ("post-scripts", r"Running post-installation scripts"),
+    ("finish",       r"Storing configuration files and kickstarts"),
+]
+
+INSTALL_PHASE = [name for name, _ in PROGRESS_PHASES].index("install")
+
+# The installation of a package, eg. "Installing bash.x86_64 (12/400)"
+PACKAGE_PATTERN = r"Installing (?P<package>\S+) \((?P<done>\d+)/(?P<total>\d+)\)"
+
+# Minimum number of seconds between package events, the last package is always written
+PACKAGE_EVENT_INTERVAL = 1
+
+def _progress_re():
+    """Combine the phase and package patterns into one regex
+
+    Each phase is a named group, p0 for the first phase, p1 for the second, etc.
+    """
+    patterns = ["(?P<p%d>%s)" % (i, p) for i, (_, p) in enumerate(PROGRESS_PHASES)]
+    patterns.append("(?P<packages>%s)" % PACKAGE_PATTERN)
+    return re.compile("|".join(patterns))
+
+class ProgressLog(object):
+    """Write the progress of an installation to a file
+
+    :param str path: Path to the progress log, events are appended to it
+
+    check_lines() may be called from more than one thread, eg. with the installer's
+    output and with the remote log, the same progress is only written once. Phases
+    are only written when they are later than the current phase.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "a")
+        self._lock = threading.Lock()
+        self._re = _progress_re()
+        self._phase = -1
+        self._done = 0
+        self._last_packages = None
+        self._phase_times = []
+
+    def event(self, event, **data):
+        """Write an event to the progress log
+
+        :param str event: Name of the event
+        :param data: Fields of the event
+        """
+        data["time"] = time.time()
+        data["event"] = event
+        self._fp.write(json.dumps(data, sort_keys=True) + "\n")
+        self._fp.flush()
+
+    def check_lines(self, text):
+        """Check log lines for progress
+
+        :param str text: One or more lines from the installer
+        """
+        with self._lock:
+            if self._fp is None:
+                return
+            for m in self._re.finditer(text):
+                if m.lastgroup == "packages":
+                    # Installing packages also means the install phase has started
+                    self._set_phase(INSTALL_PHASE)
+                    self._package(int(m.group("done")), int(m.group("total")))
+                else:
+                    self._set_phase(int(m.lastgroup[1:]))
+
+    def _set_phase(self, phase):
+        """Write a phase event if the phase is later than the current one"""
+        if phase > self._phase:
+            self._phase = phase
+            self._phase_times.append((PROGRESS_PHASES[phase][0], time.time()))
+            self.event("phase", phase=PROGRESS_PHASES[phase][0])
+
+    def phase_durations(self):
+        """Return how long each phase took
+
+        :returns: A list of (phase, started, duration) tuples
+        :rtype: list
+
+        The last phase is counted until now, call it when the installer has exited.
+        """
+        with self._lock:
+            ends = [started for _, started in self._phase_times[1:]] + [time.time()]
+            return [(name, started, end - started) for (name, started), end in zip(self._phase_times, ends)]
+
+    def _package(self, done, total):
+        """Write a package event, at most one every PACKAGE_EVENT_INTERVAL seconds
+
+        The first and the last package are always written.
+        """
+        if done <= self._done:
+            return
+        self._done = done
+        if done < total and self._last_packages is not None and \
+           time.monotonic() - self._last_packages < PACKAGE_EVENT_INTERVAL:
+            return
+        self._last_packages = time.monotonic()
+        self.event("packages", done=done, total=total)
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+def read_progress(path):
+    """Summarize a progress log
+
+    :param str path: Path to the progress log
+    :returns: The progress or None if there is no progress log
+    :rtype: dict or None
+
+    The summary has these fields:
+
+    * phase - The current phase of the installation, or None
+    * phase_started - When the current phase started
+    * packages_done - Number of packages that have been installed
+    * packages_total - Number of packages in the transaction, 0 if it is not known yet
+    * updated - The time of the last event
+    * phases - A list of {"phase": name, "started": time} for each phase
+    """
+    try:
+        f = open(path, "r")
+    except OSError:
+        return None
+
+    progress = {"phase": None, "phase_started": None, "packages_done": 0, "packages_total": 0,
+                "updated": None, "phases": []}
+    with f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # The last line may still be being written
+                continue
+            progress["updated"] = event.get("time")
+            if event.get("event") == "phase":
+                progress["phase"] = event["phase"]
+                progress["phase_started"] = event["time"]
+                progress["phases"].append({"phase": event["phase"], "started": event["time"]})
+            elif event.get("event") == "packages":
+                progress["packages_done"] = event["done"]
+                progress["packages_total"] = event["total"]
+    return progress
+
+class StageTimer(object):
+    """Record how long the stages of a build take
+
+    :param str path: Path to the log to append the stages to, or None
+
+    Stages that finish before the path is set are kept, and written when
+    the path is set with set_path(). Each stage is written as one line, the
+    log is not read or rewritten.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._pending = []
+
+    def set_path(self, path):
+        """Set the path of the log and write the stages that have finished
+
+        :param str path: Path to the log to append the stages to
+        """
+        self.path = path
+        pending, self._pending = self._pending, []
+        self._write(pending)
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage of the build
+
+        :param str name: Name of the stage
+
+        The stage is recorded as failed if the block raises an exception.
+        """
+        started = time.time()
+        start = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record(name, started, time.monotonic() - start, failed)
+
+    def record(self, name, started, duration, failed=False):
+        """Record a stage
+
+        :param str name: Name of the stage
+        :param float started: When the stage started, as a Unix timestamp
+        :param float duration: Number of seconds the stage took
+        :param bool failed: True if the stage failed
+        """
+        log.info("%s %s after %.1fs", name, "failed" if failed else "finished", duration)
+        entry = {"event": "stage", "stage": name, "time": started, "duration": round(duration, 3)}
+        if failed:
+            entry["failed"] = True
+        if self.path is None:
+            self._pending.append(entry)
+        else:
+            self._write([entry])
+
+    def _write(self, entries):
+        if not entries:
+            return
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(e, sort_keys=True) + "\n" for e in entries))
+
+def read_stage_times(path):
+    """Read the stages recorded by StageTimer
+
+    :param str path: Path to the log
+    :returns: A list of {"stage": name, "started": time, "duration": seconds, "failed": bool},
+              sorted by when they started
+    :rtype: list of dicts
+    """
+    stages = []
+    try:
+        f = open(path, "r")
+    except OSError:
+        return stages
+    with f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("event") == "stage":
+                stages.append({"stage": event["stage"], "started": event["time"],
+                               "duration": event["duration"], "failed": event.get("failed", False)})
+    return sorted(stages, key=lambda s: s["started"])
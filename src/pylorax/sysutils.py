@@ -19,22 +19,30 @@
 # Red Hat Author(s):  Martin Gracik <mgracik@redhat.com>
 #
 
-__all__ = ["joinpaths", "touch", "replace", "chown_", "chmod_", "remove",
-           "linktree"]
+__all__ = ["joinpaths", "touch", "replace", "replace_files", "chown_", "chmod_",
+           "remove", "remove_files", "linktree", "clonefile", "publish_file",
+           "publish_tree", "cpu_budget", "set_cpu_budget", "run_stages"]
 
-import sys
 import os
 import re
-import fileinput
+import errno
+import fcntl
+import hashlib
+import logging
+import time
 import pwd
 import grp
 import glob
 import shutil
 import shlex
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from configparser import ConfigParser
 
 from pylorax.executils import runcmd
 
+logger = logging.getLogger("pylorax.sysutils")
+
 def joinpaths(*args, **kwargs):
     path = os.path.sep.join(args)
 
@@ -50,14 +58,32 @@ def touch(fname):
 
 
 def replace(fname, find, sub):
-    fin = fileinput.input(fname, inplace=1)
-    pattern = re.compile(find)
+    replace_files([fname], find, sub)
 
-    for line in fin:
-        line = pattern.sub(sub, line)
-        sys.stdout.write(line)
+def replace_files(fnames, find, sub):
+    """Find-and-replace a regex in a list of files
 
-    fin.close()
+    :param list fnames: Paths of the files to change
+    :param str find: Python regex, applied to each line of the files
+    :param str sub: Replacement string
+    :returns: The files that were changed
+    :rtype: list
+
+    The pattern is compiled once, each file is read once and it is only written
+    back, in place, when a line was changed. Undecodable bytes are preserved.
+    """
+    pattern = re.compile(find)
+    changed = []
+    for fname in fnames:
+        with open(fname, "r", newline="", errors="surrogateescape") as f:
+            lines = f.readlines()
+        new_lines = [pattern.sub(sub, line) for line in lines]
+        if new_lines == lines:
+            continue
+        with open(fname, "w", newline="", errors="surrogateescape") as f:
+            f.writelines(new_lines)
+        changed.append(fname)
+    return changed
 
 
 def chown_(path, user=None, group=None, recursive=False):
@@ -94,6 +120,167 @@ def cpfile(src, dst):
 
     return dst
 
+# ioctl to share the data blocks of one file with another, from linux/fs.h
+FICLONE = 0x40049409
+
+def clonefile(src, dst):
+    """Copy a file, sharing the data with the source if the filesystem allows it
+
+    :param str src: Path of the file to copy
+    :param str dst: Path of the new file
+    :returns: How the data was copied, "reflink", "copy_file_range" or "copy"
+    :rtype: str
+
+    A reflink (FICLONE) is tried first, then os.copy_file_range which lets the
+    kernel copy the data without passing it through userspace, and finally a
+    normal read/write copy. The permissions and timestamps are copied like
+    shutil.copy2
+    """
+    with open(src, "rb") as src_fp:
+        with open(dst, "wb") as dst_fp:
+            try:
+                fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+                method = "reflink"
+            except OSError:
+                method = _copy_file_data(src_fp, dst_fp)
+    shutil.copystat(src, dst)
+    return method
+
+def _copy_file_data(src_fp, dst_fp):
+    """Copy the contents of one open file to another
+
+    :param src_fp: Source file opened for reading
+    :param dst_fp: Destination file opened for writing
+    :returns: "copy_file_range" or "copy"
+    :rtype: str
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src_fp.fileno(), dst_fp.fileno(), 1024**3):
+                pass
+            return "copy_file_range"
+        except OSError:
+            # Start over with a normal copy
+            src_fp.seek(0)
+            dst_fp.seek(0)
+            dst_fp.truncate()
+    shutil.copyfileobj(src_fp, dst_fp, 1024**2)
+    return "copy"
+
+def _copy_and_hash(src_fp, dst_fp, hashname):
+    """Copy the contents of one open file to another, hashing the data as it is written
+
+    :param src_fp: Source file opened for reading
+    :param dst_fp: Destination file opened for writing
+    :param str hashname: Name of the hashlib algorithm to use
+    :returns: The hex digest of the data
+    :rtype: str
+    :raises: OSError if the size of the copy does not match the source
+    """
+    digest = hashlib.new(hashname)
+    size = 0
+    while True:
+        data = src_fp.read(1024**2)
+        if not data:
+            break
+        digest.update(data)
+        dst_fp.write(data)
+        size += len(data)
+    dst_fp.flush()
+    if size != os.fstat(src_fp.fileno()).st_size or size != os.fstat(dst_fp.fileno()).st_size:
+        raise OSError(errno.EIO, "Short copy of %s" % src_fp.name)
+    return digest.hexdigest()
+
+def publish_file(src, dst, hashname=None, expected=None):
+    """Move a file to its final location, without copying the data if possible
+
+    :param str src: Path of the file to move
+    :param str dst: Path of the destination file, it is replaced if it exists
+    :param str hashname: hashlib algorithm to checksum the data with if it has to be copied
+    :param str expected: The hashname hexdigest recorded when src was written, or None
+    :returns: (method, hexdigest) method is "rename", "reflink", "copy_file_range" or "copy"
+              hexdigest is None unless the data was copied and hashname was set
+    :rtype: tuple
+    :raises: OSError if the copy's digest does not match expected
+
+    A rename is tried first, then a reflink if the destination is on another
+    filesystem. If the data has to be copied it is checksummed as it is written
+    when hashname is set, otherwise copy_file_range is used. When expected is
+    passed the checksum of the copied data must match it, or the copy is removed
+    and src is left in place. If src is a symlink the file it points to is copied.
+    The source is removed.
+    """
+    if not os.path.islink(src):
+        try:
+            os.replace(src, dst)
+            return ("rename", None)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    digest = None
+    with open(src, "rb") as src_fp:
+        with open(dst, "wb") as dst_fp:
+            try:
+                fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+                method = "reflink"
+            except OSError:
+                if hashname:
+                    digest = _copy_and_hash(src_fp, dst_fp, hashname)
+                    method = "copy"
+                else:
+                    method = _copy_file_data(src_fp, dst_fp)
+    if expected and digest and digest != expected:
+        os.unlink(dst)
+        raise OSError(errno.EIO, "%s of the copy of %s is %s, expected %s" % (hashname, src, digest, expected))
+    shutil.copystat(src, dst)
+    os.unlink(src)
+    return (method, digest)
+
+def publish_tree(src, dst, hashname="sha256"):
+    """Move the contents of a directory into another directory
+
+    :param str src: Directory to move the contents of
+    :param str dst: Destination directory, created if needed
+    :param str hashname: hashlib algorithm to checksum copied files with
+    :returns: {path relative to dst: hexdigest} for the files that were copied
+    :rtype: dict
+
+    Symlinks are replaced by a copy of what they point to, like "cp -R -L",
+    before anything is moved. Then each file is moved with publish_file. The
+    source directories and symlinks are left behind.
+    """
+    start = time.time()
+    links = []
+    files = []
+    for top, dirs, names in os.walk(src):
+        reltop = os.path.relpath(top, src)
+        os.makedirs(joinpaths(dst, reltop), exist_ok=True)
+        for name in dirs + names:
+            relpath = os.path.normpath(joinpaths(reltop, name))
+            if os.path.islink(joinpaths(src, relpath)):
+                links.append(relpath)
+            elif name in names:
+                files.append(relpath)
+
+    for relpath in links:
+        if os.path.isdir(joinpaths(src, relpath)):
+            shutil.copytree(joinpaths(src, relpath), joinpaths(dst, relpath), copy_function=clonefile)
+        else:
+            clonefile(joinpaths(src, relpath), joinpaths(dst, relpath))
+
+    digests = {}
+    methods = {}
+    for relpath in files:
+        method, digest = publish_file(joinpaths(src, relpath), joinpaths(dst, relpath), hashname)
+        methods[method] = methods.get(method, 0) + 1
+        if digest:
+            digests[relpath] = digest
+            logger.debug("%s %s: %s", relpath, hashname, digest)
+    logger.info("Published %s to %s in %0.1fs (%s)", src, dst, time.time() - start,
+                ", ".join("%s: %d" % m for m in sorted(methods.items())) or "empty")
+    return digests
+
 def mvfile(src, dst):
     if os.path.isdir(dst):
         dst = joinpaths(dst, os.path.basename(src))
@@ -106,9 +293,193 @@ def remove(target):
     else:
         os.unlink(target)
 
+# Batches smaller than this are removed without starting a thread pool
+REMOVE_POOL_MIN = 64
+
+def _unlink_missing_ok(path):
+    """Unlink a file, return 1 if it was removed and 0 if it was already gone"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return 0
+    return 1
+
+def remove_files(targets, workers=None):
+    """Remove a batch of files and directories
+
+    :param list targets: Paths of the files and directories to remove
+    :param int workers: Number of threads to unlink files with, defaults to cpu_budget() * 4
+    :returns: Number of files and directories removed
+    :rtype: int
+
+    Directories are removed with their contents, symlinks are removed, not followed.
+    The targets are deduplicated, including targets inside of other targets and
+    targets reached through symlinked directories, the files are unlinked by a pool
+    of threads and then the directories are removed, deepest first. Paths that are
+    already gone are skipped.
+    """
+    files = set()
+    dirs = set()
+    targets = set(os.path.normpath(t) for t in targets)
+    # Resolve the parent directory, but not the target itself, so that symlinks are removed
+    for target in set(os.path.join(os.path.realpath(os.path.dirname(t)), os.path.basename(t)) for t in targets):
+        if not os.path.lexists(target):
+            continue
+        if os.path.isdir(target) and not os.path.islink(target):
+            for root, dirnames, filenames in os.walk(target):
+                dirs.add(root)
+                for d in dirnames:
+                    path = os.path.join(root, d)
+                    # os.walk lists symlinks to directories with the directories
+                    if os.path.islink(path):
+                        files.add(path)
+                files.update(os.path.join(root, f) for f in filenames)
+        else:
+            files.add(target)
+
+    if len(files) < REMOVE_POOL_MIN:
+        removed = sum(_unlink_missing_ok(f) for f in files)
+    else:
+        with ThreadPoolExecutor(max_workers=workers or cpu_budget() * 4) as executor:
+            # Consume the results so that the first error is raised
+            removed = sum(executor.map(_unlink_missing_ok, files))
+
+    for d in sorted(dirs, key=lambda d: d.count(os.sep), reverse=True):
+        try:
+            os.rmdir(d)
+        except FileNotFoundError:
+            continue
+        removed += 1
+    return removed
+
 def linktree(src, dst):
     runcmd(["/bin/cp", "-alx", src, dst])
 
+# Number of cpus set by set_cpu_budget(), 0 means use the system limits
+_cpu_budget = 0
+
+def set_cpu_budget(cpus):
+    """Override the number of cpus returned by cpu_budget()
+
+    :param int cpus: Number of cpus to use, 0 to use the system limits
+    """
+    global _cpu_budget
+    _cpu_budget = max(0, int(cpus))
+
+def _cgroup_cpu_limit(cgroup_root="/sys/fs/cgroup", proc_cgroup="/proc/self/cgroup"):
+    """Return the number of cpus allowed by the cgroup v2 cpu.max quotas
+
+    :param str cgroup_root: Path to the cgroup2 mount
+    :param str proc_cgroup: Path to the cgroup membership file of the process
+    :returns: Number of cpus, rounded up, or None if there is no quota
+    :rtype: int or None
+
+    The quota of every cgroup between this process and the root is checked,
+    the smallest one is the effective limit.
+    """
+    try:
+        with open(proc_cgroup) as f:
+            for line in f:
+                hierarchy, _controllers, path = line.strip().split(":", 2)
+                if hierarchy == "0":
+                    break
+            else:
+                return None
+    except (OSError, ValueError):
+        return None
+
+    limit = None
+    path = path.strip("/")
+    while True:
+        try:
+            with open(os.path.join(cgroup_root, path, "cpu.max")) as f:
+                quota, period = f.read().split()
+            if quota != "max":
+                cpus = max(1, ceil(int(quota) / int(period)))
+                limit = min(limit or cpus, cpus)
+        except (OSError, ValueError):
+            pass
+        if not path:
+            break
+        path = os.path.dirname(path)
+    return limit
+
+def cpu_budget():
+    """Return the number of cpus that parallel tools should use
+
+    :returns: Number of cpus, at least 1
+    :rtype: int
+
+    This is the override set by set_cpu_budget() if there is one, otherwise
+    the smaller of the cpus this process is allowed to run on (sched affinity)
+    and the cgroup v2 cpu quota.
+    """
+    if _cpu_budget:
+        return _cpu_budget
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit:
+        cpus = min(cpus, limit)
+    return max(1, cpus)
+
+def run_stages(stages):
+    """Run the stages of a build concurrently, as soon as their dependencies have finished
+
+    :param dict stages: {name: (function, [names of stages it depends on])}
+    :returns: {name: return value of the stage's function}
+    :rtype: dict
+    :raises: The exception raised by the first stage that failed
+
+    The stages are run in threads, they are expected to spend their time waiting for
+    external programs. The time each stage took is logged. If a stage fails the stages
+    that are still running are waited for, and no new stages are started.
+    """
+    for name, (_func, deps) in stages.items():
+        missing = [d for d in deps if d not in stages]
+        if missing:
+            raise ValueError("Stage %s depends on unknown stages: %s" % (name, ", ".join(missing)))
+
+    def timed(name, func):
+        start = time.time()
+        try:
+            return func()
+        finally:
+            logger.info("%s stage took %0.1fs", name, time.time() - start)
+
+    results = {}
+    running = {}
+    pending = dict(stages)
+    error = None
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        while pending or running:
+            if error is None:
+                for name, (func, deps) in list(pending.items()):
+                    if all(d in results for d in deps):
+                        logger.debug("Starting %s stage", name)
+                        running[executor.submit(timed, name, func)] = name
+                        del pending[name]
+            if not running:
+                if error is None:
+                    raise ValueError("Stages have circular dependencies: %s" % ", ".join(sorted(pending)))
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("%s stage failed: %s", name, e)
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    logger.info("%s stages took %0.1fs", ", ".join(stages), time.time() - start)
+    return results
+
 def unquote(s):
     return ' '.join(shlex.split(s))
 
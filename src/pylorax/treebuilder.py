@@ -21,6 +21,7 @@ import logging
 logger = logging.getLogger("pylorax.treebuilder")
 
 import os, re
+import json
 from os.path import basename
 from shutil import copytree, copy2
 from pathlib import Path
@@ -29,8 +30,9 @@ import itertools
 from pylorax.sysutils import joinpaths, remove
 from pylorax.base import DataHolder
 from pylorax.ltmpl import LoraxTemplateRunner
+from pylorax.elfutils import ELF_MAGIC, ElfError, LibraryIndex
 import pylorax.imgutils as imgutils
-from pylorax.executils import runcmd, runcmd_output, execWithCapture
+from pylorax.executils import runcmd, runcmd_output
 
 templatemap = {
     'i386':    'x86.tmpl',
@@ -85,6 +87,7 @@ class RuntimeBuilder(object):
         self._installpkgs = installpkgs or []
         self._excludepkgs = excludepkgs or []
         self._runner.defaults = self.vars
+        self._pkgfiles = None
         self.dbo.reset()
 
     def _install_branding(self):
@@ -122,14 +125,27 @@ class RuntimeBuilder(object):
         for tmpl in self.add_templates:
             self._runner.run(tmpl, **self.add_template_vars)
 
+    def _installed_files(self):
+        """Return the files of the installed packages
+
+        :returns: [(name, name.arch, [files])] sorted by package
+        :rtype: list of tuples
+
+        Asking dnf for the file lists is slow, so they are only read once.
+        """
+        if self._pkgfiles is None:
+            q = self.dbo.sack.query()
+            self._pkgfiles = [(p.name, "{0.name}.{0.arch}".format(p), p.files)
+                              for p in sorted(q.installed())]
+        return self._pkgfiles
+
     def writepkglists(self, pkglistdir):
         '''debugging data: write out lists of package contents'''
         if not os.path.isdir(pkglistdir):
             os.makedirs(pkglistdir)
-        q = self.dbo.sack.query()
-        for pkgobj in q.installed():
-            with open(joinpaths(pkglistdir, pkgobj.name), "w") as fobj:
-                for fname in pkgobj.files:
+        for name, _pkg, files in self._installed_files():
+            with open(joinpaths(pkglistdir, name), "w") as fobj:
+                for fname in files:
                     fobj.write("{0}\n".format(fname))
 
     def postinstall(self):
@@ -147,19 +163,26 @@ class RuntimeBuilder(object):
         '''Remove unneeded packages and files with runtime-cleanup.tmpl'''
         self._runner.run("runtime-cleanup.tmpl")
 
-    def verify(self):
-        '''Ensure that contents of the installroot can run'''
-        status = True
+    def verify(self, libdirs=None, processes=1):
+        """Ensure that contents of the installroot can run
 
-        ELF_MAGIC = b'\x7fELF'
+        :param list libdirs: Directories, relative to the root, with shared libraries to verify too
+        :param int processes: Number of processes used to read the ELF files, None uses all cpus
+        :returns: True if nothing is missing
+        :rtype: bool
+
+        The ELF files in /usr/bin, /usr/sbin and libdirs are read directly, and
+        the libraries they need are looked up in the installroot the same way
+        ld.so would find them. Scripts are checked for their interpreter.
+        """
+        status = True
 
         # Iterate over all files in /usr/bin and /usr/sbin
         # For ELF files, gather them into a list and we'll check them all at
         # the end. For files with a #!, check them as we go
         elf_files = []
-        usr_bin = Path(self.vars.root + '/usr/bin')
-        usr_sbin = Path(self.vars.root + '/usr/sbin')
-        for path in (str(x) for x in itertools.chain(usr_bin.iterdir(), usr_sbin.iterdir()) \
+        dirs = ["/usr/bin", "/usr/sbin"] + [d for d in (libdirs or []) if os.path.isdir(self.vars.root + d)]
+        for path in (str(x) for x in itertools.chain.from_iterable(Path(self.vars.root + d).iterdir() for d in dirs) \
                      if x.is_file()):
             with open(path, "rb") as f:
                 magic = f.read(4)
@@ -179,30 +202,60 @@ class RuntimeBuilder(object):
                         logger.error('%s, needed by %s, does not exist', shabang, path)
                         status = False
 
-        # Now, run ldd on all the ELF files
-        # Just run ldd once on everything so it isn't logged a million times.
-        # At least one thing in the list isn't going to be a dynamic executable,
-        # so use execWithCapture to ignore the exit code.
-        filename = ''
-        for line in execWithCapture('ldd', elf_files, root=self.vars.root,
-                log_output=False, filter_stderr=True).split('\n'):
-            if line and not line[0].isspace():
-                # New filename header, strip the : at the end and save
-                filename = line[:-1]
-            elif 'not found' in line:
-                logger.error('%s, needed by %s, not found', line.split()[0], filename)
+        # Now check the libraries needed by all the ELF files
+        libs = LibraryIndex(self.vars.root)
+        if processes != 1:
+            libs.preload([libs.realpath(p) for p in elf_files], processes)
+        for path in sorted(elf_files):
+            try:
+                missing = libs.missing(path)
+            except (ElfError, OSError) as e:
+                logger.error("Cannot read %s: %s", path, e)
+                status = False
+                continue
+            for name, needed_by in missing:
+                if needed_by == libs.realpath(path):
+                    logger.error('%s, needed by %s, not found', name, path)
+                else:
+                    logger.error('%s, needed by %s (loaded by %s), not found', name, needed_by, path)
                 status = False
 
         return status
 
     def writepkgsizes(self, pkgsizefile):
-        '''debugging data: write a big list of pkg sizes'''
-        fobj = open(pkgsizefile, "w")
-        getsize = lambda f: os.lstat(f).st_size if os.path.exists(f) else 0
-        q = self.dbo.sack.query()
-        for p in sorted(q.installed()):
-            pkgsize = sum(getsize(joinpaths(self.vars.root,f)) for f in p.files)
-            fobj.write("{0.name}.{0.arch}: {1}\n".format(p, pkgsize))
+        """debugging data: write a big list of pkg sizes
+
+        :param str pkgsizefile: Path of the file to write
+        :returns: {name.arch: size in bytes}
+        :rtype: dict
+
+        The sizes of everything in the root are read in one pass and then
+        added up using the package file lists.
+        """
+        sizes = tree_sizes(self.vars.root)
+        realdirs = {}
+        pkgsizes = {}
+        with open(pkgsizefile, "w") as fobj:
+            for _name, pkg, files in self._installed_files():
+                pkgsizes[pkg] = sum(sizes.get(tree_realpath(self.vars.root, f, realdirs), 0) for f in files)
+                fobj.write("{0}: {1}\n".format(pkg, pkgsizes[pkg]))
+        return pkgsizes
+
+    def writepkgsizediff(self, original, final, difffile):
+        """debugging data: write the space saved in each package as JSON
+
+        :param dict original: {name.arch: size} from before runtime-cleanup.tmpl
+        :param dict final: {name.arch: size} from after runtime-cleanup.tmpl
+        :param str difffile: Path of the JSON file to write
+        """
+        packages = [{"package": pkg, "original": original[pkg], "final": final.get(pkg, 0),
+                     "saved": original[pkg] - final.get(pkg, 0)} for pkg in original]
+        packages.sort(key=lambda p: (-p["saved"], p["package"]))
+        with open(difffile, "w") as fobj:
+            json.dump({"original": sum(original.values()),
+                       "final": sum(final.values()),
+                       "saved": sum(original.values()) - sum(final.values()),
+                       "packages": packages}, fobj, indent=2)
 
     def generate_module_data(self):
         root = self.vars.root
@@ -401,3 +454,55 @@ def string_lower(string):
     This is used as a filter in the templates.
     """
     return string.lower()
+
+def tree_sizes(root):
+    """ Return the size of everything under a directory
+
+    :param str root: Directory to scan
+    :returns: {absolute path relative to root: size from lstat}
+    :rtype: dict
+
+    Symlinks are not followed. This is used to add up package sizes without
+    checking each file of each package separately.
+    """
+    sizes = {}
+    root = root.rstrip("/")
+    dirs = [root]
+    while dirs:
+        path = dirs.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                sizes[entry.path[len(root):]] = entry.stat(follow_symlinks=False).st_size
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+            except OSError:
+                pass
+    return sizes
+
+def tree_realpath(root, path, realdirs):
+    """ Return the path of a file in the root with its directory's symlinks resolved
+
+    :param str root: Directory the path is in
+    :param str path: Absolute path relative to root, eg. /lib/modules/5.3.7/modules.dep
+    :param dict realdirs: Cache of the resolved directories, pass the same dict for each call
+    :returns: The path relative to root, eg. /usr/lib/modules/5.3.7/modules.dep
+    :rtype: str
+
+    The file itself is not resolved, tree_sizes() records the size of a symlink.
+    Directories that resolve to somewhere outside of the root are left as they are.
+    """
+    parent, name = os.path.split(path)
+    if parent not in realdirs:
+        realroot = os.path.realpath(root)
+        realdir = os.path.realpath(joinpaths(realroot, parent))
+        if realdir == realroot:
+            realdirs[parent] = ""
+        elif realdir.startswith(realroot + "/"):
+            realdirs[parent] = realdir[len(realroot):]
+        else:
+            realdirs[parent] = parent.rstrip("/")
+    return realdirs[parent] + "/" + name
@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Benchmark the lorax-composer API routes that are called the most
+
+The results directory is seeded with N synthetic composes, and the blueprint git
+repo with M blueprints that each have K commits, every commit is tagged. The routes
+are requested with the Flask test client, so no lorax-composer process, dnf, or
+anaconda is needed. Each scale is set up in a new temporary directory.
+
+Run it from the top of the checkout with:
+
+    PYTHONPATH=./src/ ./tests/benchmarks/bench_composer.py --output benchmark.json
+
+The results are written as JSON, pass a previous run to --compare to show how
+much slower or faster each benchmark is.
+"""
+import logging
+log = logging.getLogger("bench-composer")
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from pylorax import vernum
+from pylorax.api.compose import compose_args
+from pylorax.api.config import configure, make_queue_dirs
+from pylorax.api.metrics import TimedLock
+from pylorax.api.queue import PROGRESS_LOG
+from pylorax.api.recipes import open_or_create_repo, commit_recipe, tag_recipe_commit
+from pylorax.api.recipes import recipe_from_dict, recipe_diff
+from pylorax.api.server import server, GitLock
+from pylorax.api.timestamp import TS_CREATED, TS_STARTED, TS_FINISHED
+import pylorax.api.toml as toml
+from pylorax.progress import PROGRESS_PHASES
+from pylorax.sysutils import joinpaths
+
+# name: (composes, blueprints, commits per blueprint)
+SCALES = {"small":  (10, 5, 3),
+          "medium": (100, 20, 10),
+          "large":  (1000, 50, 20)}
+
+# The synthetic composes cycle through these types
+COMPOSE_TYPES = ["qcow2", "live-iso", "ext4-filesystem"]
+
+# Installer phases written to each compose's progress log
+PHASES = [name for name, _ in PROGRESS_PHASES]
+
+def parse_scale(scale):
+    """Parse a scale name, or N,M,K
+
+    :param str scale: A name from SCALES, or composes,blueprints,commits
+    :returns: (name, composes, blueprints, commits)
+    :rtype: tuple
+    :raises: argparse.ArgumentTypeError if it cannot be parsed
+    """
+    if scale in SCALES:
+        return (scale,) + SCALES[scale]
+    try:
+        composes, blueprints, commits = [int(n) for n in scale.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not one of %s or N,M,K" % (scale, ", ".join(SCALES)))
+    if composes < 1 or blueprints < 1 or commits < 1:
+        raise argparse.ArgumentTypeError("%s must all be 1 or more" % scale)
+    return (scale, composes, blueprints, commits)
+
+def make_recipe(name, commit):
+    """Make a blueprint that changes with every commit
+
+    :param str name: Name of the blueprint
+    :param int commit: Number of the commit, from 0
+    :returns: The blueprint
+    :rtype: Recipe
+    """
+    packages = [{"name": "package-%02d" % i, "version": "1.%d.*" % (commit if i == 0 else 0)}
+                for i in range(10 + commit)]
+    modules = [{"name": "module-%02d" % i, "version": "*"} for i in range(3)]
+    return recipe_from_dict({"name": name,
+                             "description": "Benchmark blueprint %s, commit %d" % (name, commit),
+                             "version": "0.0.1",
+                             "packages": packages,
+                             "modules": modules,
+                             "groups": [{"name": "core"}],
+                             "customizations": {"hostname": "%s-%d" % (name, commit)}})
+
+def seed_blueprints(repo, blueprints, commits):
+    """Commit and tag the blueprints
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param int blueprints: Number of blueprints
+    :param int commits: Number of commits of each blueprint
+    :returns: {name: (first recipe, last recipe)}
+    :rtype: dict
+    """
+    recipes = {}
+    for b in range(blueprints):
+        name = "bench-%03d" % b
+        first = None
+        for c in range(commits):
+            recipe = make_recipe(name, c)
+            commit_recipe(repo, "master", recipe)
+            tag_recipe_commit(repo, "master", name)
+            if c == 0:
+                first = recipe
+        recipes[name] = (first, recipe)
+    return recipes
+
+def seed_composes(lib_dir, composes, blueprint_names):
+    """Write the results directories of finished, failed, running, and waiting composes
+
+    :param str lib_dir: The composer lib_dir
+    :param int composes: Number of composes
+    :param list blueprint_names: Names of the blueprints to use
+    :returns: The uuids of the composes
+    :rtype: list of str
+
+    1 in 10 composes failed, the last compose is running, and the two before it are
+    waiting, the rest have finished.
+    """
+    uuids = []
+    now = time.time()
+    for i in range(composes):
+        build_id = str(uuid.uuid4())
+        results_dir = joinpaths(lib_dir, "results", build_id)
+        os.makedirs(results_dir)
+        compose_type = COMPOSE_TYPES[i % len(COMPOSE_TYPES)]
+        blueprint = make_recipe(blueprint_names[i % len(blueprint_names)], 0)
+        created = now - (composes - i) * 600
+
+        if i == composes - 1:
+            status, queue = "RUNNING", "run"
+        elif i >= composes - 3:
+            status, queue = "WAITING", "new"
+        elif i % 10 == 9:
+            status, queue = "FAILED", None
+        else:
+            status, queue = "FINISHED", None
+
+        cfg_args = compose_args(compose_type)
+        cfg_args.update({"ks": [joinpaths(results_dir, "final-kickstart.ks")],
+                         "logfile": joinpaths(results_dir, "logs/"),
+                         "timeout": 60})
+        with open(joinpaths(results_dir, "config.toml"), "w") as f:
+            f.write(toml.dumps(cfg_args))
+        with open(joinpaths(results_dir, "blueprint.toml"), "w") as f:
+            f.write(blueprint.toml())
+        for ks in [compose_type + ".ks", "final-kickstart.ks"]:
+            with open(joinpaths(results_dir, ks), "w") as f:
+                f.write("# %s\n" % ks)
+        with open(joinpaths(results_dir, "STATUS"), "w") as f:
+            f.write(status + "\n")
+
+        times = {TS_CREATED: created}
+        if status != "WAITING":
+            times[TS_STARTED] = created + 5
+            with open(joinpaths(results_dir, PROGRESS_LOG), "w") as f:
+                for p, phase in enumerate(PHASES if status != "RUNNING" else PHASES[:5]):
+                    f.write(json.dumps({"event": "phase", "phase": phase, "time": created + 10 + p * 30}) + "\n")
+                f.write(json.dumps({"event": "packages", "done": 400, "total": 400, "time": created + 200}) + "\n")
+        if status in ("FINISHED", "FAILED"):
+            times[TS_FINISHED] = created + 500
+        with open(joinpaths(results_dir, "times.toml"), "w") as f:
+            f.write(toml.dumps(times))
+
+        if status == "FINISHED":
+            with open(joinpaths(results_dir, cfg_args["image_name"]), "wb") as f:
+                f.truncate(1024**2)
+        if queue:
+            os.symlink(results_dir, joinpaths(lib_dir, "queue", queue, build_id))
+        uuids.append(build_id)
+    return uuids
+
+def time_calls(fn, repeat, warmup=1):
+    """Call a function and return statistics about how long it took
+
+    :param fn: Function to call, with no arguments
+    :param int repeat: Number of calls to time
+    :param int warmup: Number of calls to make first, that are not timed
+    :returns: {"iterations", "min", "median", "mean", "max", "stdev"} in seconds
+    :rtype: dict
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"iterations": repeat,
+            "min":        min(times),
+            "median":     statistics.median(times),
+            "mean":       statistics.mean(times),
+            "max":        max(times),
+            "stdev":      statistics.stdev(times) if repeat > 1 else 0.0}
+
+def get_route(client, route):
+    """Return a function that requests a route and checks that it succeeded"""
+    def get():
+        resp = client.get(route)
+        if resp.status_code != 200:
+            raise RuntimeError("%s returned %d: %s" % (route, resp.status_code, resp.data[:200]))
+        return resp
+    return get
+
+def run_scale(scale, repeat, keep=False):
+    """Setup the fixtures for a scale and run the benchmarks
+
+    :param tuple scale: (name, composes, blueprints, commits) from parse_scale()
+    :param int repeat: Number of times to call each route
+    :param bool keep: Keep the temporary directory
+    :returns: The scale, the time taken to set it up, and the results of the benchmarks
+    :rtype: dict
+    """
+    name, composes, blueprints, commits = scale
+    tmp_dir = tempfile.mkdtemp(prefix="lorax.bench.")
+    try:
+        setup_start = time.perf_counter()
+        cfg = configure(root_dir=tmp_dir, test_config=True)
+        lib_dir = cfg.get("composer", "lib_dir")
+        errors = make_queue_dirs(cfg, os.getgid())
+        if errors:
+            raise RuntimeError("\n".join(errors))
+
+        repo_dir = joinpaths(tmp_dir, "blueprints")
+        os.makedirs(repo_dir)
+        repo = open_or_create_repo(repo_dir)
+        recipes = seed_blueprints(repo, blueprints, commits)
+        names = sorted(recipes)
+        uuids = seed_composes(lib_dir, composes, names)
+        setup_seconds = time.perf_counter() - setup_start
+
+        server.config["COMPOSER_CFG"] = cfg
+        server.config["GITLOCK"] = GitLock(repo=repo, lock=TimedLock("git"), dir=repo_dir)
+        server.config["TEMPLATE_ERRORS"] = []
+        server.config["TESTING"] = True
+        client = server.test_client()
+
+        all_names = ",".join(names)
+        benchmarks = {
+            "compose_status_all":       get_route(client, "/api/v0/compose/status/*"),
+            "compose_status_one":       get_route(client, "/api/v0/compose/status/%s" % uuids[0]),
+            "compose_status_10":        get_route(client, "/api/v0/compose/status/%s" % ",".join(uuids[:10])),
+            "compose_finished":         get_route(client, "/api/v0/compose/finished"),
+            "blueprints_list":          get_route(client, "/api/v0/blueprints/list?limit=%d" % blueprints),
+            "blueprints_info_one":      get_route(client, "/api/v0/blueprints/info/%s" % names[0]),
+            "blueprints_info_all":      get_route(client, "/api/v0/blueprints/info/%s" % all_names),
+            "blueprints_changes_one":   get_route(client, "/api/v0/blueprints/changes/%s?limit=%d" % (names[0], commits)),
+            "blueprints_changes_all":   get_route(client, "/api/v0/blueprints/changes/%s?limit=%d" % (all_names, commits)),
+            "recipe_diff_all":          lambda: [recipe_diff(first, last) for first, last in recipes.values()],
+        }
+        results = {}
+        for bench, fn in sorted(benchmarks.items()):
+            log.info("%s: %s", name, bench)
+            results[bench] = time_calls(fn, repeat)
+    finally:
+        if keep:
+            log.info("Keeping %s", tmp_dir)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {"scale":         name,
+            "composes":      composes,
+            "blueprints":    blueprints,
+            "commits":       commits,
+            "setup_seconds": setup_seconds,
+            "benchmarks":    results}
+
+def compare(results, previous, max_regression):
+    """Print how the medians changed from a previous run
+
+    :param dict results: The results of this run
+    :param dict previous: The results of a previous run
+    :param float max_regression: Percentage slower that counts as a regression, or None
+    :returns: The number of benchmarks that regressed
+    :rtype: int
+    """
+    old_scales = dict((s["scale"], s) for s in previous["scales"])
+    regressions = 0
+    print("\nCompared to %s from %s" % (previous["version"], time.ctime(previous["created"])))
+    print("%-8s %-24s %12s %12s %9s" % ("scale", "benchmark", "old median", "new median", "change"))
+    for scale in results["scales"]:
+        old = old_scales.get(scale["scale"])
+        if old is None:
+            continue
+        for bench, stats in sorted(scale["benchmarks"].items()):
+            if bench not in old["benchmarks"]:
+                continue
+            old_median = old["benchmarks"][bench]["median"]
+            change = (stats["median"] - old_median) / old_median * 100 if old_median else 0.0
+            flag = ""
+            if max_regression is not None and change > max_regression:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("%-8s %-24s %10.2fms %10.2fms %+8.1f%%%s" % (scale["scale"], bench, old_median * 1000,
+                                                               stats["median"] * 1000, change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the lorax-composer API")
+    parser.add_argument("--scale", action="append", type=parse_scale, dest="scales",
+                        help="Scale to run, one of %s, or composes,blueprints,commits. "
+                             "Can be repeated, defaults to small and medium" % ", ".join(sorted(SCALES)))
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="Number of times to run each benchmark")
+    parser.add_argument("--output", default=None,
+                        help="Write the results to this JSON file")
+    parser.add_argument("--compare", default=None,
+                        help="JSON results of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="Exit with an error if a median is more than this percentage slower "
+                             "than the --compare results")
+    parser.add_argument("--keep", action="store_true", default=False,
+                        help="Keep the temporary directories with the fixtures")
+    parser.add_argument("--debug", action="store_true", default=False,
+                        help="Log the progress of the benchmarks")
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if opts.debug else logging.WARNING,
+                        format="%(asctime)s: %(message)s")
+    # The server's request logging would be included in the times
+    logging.getLogger("lorax-composer").setLevel(logging.WARNING)
+
+    scales = opts.scales or [parse_scale("small"), parse_scale("medium")]
+    results = {"version":  vernum,
+               "python":   platform.python_version(),
+               "machine":  platform.machine(),
+               "cpus":     os.cpu_count(),
+               "created":  time.time(),
+               "repeat":   opts.repeat,
+               "scales":   []}
+
+    for scale in scales:
+        result = run_scale(scale, opts.repeat, opts.keep)
+        results["scales"].append(result)
+        print("%s: %d composes, %d blueprints with %d commits, setup took %.1fs" %
+              (result["scale"], result["composes"], result["blueprints"], result["commits"],
+               result["setup_seconds"]))
+        for bench, stats in sorted(result["benchmarks"].items()):
+            print("    %-24s median %10.2fms  min %10.2fms  max %10.2fms" %
+                  (bench, stats["median"] * 1000, stats["min"] * 1000, stats["max"] * 1000))
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Results written to %s" % opts.output)
+
+    if opts.compare:
+        with open(opts.compare, "r") as f:
+            previous = json.load(f)
+        if compare(results, previous, opts.max_regression):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
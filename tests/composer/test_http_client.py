@@ -14,9 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import tempfile
 import unittest
 
-from composer.http_client import api_url, get_filename
+from composer.http_client import api_url, get_filename, _split_ranges
+from composer.http_client import _read_download_state, _write_download_state
 
 headers = {'content-disposition': 'attachment; filename=e7b9b9b0-5867-493d-89c3-115cfe9227d7-metadata.tar;',
            'access-control-max-age': '21600',
@@ -34,3 +37,20 @@ class HttpClientTest(unittest.TestCase):
     def test_get_filename(self):
         """Return the filename from a content-disposition header"""
         self.assertEqual(get_filename(headers), "e7b9b9b0-5867-493d-89c3-115cfe9227d7-metadata.tar")
+
+    def test_split_ranges(self):
+        """Split a download into ranges"""
+        self.assertEqual(_split_ranges(10, 1), [[0, 10, 0]])
+        self.assertEqual(_split_ranges(10, 3), [[0, 3, 0], [3, 6, 0], [6, 10, 0]])
+        self.assertEqual(_split_ranges(2, 4), [[0, 1, 0], [1, 2, 0]])
+
+    def test_download_state(self):
+        """Save and restore the progress of a download"""
+        with tempfile.TemporaryDirectory(prefix="composer.test.") as tmpdir:
+            state_path = os.path.join(tmpdir, "image.part.json")
+            self.assertEqual(_read_download_state(state_path, '"etag"', 10), None)
+
+            _write_download_state(state_path, '"etag"', 10, [[0, 5, 5], [5, 10, 2]])
+            self.assertEqual(_read_download_state(state_path, '"etag"', 10), [[0, 5, 5], [5, 10, 2]])
+            self.assertEqual(_read_download_state(state_path, '"changed"', 10), None)
+            self.assertEqual(_read_download_state(state_path, '"etag"', 11), None)
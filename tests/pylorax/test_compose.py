@@ -27,7 +27,7 @@ from pylorax.api.compose import lang_cmd, get_languages, keyboard_cmd, get_keybo
 from pylorax.api.compose import firewall_cmd, get_firewall_settings
 from pylorax.api.compose import services_cmd, get_services, get_default_services
 from pylorax.api.compose import get_kernel_append, bootloader_append, customize_ks_template
-from pylorax.api.config import configure, make_dnf_dirs
+from pylorax.api.config import configure, make_dnf_dirs, check_compression, check_numeric_options
 from pylorax.api.dnfbase import get_base_object
 from pylorax.api.recipes import recipe_from_toml, RecipeError
 from pylorax.sysutils import joinpaths
@@ -835,3 +835,41 @@ class ExtraPkgsTest(unittest.TestCase):
         """Test that non-live doesn't parse live-install.tmpl"""
         extra_pkgs = get_extra_pkgs(self.dbo, "./share/", "qcow2")
         self.assertEqual(extra_pkgs, [])
+
+class ConfigChecksTest(unittest.TestCase):
+    def test_check_compression(self):
+        """Test replacing bad [compression] settings"""
+        config = configure(test_config=True)
+        self.assertEqual(check_compression(config), [])
+
+        config.add_section("compression")
+        config.set("compression", "type", "zstd")
+        config.set("compression", "threads", "4")
+        self.assertEqual(check_compression(config), [])
+
+        config.set("compression", "type", "rar")
+        config.set("compression", "threads", "many")
+        self.assertEqual(len(check_compression(config)), 2)
+        self.assertEqual(config.get("compression", "type"), "xz")
+        self.assertEqual(config.get("compression", "threads"), "0")
+
+        config.set("compression", "threads", "-1")
+        self.assertEqual(len(check_compression(config)), 1)
+        self.assertEqual(config.get("compression", "threads"), "0")
+
+    def test_check_numeric_options(self):
+        """Test replacing bad numeric [composer] settings"""
+        config = configure(test_config=True)
+        self.assertEqual(check_numeric_options(config), [])
+
+        config.set("composer", "cpus", "4")
+        config.set("composer", "lock_warn_seconds", "2.5")
+        self.assertEqual(check_numeric_options(config), [])
+
+        config.set("composer", "cpus", "all")
+        config.set("composer", "lock_warn_seconds", "-1")
+        config.set("composer", "profile_max", "1.5")
+        self.assertEqual(len(check_numeric_options(config)), 3)
+        self.assertEqual(config.get("composer", "cpus"), "0")
+        self.assertEqual(config.get("composer", "lock_warn_seconds"), "0")
+        self.assertEqual(config.get("composer", "profile_max"), "500")
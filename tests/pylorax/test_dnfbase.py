@@ -20,9 +20,11 @@ import tempfile
 import unittest
 
 import configparser
+import dnf
 
 from pylorax.api.config import configure, make_dnf_dirs
 from pylorax.api.dnfbase import get_base_object
+from pylorax.dnfbase import repo_cache_name, use_package_cache
 
 
 class DnfbaseNoSystemReposTest(unittest.TestCase):
@@ -110,3 +112,31 @@ class CreateDnfDirsTest(unittest.TestCase):
         make_dnf_dirs(config, os.getuid(), os.getgid())
 
         self.assertTrue(os.path.exists(self.tmp_dir + '/var/tmp/composer/dnf/root'))
+
+
+class DnfbasePackageCacheTest(unittest.TestCase):
+    def test_repo_cache_name(self):
+        """Test that the package cache name depends on the repo's urls"""
+        conf = dnf.Base().conf
+        repo = dnf.repo.Repo("lorax-repo-0", conf)
+        repo.baseurl = ["http://mirror.example.com/fedora/"]
+        other = dnf.repo.Repo("lorax-repo-0", conf)
+        other.baseurl = ["http://mirror.example.com/updates/"]
+
+        self.assertTrue(repo_cache_name(repo).startswith("lorax-repo-0-"))
+        self.assertEqual(repo_cache_name(repo), repo_cache_name(repo))
+        self.assertNotEqual(repo_cache_name(repo), repo_cache_name(other))
+
+    def test_use_package_cache(self):
+        """Test setting up the persistent package cache"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as pkgcache:
+            dbo = dnf.Base()
+            repo = dnf.repo.Repo("lorax-repo-0", dbo.conf)
+            repo.baseurl = ["http://mirror.example.com/fedora/"]
+            repo.enable()
+            dbo.repos.add(repo)
+
+            use_package_cache(dbo, pkgcache)
+            self.assertTrue(dbo.conf.keepcache)
+            self.assertEqual(repo.pkgdir, os.path.join(pkgcache, repo_cache_name(repo)))
+            self.assertTrue(os.path.isdir(repo.pkgdir))
@@ -0,0 +1,96 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from pylorax.api.download import file_etag, parse_range, TarStream
+from pylorax.sysutils import joinpaths
+
+class DownloadTest(unittest.TestCase):
+    def test_parse_range(self):
+        """Test parsing the Range header"""
+        self.assertEqual(parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(parse_range("bytes=500-", 1000), (500, 999))
+        self.assertEqual(parse_range("bytes=900-2000", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-2000", 1000), (0, 999))
+
+        # Multiple ranges and invalid headers send the whole file
+        self.assertEqual(parse_range("bytes=0-1,5-6", 1000), None)
+        self.assertEqual(parse_range("lines=0-1", 1000), None)
+        self.assertEqual(parse_range("bytes=10-5", 1000), None)
+
+        with self.assertRaises(ValueError):
+            parse_range("bytes=1000-", 1000)
+        with self.assertRaises(ValueError):
+            parse_range("bytes=-0", 1000)
+
+    def test_file_etag(self):
+        """Test the ETag of a file"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.") as f:
+            self.assertEqual(file_etag(f.name, {"sha256": "abcd"}), "sha256-abcd")
+            etag = file_etag(f.name)
+            self.assertEqual(file_etag(f.name), etag)
+            f.write(b"changed")
+            f.flush()
+            self.assertNotEqual(file_etag(f.name), etag)
+
+    def test_tar_stream(self):
+        """Test creating a tar while it is read"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            os.makedirs(joinpaths(tmp_dir, "logs/anaconda"))
+            open(joinpaths(tmp_dir, "logs/anaconda/anaconda.log"), "w").write("anaconda log\n" * 100)
+            open(joinpaths(tmp_dir, "blueprint.toml"), "w").write("name = \"example\"\n")
+            open(joinpaths(tmp_dir, "n" * 150), "w").write("long name\n")
+            os.symlink("blueprint.toml", joinpaths(tmp_dir, "link"))
+
+            tar = TarStream(tmp_dir, ["blueprint.toml", "link", "logs", "n" * 150])
+            data = b"".join(tar)
+            self.assertEqual(len(data), tar.size)
+            with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+                self.assertEqual(tf.getnames(), ["blueprint.toml", "link", "logs", "logs/anaconda",
+                                                 "logs/anaconda/anaconda.log", "n" * 150])
+                self.assertEqual(tf.getmember("link").linkname, "blueprint.toml")
+                self.assertEqual(tf.extractfile("logs/anaconda/anaconda.log").read(), b"anaconda log\n" * 100)
+
+            tar = TarStream(tmp_dir, ["logs"], "gzip")
+            self.assertEqual(tar.size, None)
+            self.assertEqual(tar.filename_suffix, ".tar.gz")
+            with tarfile.open(fileobj=io.BytesIO(gzip.decompress(b"".join(tar)))) as tf:
+                self.assertEqual(tf.getnames(), ["logs", "logs/anaconda", "logs/anaconda/anaconda.log"])
+
+            with self.assertRaises(ValueError):
+                TarStream(tmp_dir, ["logs"], "bzip2")
+
+    def test_tar_stream_changed(self):
+        """Test that the tar is still valid when a file changes size"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            open(joinpaths(tmp_dir, "shrinks.log"), "w").write("x" * 1000)
+            open(joinpaths(tmp_dir, "grows.log"), "w").write("y" * 1000)
+            tar = TarStream(tmp_dir, ["grows.log", "shrinks.log"])
+            open(joinpaths(tmp_dir, "shrinks.log"), "w").write("x" * 10)
+            open(joinpaths(tmp_dir, "grows.log"), "a").write("y" * 1000)
+
+            data = b"".join(tar)
+            self.assertEqual(len(data), tar.size)
+            with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+                self.assertEqual(tf.extractfile("grows.log").read(), b"y" * 1000)
+                self.assertEqual(tf.extractfile("shrinks.log").read(), b"x" * 10 + bytes(990))
@@ -0,0 +1,85 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+from pylorax.elfutils import read_elf, ElfError, LibraryIndex, expand_search_dirs, ELFCLASS64
+from pylorax.sysutils import joinpaths
+
+class ElfUtilsTest(unittest.TestCase):
+    def read_elf_test(self):
+        """Test reading the dynamic section of an ELF file"""
+        info = read_elf("/usr/bin/ls")
+        self.assertTrue(info.interp)
+        self.assertTrue("libc.so.6" in info.needed, info.needed)
+        self.assertEqual(info.soname, None)
+
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            script = joinpaths(work_dir, "script.sh")
+            open(script, "w").write("#!/bin/sh\n")
+            self.assertEqual(read_elf(script), None)
+
+            truncated = joinpaths(work_dir, "truncated")
+            with open("/usr/bin/ls", "rb") as f:
+                open(truncated, "wb").write(f.read(64))
+            with self.assertRaises(ElfError):
+                read_elf(truncated)
+
+    def realpath_test(self):
+        """Test resolving symlinks inside of the root"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root:
+            os.makedirs(joinpaths(root, "usr/lib64"))
+            os.symlink("usr/lib64", joinpaths(root, "lib64"))
+            open(joinpaths(root, "usr/lib64/libfoo.so.1.0"), "w").write("")
+            os.symlink("/lib64/libfoo.so.1.0", joinpaths(root, "usr/lib64/libfoo.so.1"))
+            os.symlink("/usr/lib64/libmissing.so.1.0", joinpaths(root, "usr/lib64/libmissing.so.1"))
+
+            libs = LibraryIndex(root)
+            self.assertEqual(libs.realpath("/lib64/libfoo.so.1"), "/usr/lib64/libfoo.so.1.0")
+            self.assertEqual(libs.realpath("/lib64/../lib64/libfoo.so.1"), "/usr/lib64/libfoo.so.1.0")
+            self.assertEqual(libs.realpath("/lib64/libmissing.so.1"), None)
+
+    def ld_so_conf_test(self):
+        """Test reading the library directories from ld.so.conf"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root:
+            os.makedirs(joinpaths(root, "etc/ld.so.conf.d"))
+            open(joinpaths(root, "etc/ld.so.conf"), "w").write("include ld.so.conf.d/*.conf\n/opt/lib # comment\n")
+            open(joinpaths(root, "etc/ld.so.conf.d/a.conf"), "w").write("/usr/lib64/a\n")
+            open(joinpaths(root, "etc/ld.so.conf.d/b.conf"), "w").write("# nothing\n/usr/lib64/b\n")
+            self.assertEqual(LibraryIndex(root).ld_so_conf(), ["/usr/lib64/a", "/usr/lib64/b", "/opt/lib"])
+
+    def expand_search_dirs_test(self):
+        """Test expanding $ORIGIN and $LIB in rpaths"""
+        self.assertEqual(expand_search_dirs(["$ORIGIN/../$LIB", "${ORIGIN}/x", "/opt/${LIB}/foo"],
+                                            "/usr/bin", ELFCLASS64),
+                         ["/usr/bin/../lib64", "/usr/bin/x", "/opt/lib64/foo"])
+        self.assertEqual(expand_search_dirs(["/opt/$LIB"], "/usr/bin", 1), ["/opt/lib"])
+
+    def missing_test(self):
+        """Test finding missing libraries"""
+        self.assertEqual(LibraryIndex("/").missing("/usr/bin/ls"), [])
+
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root:
+            os.makedirs(joinpaths(root, "usr/bin"))
+            shutil.copy2("/usr/bin/ls", joinpaths(root, "usr/bin/ls"))
+            info = read_elf("/usr/bin/ls")
+
+            missing = LibraryIndex(root).missing("/usr/bin/ls")
+            self.assertTrue((info.interp, "/usr/bin/ls") in missing, missing)
+            self.assertTrue(("libc.so.6", "/usr/bin/ls") in missing, missing)
@@ -14,19 +14,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import errno
 import glob
+import hashlib
+import lzma
 import os
 import parted
 import tarfile
 import tempfile
 import unittest
+from unittest import mock
+from subprocess import CalledProcessError
 
 from ..lib import get_file_magic
 from pylorax.executils import runcmd
 from pylorax.imgutils import mkcpio, mktar, mksquashfs, mksparse, mkqcow2, loop_attach, loop_detach
 from pylorax.imgutils import get_loop_name, LoopDev, dm_attach, dm_detach, DMDev, Mount
 from pylorax.imgutils import mkdosimg, mkext4img, mkbtrfsimg, mkhfsimg, default_image_name
-from pylorax.imgutils import mount, umount, kpartx_disk_img, PartitionMount, mkfsimage_from_disk
+from pylorax.imgutils import mount, umount, kpartx_disk_img, PartitionMount, mkfsimage_from_disk, OverlayMount
+from pylorax.imgutils import image_checksums, record_checksums, write_checksums_file, read_checksums_file
+from pylorax.imgutils import CpioWriter, compressor_cmd, mkfs_can_populate, estimate_size, round_to_blocks
+from pylorax.imgutils import mark_image_trimmed, image_is_trimmed, run_compressor, publish_image
 from pylorax.sysutils import joinpaths
 
 def mkfakerootdir(rootdir):
@@ -128,6 +136,46 @@ class ImgUtilsTest(unittest.TestCase):
                 file_details = get_file_magic(disk_img.name)
                 self.assertTrue("cpio" in file_details, file_details)
 
+    def compressor_cmd_test(self):
+        """Test compressor_cmd function"""
+        self.assertEqual(compressor_cmd(None), ["cat"])
+        self.assertEqual(compressor_cmd("xz", threads=2), ["xz", "-T2", "--check=crc32", "-9"])
+        self.assertEqual(compressor_cmd("gzip", ["-1"], threads=2), ["pigz", "-p2", "-1"])
+        self.assertEqual(compressor_cmd("zstd", threads=4), ["zstd", "-T4", "--long", "-10"])
+        self.assertEqual(compressor_cmd("zstd", ["-3"], threads=4), ["zstd", "-T4", "--long", "-3"])
+        with self.assertRaises(ValueError):
+            compressor_cmd("rar")
+
+    def compressed_mkcpio_test(self):
+        """Test mkcpio function with compression"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+                mkfakerootdir(work_dir)
+                self.assertEqual(mkcpio(work_dir, disk_img.name, compression="xz"), 0)
+
+                data = lzma.decompress(open(disk_img.name, "rb").read())
+                self.assertTrue(data.startswith(b"070701"))
+                self.assertTrue(b"home/bart/.bashrc\0" in data)
+                self.assertTrue(b"TRAILER!!!\0" in data)
+                self.assertEqual(len(data) % 512, 0)
+
+    def cpiowriter_append_test(self):
+        """Test appending a compressed cpio archive to an existing file"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.initrd.") as initrd:
+            initrd.write(b"FAKE INITRD")
+            initrd.flush()
+            with open(initrd.name, "ab") as f:
+                with CpioWriter(f, compression="xz") as cpio:
+                    cpio.add_data("ks.cfg", b"text\n", mtime=0)
+
+            data = open(initrd.name, "rb").read()
+            self.assertTrue(data.startswith(b"FAKE INITRD"))
+            archive = lzma.decompress(data[11:])
+            # header, name padded to 4 bytes, then the data
+            self.assertEqual(archive[:110], b"070701" + b"".join(b"%08X" % f for f in
+                             (1, 0o100644, 0, 0, 1, 0, 5, 0, 0, 0, 0, 7, 0)))
+            self.assertEqual(archive[110:128], b"ks.cfg\0\0\0\0text\n\0\0\0")
+
     def mktar_test(self):
         """Test mktar function"""
         with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
@@ -155,6 +203,92 @@ class ImgUtilsTest(unittest.TestCase):
                     file_details = get_file_magic(disk_img.name)
                     self.assertTrue(magic in file_details, (compression, magic, file_details))
 
+    def mktar_checksum_test(self):
+        """Test that mktar records the checksum of the tar"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+                mkfakerootdir(work_dir)
+                mktar(work_dir, disk_img.name, compression="xz")
+                sha256 = hashlib.sha256(open(disk_img.name, "rb").read()).hexdigest()
+                self.assertEqual(image_checksums(disk_img.name, compute=False), {"sha256": sha256})
+
+    def run_compressor_write_error_test(self):
+        """Test that a failure writing the compressed output is raised instead of hanging"""
+        def feed(comp_stdin):
+            for _ in range(64):
+                comp_stdin.write(bytes(1024**2))
+            return 64 * 1024**2
+
+        # Writes to /dev/full fail with ENOSPC
+        with self.assertRaises(OSError):
+            run_compressor(["cat"], "/dev/full", feed)
+        self.assertEqual(image_checksums("/dev/full", compute=False), {})
+
+    def image_checksums_test(self):
+        """Test recording and calculating image checksums"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            image = joinpaths(work_dir, "disk.img")
+            open(image, "w").write("I AM A FAKE IMAGE")
+            sha256 = hashlib.sha256(b"I AM A FAKE IMAGE").hexdigest()
+
+            self.assertEqual(image_checksums(image, compute=False), {})
+            record_checksums(image, {"sha256": "not-really-a-checksum"})
+            self.assertEqual(image_checksums(image), {"sha256": "not-really-a-checksum"})
+
+            # Changing the file invalidates the recorded checksum
+            open(image, "w").write("I AM A DIFFERENT FAKE IMAGE")
+            sha256 = hashlib.sha256(b"I AM A DIFFERENT FAKE IMAGE").hexdigest()
+            self.assertEqual(image_checksums(image, compute=False), {})
+            self.assertEqual(image_checksums(image), {"sha256": sha256})
+
+            checksums_file = joinpaths(work_dir, "CHECKSUMS")
+            write_checksums_file(checksums_file, {"disk.img": {"sha256": sha256}})
+            self.assertEqual(open(checksums_file).read(), "SHA256 (disk.img) = %s\n" % sha256)
+            self.assertEqual(read_checksums_file(checksums_file), {"disk.img": {"sha256": sha256}})
+            self.assertEqual(read_checksums_file(joinpaths(work_dir, "MISSING")), {})
+
+    def publish_image_test(self):
+        """Test keeping and recording checksums when moving images"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            image = joinpaths(work_dir, "disk.img")
+            open(image, "w").write("I AM A FAKE IMAGE")
+            sha256 = hashlib.sha256(b"I AM A FAKE IMAGE").hexdigest()
+
+            # A renamed image keeps its recorded checksum, nothing is calculated
+            record_checksums(image, {"sha256": "not-really-a-checksum"})
+            self.assertEqual(publish_image(image, joinpaths(work_dir, "renamed.img")), "rename")
+            self.assertEqual(image_checksums(joinpaths(work_dir, "renamed.img"), compute=False),
+                             {"sha256": "not-really-a-checksum"})
+
+            # A copy to another filesystem is checksummed while it is copied
+            open(image, "w").write("I AM A FAKE IMAGE")
+            with mock.patch("pylorax.sysutils.os.replace", side_effect=OSError(errno.EXDEV, "cross-device")):
+                with mock.patch("pylorax.sysutils.fcntl.ioctl", side_effect=OSError):
+                    self.assertEqual(publish_image(image, joinpaths(work_dir, "copied.img")), "copy")
+            self.assertFalse(os.path.exists(image))
+            self.assertEqual(image_checksums(joinpaths(work_dir, "copied.img"), compute=False), {"sha256": sha256})
+
+    def image_trimmed_test(self):
+        """Test remembering that an image's free blocks have been discarded"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            image = joinpaths(work_dir, "disk.img")
+            mksparse(image, 1024**2)
+            self.assertFalse(image_is_trimmed(image))
+            mark_image_trimmed(image)
+            self.assertTrue(image_is_trimmed(image))
+
+            # A hardlink to the image is the same image
+            link = joinpaths(work_dir, "rootfs.img")
+            os.link(image, link)
+            self.assertTrue(image_is_trimmed(link))
+
+            # Changing the image invalidates the mark
+            with open(image, "r+b") as f:
+                f.seek(4096)
+                f.write(b"DELETED DATA")
+            os.utime(image, ns=(0, 0))
+            self.assertFalse(image_is_trimmed(link))
+
     def mktar_single_file_test(self):
         with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img,\
                 tempfile.NamedTemporaryFile(prefix="lorax.test.input.") as input_file:
@@ -172,7 +306,10 @@ class ImgUtilsTest(unittest.TestCase):
             with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
                 mkfakerootdir(work_dir)
                 disk_img.close()
-                mksquashfs(work_dir, disk_img.name)
+                compressargs = ["-noappend"]
+                mksquashfs(work_dir, disk_img.name, compressargs=compressargs)
+                # The caller's arguments are not changed
+                self.assertEqual(compressargs, ["-noappend"])
 
                 self.assertTrue(os.path.exists(disk_img.name))
                 file_details = get_file_magic(disk_img.name)
@@ -247,6 +384,24 @@ class ImgUtilsTest(unittest.TestCase):
                 with Mount(loopdev) as mnt:
                     self.assertTrue(mnt is not None)
 
+    def overlay_fallback_test(self):
+        """Test that OverlayMount copies the directory when overlayfs cannot be mounted"""
+        def no_overlay(cmd, **kwargs):
+            if cmd[0] == "mount":
+                raise CalledProcessError(32, cmd)
+            return runcmd(cmd, **kwargs)
+
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            lower_dir = joinpaths(work_dir, "lower")
+            mkfakerootdir(lower_dir)
+            with mock.patch("pylorax.imgutils.runcmd", side_effect=no_overlay):
+                with OverlayMount(lower_dir, tmpdir=work_dir) as root_dir:
+                    self.assertTrue(root_dir.startswith(work_dir))
+                    self.assertTrue(os.path.exists(joinpaths(root_dir, "etc/passwd")))
+                    open(joinpaths(root_dir, "etc/passwd"), "w").write("changed")
+            self.assertNotEqual(open(joinpaths(lower_dir, "etc/passwd")).read(), "changed")
+            self.assertEqual(os.listdir(work_dir), ["lower"])
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def mkdosimg_test(self):
         """Test mkdosimg function (requires loop)"""
@@ -270,6 +425,23 @@ class ImgUtilsTest(unittest.TestCase):
                 file_details = get_file_magic(disk_img.name)
                 self.assertTrue("ext2 filesystem" in file_details, file_details)
 
+    @unittest.skipUnless(mkfs_can_populate("ext4"), "requires mkfs.ext4 with -d support")
+    def mkext4img_populate_test(self):
+        """Test mkext4img function without a loop device"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+                mkfakerootdir(work_dir)
+                mkext4img(work_dir, disk_img.name, size=64*1024**2, label="Anaconda")
+                file_details = get_file_magic(disk_img.name)
+                self.assertTrue("ext4 filesystem" in file_details, file_details)
+                self.assertTrue("Anaconda" in file_details, file_details)
+                self.assertTrue(image_is_trimmed(disk_img.name))
+
+    def mkfs_can_populate_test(self):
+        """Test mkfs_can_populate function"""
+        self.assertFalse(mkfs_can_populate("vfat"))
+        self.assertFalse(mkfs_can_populate("btrfs"))
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def mkbtrfsimg_test(self):
         """Test mkbtrfsimg function (requires loop)"""
@@ -292,9 +464,25 @@ class ImgUtilsTest(unittest.TestCase):
                 file_details = get_file_magic(disk_img.name)
                 self.assertTrue("Macintosh HFS" in file_details, file_details)
 
+    def estimate_size_test(self):
+        """Test estimate_size function"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkfakerootdir(work_dir)
+            expected = 0
+            for top, dirs, files in os.walk(work_dir):
+                for f in files + dirs:
+                    expected += round_to_blocks(os.lstat(os.path.join(top, f)).st_size, 4096)
+            self.assertEqual(estimate_size(work_dir, overhead=0), expected)
+            self.assertEqual(estimate_size(work_dir, overhead=0, threads=4), expected)
+
+            # Grafting a single file counts its size
+            graft = {"etc/passwd": joinpaths(work_dir, "etc/passwd")}
+            self.assertEqual(estimate_size(None, graft=graft, overhead=0), 4096)
+
     def default_image_name_test(self):
         """Test default_image_name function"""
-        for compression, suffix in [("xz", ".xz"), ("gzip", ".gz"), ("bzip2", ".bz2"), ("lzma", ".lzma")]:
+        for compression, suffix in [("xz", ".xz"), ("gzip", ".gz"), ("bzip2", ".bz2"), ("lzma", ".lzma"),
+                                    ("zstd", ".zst")]:
             filename = default_image_name(compression, "foobar")
             self.assertTrue(filename.endswith(suffix))
 
@@ -0,0 +1,146 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pylorax.api.logfollow import parse_cursor, format_cursor, tail_offset, read_new
+from pylorax.api.logfollow import follow_log, sse_event, Inotify
+from pylorax.api.queue import RUNNING_LOGS
+from pylorax.sysutils import joinpaths
+
+class FakeConfig(object):
+    def __init__(self, lib_dir):
+        self.lib_dir = lib_dir
+
+    def get(self, section, option):
+        return self.lib_dir
+
+class LogFollowTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="lorax.test.logfollow.")
+        self.cfg = FakeConfig(self.tmp_dir.name)
+        self.uuid_dir = joinpaths(self.tmp_dir.name, "results", "test-uuid")
+        os.makedirs(joinpaths(self.uuid_dir, "logs", "anaconda"))
+        self.running_logs = dict(RUNNING_LOGS)
+        tmp_logs = joinpaths(self.tmp_dir.name, "tmp")
+        os.makedirs(tmp_logs)
+        for name in RUNNING_LOGS:
+            RUNNING_LOGS[name] = joinpaths(tmp_logs, name + ".log")
+
+    def tearDown(self):
+        RUNNING_LOGS.update(self.running_logs)
+        self.tmp_dir.cleanup()
+
+    def write(self, path, data, mode="w"):
+        with open(path, mode) as f:
+            f.write(data)
+
+    def test_cursor(self):
+        """Test parsing and formatting the log cursor"""
+        offsets = parse_cursor("packaging:1234,anaconda:5678")
+        self.assertEqual(list(offsets.items()), [("packaging", 1234), ("anaconda", 5678)])
+        self.assertEqual(format_cursor("anaconda", offsets), "anaconda:5678,packaging:1234")
+        for cursor in ["", "anaconda", "anaconda:-1", "program:10", "anaconda:1,"]:
+            with self.assertRaises(ValueError):
+                parse_cursor(cursor)
+
+    def test_read_new(self):
+        """Test reading the complete lines added to a log"""
+        path = joinpaths(self.tmp_dir.name, "test.log")
+        self.write(path, "first line\nsecond line\npartial")
+        self.assertEqual(read_new(path, 0), ("first line\nsecond line\n", 23))
+        self.assertEqual(read_new(path, 23), ("", 23))
+        self.assertEqual(read_new(path, 23, final=True), ("partial", 30))
+
+        # A replaced log is read from the start
+        self.write(path, "new\n")
+        self.assertEqual(read_new(path, 30), ("new\n", 4))
+
+    def test_tail_offset(self):
+        """Test starting at a line boundary near the end of a log"""
+        path = joinpaths(self.tmp_dir.name, "test.log")
+        self.write(path, "".join("line %04d\n" % i for i in range(1000)))
+        self.assertEqual(tail_offset(path, 1024), 0)
+        offset = tail_offset(path, 1)
+        self.assertTrue(10000 - 1024 <= offset <= 10000 - 1024 + 10)
+        self.assertEqual(offset % 10, 0)
+
+    def test_follow_finished(self):
+        """Test following the log of a finished compose"""
+        self.write(joinpaths(self.uuid_dir, "STATUS"), "FINISHED\n")
+        self.write(joinpaths(self.uuid_dir, "logs", "combined.log"), "one\ntwo\nthree\n")
+        events = list(follow_log(self.cfg, "test-uuid"))
+        self.assertEqual(events, [("log", "one\ntwo\nthree\n", "combined:14"),
+                                  ("end", "FINISHED", "combined:14")])
+
+        # Continue from a cursor
+        events = list(follow_log(self.cfg, "test-uuid", "combined:4"))
+        self.assertEqual(events, [("log", "two\nthree\n", "combined:14"),
+                                  ("end", "FINISHED", "combined:14")])
+
+    def test_follow_running(self):
+        """Test following the logs of a running compose"""
+        anaconda_log = RUNNING_LOGS["anaconda"]
+        self.write(joinpaths(self.uuid_dir, "STATUS"), "RUNNING\n")
+        self.write(anaconda_log, "starting\n")
+
+        events = follow_log(self.cfg, "test-uuid", poll=0.1, keepalive=0.1)
+        self.assertEqual(next(events), ("log", "starting\n", "anaconda:9"))
+
+        # Only new lines are returned, and only complete ones
+        self.write(anaconda_log, "installing\npartial", "a")
+        self.assertEqual(next(events), ("log", "installing\n", "anaconda:20"))
+        self.assertEqual(next(events), ("keepalive", "", "anaconda:20"))
+
+        # anaconda exits, its log is moved into the results and the compose finishes
+        os.rename(anaconda_log, joinpaths(self.uuid_dir, "logs", "anaconda", "anaconda.log"))
+        self.write(joinpaths(self.uuid_dir, "logs", "combined.log"), "finished\n")
+        self.write(joinpaths(self.uuid_dir, "STATUS"), "FINISHED\n")
+        self.assertEqual(list(events), [("log", "partial", "anaconda:27"),
+                                        ("switch", "combined", "combined:0,anaconda:27"),
+                                        ("log", "finished\n", "combined:9,anaconda:27"),
+                                        ("end", "FINISHED", "combined:9,anaconda:27")])
+
+    def test_inotify(self):
+        """Test waiting for a log to change"""
+        watcher = Inotify()
+        try:
+            watcher.watch(self.tmp_dir.name)
+            self.assertFalse(watcher.wait({"test.log"}, 0.1))
+            self.write(joinpaths(self.tmp_dir.name, "other.log"), "other\n")
+            self.write(joinpaths(self.tmp_dir.name, "test.log"), "test\n")
+            # Without inotify the caller has to check the files itself
+            self.assertEqual(watcher.wait({"test.log"}, 1), watcher.fd is not None)
+        finally:
+            watcher.close()
+
+    def test_follow_polling(self):
+        """Test keepalive events when inotify is not available"""
+        self.write(joinpaths(self.uuid_dir, "STATUS"), "WAITING\n")
+        with mock.patch("pylorax.api.logfollow.ctypes.CDLL", side_effect=OSError):
+            events = follow_log(self.cfg, "test-uuid", poll=0.1, keepalive=0.1)
+            self.assertEqual(next(events), ("keepalive", "", ""))
+            events.close()
+
+    def test_sse_event(self):
+        """Test formatting Server-Sent Events"""
+        self.assertEqual(sse_event("log", "one\ntwo\n", "anaconda:8"),
+                         "event: log\nid: anaconda:8\ndata: one\ndata: two\ndata: \n\n")
+        self.assertEqual(sse_event("end", "FINISHED", ""), "event: end\ndata: FINISHED\n\n")
+        self.assertEqual(sse_event("keepalive", "", "anaconda:8"), ": keepalive\n\n")
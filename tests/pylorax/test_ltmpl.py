@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from contextlib import contextmanager
+import json
 import os
 from rpmfluff import SimpleRpmBuild, SourceFile, expectedArch
 import shutil
@@ -24,6 +25,8 @@ import unittest
 from pylorax.dnfbase import get_dnf_base_object
 from pylorax.ltmpl import LoraxTemplate, LoraxTemplateRunner
 from pylorax.ltmpl import brace_expand, split_and_expand, rglob, rexists
+from pylorax.ltmpl import template_lookup, set_template_cache_dir, clear_template_cache
+from pylorax.ltmpl import enable_template_profiler, disable_template_profiler
 from pylorax.sysutils import joinpaths
 
 class TemplateFunctionsTestCase(unittest.TestCase):
@@ -78,6 +81,36 @@ class LoraxTemplateTestCase(unittest.TestCase):
                                     ['installpkg', 'foo-one', 'foo-two'],
                                     ['run_pkg_transaction']])
 
+    def test_parse_cache(self):
+        """Test reusing the commands parsed from a template"""
+        self.assertTrue(template_lookup(self.templates.directories) is template_lookup(self.templates.directories))
+
+        commands = self.templates.parse("parse-test.tmpl", {"basearch": "x86_64"}, cache=True)
+        commands.append(["changed"])
+        self.assertEqual(self.templates.parse("parse-test.tmpl", {"basearch": "x86_64"}, cache=True),
+                         [['installpkg', 'common-package'],
+                          ['installpkg', 'foo-one', 'foo-two'],
+                          ['installpkg', 'not-s390x-package'],
+                          ['run_pkg_transaction']])
+        self.assertEqual(self.templates.parse("parse-test.tmpl", {"basearch": "s390x"}, cache=True),
+                         [['installpkg', 'common-package'],
+                          ['installpkg', 'foo-one', 'foo-two'],
+                          ['run_pkg_transaction']])
+
+    def test_compiled_template_cache(self):
+        """Test saving the compiled templates"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as cache_dir:
+            try:
+                clear_template_cache()
+                set_template_cache_dir(cache_dir)
+                self.templates.parse("parse-test.tmpl", {"basearch": "x86_64"})
+                compiled = [f for _root, _dirs, files in os.walk(joinpaths(cache_dir, str(os.geteuid())))
+                            for f in files if f.startswith("parse-test.tmpl")]
+                self.assertTrue(compiled)
+            finally:
+                set_template_cache_dir(None)
+                clear_template_cache()
+
 @contextmanager
 def in_tempdir(prefix='tmp'):
     """Execute a block of code with chdir in a temporary location"""
@@ -246,6 +279,28 @@ class LoraxTemplateRunnerTestCase(unittest.TestCase):
         self.runner.run("remove-cmd.tmpl")
         self.assertFalse(os.path.exists(joinpaths(self.root_dir, "/lorax-file")))
 
+    def test_profile_templates(self):
+        """Test profiling the template commands"""
+        try:
+            profiler = enable_template_profiler()
+            self.runner.run("copy-cmd.tmpl")
+        finally:
+            disable_template_profiler()
+
+        self.assertEqual([e["command"] for e in profiler.lines], ["append", "copy"])
+        copy_entry = profiler.lines[1]
+        self.assertEqual(copy_entry["args"], "/lorax-file /copied-file")
+        self.assertEqual(copy_entry["command_index"], 2)
+        self.assertEqual(copy_entry["files"], 1)
+        self.assertEqual(copy_entry["bytes"], os.path.getsize(joinpaths(self.root_dir, "/lorax-file")))
+        self.assertEqual(profiler.commands()["copy"]["count"], 1)
+
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as logdir:
+            profiler.write(logdir)
+            with open(joinpaths(logdir, "template-profile.json")) as f:
+                self.assertEqual(json.load(f)["lines"], profiler.lines)
+            self.assertTrue("copy-cmd.tmpl command 2: copy" in open(joinpaths(logdir, "template-profile.txt")).read())
+
     def test_chmod(self):
         """Test chmod template command"""
         self.runner.run("chmod-cmd.tmpl")
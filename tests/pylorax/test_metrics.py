@@ -0,0 +1,129 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import tempfile
+import unittest
+from unittest import mock
+
+from pylorax.api.metrics import Registry, Counter, Gauge, Histogram, TimedLock, LOCK_WAIT_SECONDS
+from pylorax.api.metrics import LOCK_HOLD_SECONDS, lock_status, set_lock_warn_seconds
+from pylorax.api.metrics import write_metrics_file, read_metrics_file
+from pylorax.sysutils import joinpaths
+
+class MetricsTest(unittest.TestCase):
+    def test_counter(self):
+        """Test the text format of a counter"""
+        registry = Registry()
+        c = Counter("test_requests_total", "Number of requests", ("route", "code"), registry=registry)
+        c.inc(route="/api/status", code=200)
+        c.inc(2, route="/api/status", code=200)
+        c.inc(route='/a"b', code=400)
+        self.assertEqual(c.get(route="/api/status", code=200), 3)
+        self.assertEqual(registry.exposition(),
+                         "# HELP test_requests_total Number of requests\n"
+                         "# TYPE test_requests_total counter\n"
+                         'test_requests_total{route="/a\\"b",code="400"} 1\n'
+                         'test_requests_total{route="/api/status",code="200"} 3\n')
+
+        with self.assertRaises(ValueError):
+            c.inc(route="/api/status")
+        with self.assertRaises(ValueError):
+            Counter("test_requests_total", "Duplicate", registry=registry)
+
+    def test_gauge(self):
+        """Test setting a gauge"""
+        registry = Registry()
+        g = Gauge("test_queue_depth", "Queue depth", ("queue",), registry=registry)
+        g.set(5, queue="new")
+        g.dec(queue="new")
+        g.inc(0.5, queue="run")
+        self.assertEqual(registry.exposition(),
+                         "# HELP test_queue_depth Queue depth\n"
+                         "# TYPE test_queue_depth gauge\n"
+                         'test_queue_depth{queue="new"} 4\n'
+                         'test_queue_depth{queue="run"} 0.5\n')
+
+    def test_histogram(self):
+        """Test the buckets of a histogram"""
+        registry = Registry()
+        h = Histogram("test_seconds", "Durations", registry=registry, buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            h.observe(value)
+        self.assertEqual(h.get(), (3.65, 4))
+        self.assertEqual(registry.exposition(),
+                         "# HELP test_seconds Durations\n"
+                         "# TYPE test_seconds histogram\n"
+                         'test_seconds_bucket{le="0.1"} 2\n'
+                         'test_seconds_bucket{le="1"} 3\n'
+                         'test_seconds_bucket{le="+Inf"} 4\n'
+                         'test_seconds_sum 3.65\n'
+                         'test_seconds_count 4\n')
+
+        with h.time():
+            pass
+        self.assertEqual(h.get()[1], 5)
+
+    def test_timed_lock(self):
+        """Test that the lock's wait time is recorded"""
+        lock = TimedLock("test-lock")
+        before = (LOCK_WAIT_SECONDS.get(lock="test-lock") or (0, 0))[1]
+        with lock:
+            self.assertTrue(lock.locked())
+            self.assertFalse(lock.acquire(blocking=False))
+        self.assertFalse(lock.locked())
+        self.assertEqual(LOCK_WAIT_SECONDS.get(lock="test-lock")[1], before + 1)
+
+    def test_lock_holder(self):
+        """Test recording who holds the lock and for how long"""
+        lock = TimedLock("test-holder")
+        with lock:
+            status = [s for s in lock_status() if s["name"] == "test-holder"][0]
+            self.assertEqual(status["holder"], __name__ + ".test_lock_holder")
+            self.assertTrue(status["locked"])
+        status = lock.status()
+        self.assertEqual((status["locked"], status["holder"], status["held_seconds"]), (False, None, 0))
+        self.assertEqual(status["max_hold_holder"], __name__ + ".test_lock_holder")
+        self.assertEqual(LOCK_HOLD_SECONDS.get(lock="test-holder", holder=__name__ + ".test_lock_holder")[1], 1)
+
+        def take_lock():
+            lock.acquire()
+            lock.release()
+        take_lock()
+        self.assertEqual(LOCK_HOLD_SECONDS.get(lock="test-holder", holder=__name__ + ".take_lock")[1], 1)
+
+    def test_slow_hold_warning(self):
+        """Test the warning about holding a lock for too long"""
+        lock = TimedLock("test-slow")
+        try:
+            set_lock_warn_seconds(1)
+            with mock.patch("pylorax.api.metrics.time.monotonic", side_effect=[10, 10, 12]):
+                with self.assertLogs("lorax-composer", level="WARNING") as cm:
+                    with lock:
+                        pass
+            self.assertIn("The test-slow lock was held for 2.00s by %s.test_slow_hold_warning" % __name__, cm.output[0])
+        finally:
+            set_lock_warn_seconds(0)
+
+    def test_metrics_file(self):
+        """Test passing metrics through a file"""
+        registry = Registry()
+        c = Counter("test_composes_total", "Composes", registry=registry)
+        c.inc()
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            path = joinpaths(tmp_dir, "monitor.prom")
+            self.assertEqual(read_metrics_file(path), "")
+            write_metrics_file(registry, path)
+            self.assertEqual(read_metrics_file(path), registry.exposition())
@@ -0,0 +1,79 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import socket
+import tempfile
+import unittest
+
+from pylorax.monitor import LogMonitor, ERROR_PATTERNS, compile_error_patterns
+from pylorax.sysutils import joinpaths
+
+class LogMonitorTest(unittest.TestCase):
+    def send_log(self, data, error_patterns=None):
+        """Send data to a LogMonitor and return the log file, error flag, and error line"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            log_path = joinpaths(tmp_dir, "virt-install.log")
+            monitor = LogMonitor(log_path, error_patterns=error_patterns)
+            try:
+                with socket.create_connection((monitor.host, monitor.port)) as s:
+                    # Send it in small pieces so that lines and characters are split
+                    for i in range(0, len(data), 7):
+                        s.sendall(data[i:i+7])
+                # The handler exits when the connection is closed
+                monitor.server_thread.join(10)
+            finally:
+                monitor.shutdown()
+            with open(log_path, "rb") as f:
+                return (f.read(), monitor.server.log_error, monitor.server.error_line)
+
+    def no_error_test(self):
+        """Test a log without errors"""
+        data = "Starting installer\nInstalling packages ✓\nDone\n".encode("utf-8")
+        self.assertEqual(self.send_log(data), (data, False, ""))
+
+    def error_test(self):
+        """Test a log with errors"""
+        data = b"Starting installer\nTraceback (most recent call last):\n  File \"foo.py\"\n"
+        self.assertEqual(self.send_log(data), (data, True, "Traceback (most recent call last):"))
+
+        data = b"info\n12:00 packaging: base repo (http://example.com) not valid\n"
+        self.assertEqual(self.send_log(data), (data, True, "12:00 packaging: base repo (http://example.com) not valid"))
+
+    def last_line_test(self):
+        """Test an error in a last line without a newline"""
+        data = b"info\nOut of memory: Killed process 1"
+        self.assertEqual(self.send_log(data), (data, True, "Out of memory: Killed process 1"))
+
+    def ignored_test(self):
+        """Test that errors in IGNORED lines are skipped"""
+        data = b"Call Trace: IGNORED\ninfo\n"
+        self.assertEqual(self.send_log(data), (data, False, ""))
+
+        data = b"Call Trace: IGNORED\ninfo\nCall Trace: oops\n"
+        self.assertEqual(self.send_log(data), (data, True, "Call Trace: oops"))
+
+    def custom_patterns_test(self):
+        """Test passing the error patterns"""
+        data = b"Traceback (most recent call last):\nFATAL: disk on fire\n"
+        self.assertEqual(self.send_log(data, [r"^FATAL:"]), (data, True, "FATAL: disk on fire"))
+
+    def compile_test(self):
+        """Test combining the error patterns"""
+        error_re = compile_error_patterns(ERROR_PATTERNS)
+        self.assertIsNotNone(error_re.search("one\ncrashed on signal 11\n"))
+        self.assertIsNotNone(error_re.search("packaging: foo requires bar"))
+        self.assertIsNone(error_re.search("packaging: foo\nrequires bar"))
+        self.assertIsNone(error_re.search("Traceback"))
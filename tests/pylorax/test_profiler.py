@@ -0,0 +1,105 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from pylorax.api.profiler import RequestProfiler, PEER_UID_ENVIRON, parse_uids, peer_uid, route_filename
+
+def slow_function():
+    return sum(i * i for i in range(10000))
+
+class ProfilerTest(unittest.TestCase):
+    def test_route_filename(self):
+        """Test converting routes to filenames"""
+        self.assertEqual(route_filename("/api/v0/blueprints/changes/<blueprint_names>"),
+                         "api_v0_blueprints_changes_blueprint_names")
+        self.assertEqual(route_filename("/"), "unknown")
+
+    def test_parse_uids(self):
+        """Test parsing the allowed users"""
+        self.assertEqual(parse_uids("root, 1000,,no-such-user-here"), set([0, 1000]))
+        self.assertEqual(parse_uids(""), set())
+
+    def test_peer_uid(self):
+        """Test getting the uid of the client"""
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        with a, b:
+            self.assertEqual(peer_uid(a), os.getuid())
+
+    def test_wanted(self):
+        """Test which requests are profiled"""
+        profiler = RequestProfiler("/tmp/profiles")
+        self.assertFalse(profiler.enabled)
+
+        profiler = RequestProfiler("/tmp/profiles", uids=set([1000]))
+        self.assertTrue(profiler.enabled)
+        self.assertTrue(profiler.wanted({PEER_UID_ENVIRON: 1000}, {"X-Composer-Profile": "1"}))
+        self.assertFalse(profiler.wanted({PEER_UID_ENVIRON: 1000}, {}))
+        self.assertFalse(profiler.wanted({PEER_UID_ENVIRON: 1001}, {"X-Composer-Profile": "1"}))
+        self.assertFalse(profiler.wanted({}, {"X-Composer-Profile": "1"}))
+
+        profiler = RequestProfiler("/tmp/profiles", always=True)
+        self.assertTrue(profiler.wanted({}, {}))
+
+    def test_profile_report(self):
+        """Test saving profiles and adding them together"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            profiler = RequestProfiler(os.path.join(tmp_dir, "profiles"), always=True, max_profiles=2)
+            self.assertTrue(profiler.report().startswith("No profiles"))
+
+            for route in ["/api/v0/blueprints/changes/<blueprint_names>", "/api/v0/projects/info/<project_names>",
+                          "/api/v0/projects/info/<project_names>"]:
+                profile = profiler.start()
+                # Only one request is profiled at a time
+                self.assertIsNone(profiler.start())
+                slow_function()
+                self.assertIsNotNone(profiler.finish(profile, route, "GET"))
+
+            # The oldest profile is removed
+            profiles = profiler.profiles()
+            self.assertEqual(len(profiles), 2)
+            self.assertTrue(all(p.endswith("-GET-api_v0_projects_info_project_names.prof") for p in profiles))
+
+            report = profiler.report()
+            self.assertIn("api_v0_projects_info_project_names", report)
+            self.assertIn("slow_function", report)
+            self.assertTrue(profiler.report(route="/api/v0/blueprints/changes/<blueprint_names>").startswith("No profiles"))
+            with self.assertRaises(KeyError):
+                profiler.report(sort="nosuchkey")
+
+    def test_greenlet_switches(self):
+        """Test counting the greenlet switches while a request is profiled"""
+        fake_greenlet = mock.Mock()
+        fake_greenlet.settrace.return_value = None
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            with mock.patch("pylorax.api.profiler.greenlet", fake_greenlet):
+                profiler = RequestProfiler(os.path.join(tmp_dir, "profiles"), always=True)
+                profile = profiler.start()
+                trace = fake_greenlet.settrace.call_args[0][0]
+                trace("switch", (None, None))
+                trace("throw", (None, None))
+                trace("other", (None, None))
+                self.assertIsNotNone(profiler.finish(profile, "/api/v0/projects/list", "GET"))
+                # The previous trace function is restored
+                fake_greenlet.settrace.assert_called_with(None)
+
+            report = profiler.report().splitlines()
+            self.assertEqual(report[0].split()[-1], "switches")
+            self.assertEqual(report[1].split()[-1], "2")
@@ -0,0 +1,105 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from pylorax.progress import ProgressLog, StageTimer, read_progress, read_stage_times
+from pylorax.sysutils import joinpaths
+
+INSTALL_LOG = """Starting installer, one moment...
+anaconda 31.22-1 for Fedora 31 started.
+Downloading packages
+Downloading 3 RPMs, 1.2 MiB / 3.4 MiB (35%) done.
+Preparing transaction from installation source
+Installing bash.x86_64 (1/3)
+Installing filesystem.x86_64 (2/3)
+Installing glibc.x86_64 (3/3)
+Performing post-installation setup tasks
+Configuring installed system
+Installing boot loader
+Storing configuration files and kickstarts
+"""
+
+class ProgressTest(unittest.TestCase):
+    def progress_log_test(self):
+        """Test writing the progress log"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            path = joinpaths(tmp_dir, "progress.jsonl")
+            progress = ProgressLog(path)
+            with mock.patch("pylorax.progress.PACKAGE_EVENT_INTERVAL", 3600):
+                progress.check_lines(INSTALL_LOG)
+            # Progress from the remote log that has already been seen is not written again
+            progress.check_lines("Downloading packages\nInstalling glibc.x86_64 (3/3)\n")
+            progress.close()
+            progress.check_lines("Installing boot loader\n")
+
+            events = [json.loads(line) for line in open(path)]
+            self.assertEqual([(e["event"], e.get("phase"), e.get("done")) for e in events],
+                             [("phase", "setup", None), ("phase", "download", None),
+                              ("phase", "transaction", None), ("phase", "install", None),
+                              ("packages", None, 1), ("packages", None, 3),
+                              ("phase", "post-install", None), ("phase", "configure", None),
+                              ("phase", "bootloader", None), ("phase", "finish", None)])
+
+    def read_progress_test(self):
+        """Test summarizing the progress log"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            path = joinpaths(tmp_dir, "progress.jsonl")
+            self.assertEqual(read_progress(path), None)
+
+            with open(path, "w") as f:
+                f.write('{"event": "phase", "phase": "download", "time": 10.0}\n')
+                f.write('{"event": "phase", "phase": "install", "time": 20.0}\n')
+                f.write('{"done": 5, "event": "packages", "time": 25.0, "total": 10}\n')
+                f.write('{"done": 7, "eve')
+            self.assertEqual(read_progress(path),
+                             {"phase": "install", "phase_started": 20.0,
+                              "packages_done": 5, "packages_total": 10, "updated": 25.0,
+                              "phases": [{"phase": "download", "started": 10.0},
+                                         {"phase": "install", "started": 20.0}]})
+
+    def phase_durations_test(self):
+        """Test the duration of the installer's phases"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            progress = ProgressLog(joinpaths(tmp_dir, "progress.jsonl"))
+            with mock.patch("pylorax.progress.time.time", side_effect=[10.0, 10.0, 25.0, 25.0, 40.0]):
+                progress.check_lines("Downloading packages\nStarting package installation process\n")
+                self.assertEqual(progress.phase_durations(), [("download", 10.0, 15.0), ("install", 25.0, 15.0)])
+            progress.close()
+
+    def stage_timer_test(self):
+        """Test recording the stages of a build"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            path = joinpaths(tmp_dir, "stages.jsonl")
+            timer = StageTimer()
+            with timer.stage("depsolve"):
+                pass
+            self.assertEqual(read_stage_times(path), [])
+
+            # Stages before the path is set are written when it is set
+            timer.set_path(path)
+            with self.assertRaises(RuntimeError):
+                with timer.stage("kickstart"):
+                    raise RuntimeError("failed")
+            timer.record("anaconda", 1.0, 600.0)
+
+            stages = read_stage_times(path)
+            self.assertEqual([(s["stage"], s["failed"]) for s in stages],
+                             [("anaconda", False), ("depsolve", False), ("kickstart", True)])
+            self.assertEqual(stages[0], {"stage": "anaconda", "started": 1.0, "duration": 600.0, "failed": False})
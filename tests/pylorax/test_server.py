@@ -15,12 +15,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import io
 import os
 from configparser import ConfigParser, NoOptionError
 from contextlib import contextmanager
 from glob import glob
 from rpmfluff import SimpleRpmBuild, expectedArch
 import shutil
+import tarfile
 import tempfile
 import time
 from threading import Lock
@@ -35,6 +37,7 @@ from pylorax.api.recipes import open_or_create_repo, commit_recipe_directory
 from pylorax.api.server import server, GitLock
 import pylorax.api.toml as toml
 from pylorax.api.dnfbase import DNFLock
+from pylorax.api.profiler import RequestProfiler
 from pylorax.sysutils import joinpaths
 
 # Used for testing UTF-8 input support
@@ -179,6 +182,52 @@ class ServerTestCase(unittest.TestCase):
         # Check for test message
         self.assertEqual(data["msgs"], ["Test message"])
 
+    def test_01_metrics(self):
+        """Test the /api/metrics route"""
+        self.server.get("/api/status")
+        with server.config["DNFLOCK"].lock:
+            pass
+        resp = self.server.get("/api/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        metrics = resp.data.decode("utf-8")
+        self.assertIn('lorax_composer_http_requests_total{route="/api/status",method="GET",code="200"}', metrics)
+        self.assertIn('lorax_composer_http_request_duration_seconds_count{route="/api/status"}', metrics)
+        self.assertIn('lorax_composer_queue_depth{queue="new"}', metrics)
+        self.assertIn('lorax_composer_lock_wait_seconds_count{lock="dnf"}', metrics)
+        self.assertIn('lorax_composer_template_cache_lookups_total{result="hit"}', metrics)
+
+    def test_01_debug_locks(self):
+        """Test the /api/debug/locks route"""
+        resp = self.server.get("/api/debug/locks")
+        data = json.loads(resp.data)
+        dnf_lock = [l for l in data["locks"] if l["name"] == "dnf"][0]
+        self.assertEqual(sorted(dnf_lock.keys()), ["held_seconds", "holder", "locked", "max_hold_holder",
+                                                   "max_hold_seconds", "name", "waiting"])
+        self.assertEqual(dnf_lock["waiting"], 0)
+
+    def test_01_debug_profiles(self):
+        """Test profiling requests and the /api/debug/profiles route"""
+        resp = self.server.get("/api/debug/profiles")
+        self.assertEqual(resp.status_code, 400)
+
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmp_dir:
+            server.config["PROFILER"] = RequestProfiler(tmp_dir, always=True)
+            try:
+                self.server.get("/api/status")
+                self.server.get("/api/v0/blueprints/info/example-http-server")
+                self.assertEqual(len(server.config["PROFILER"].profiles()), 2)
+
+                resp = self.server.get("/api/debug/profiles?route=/api/v0/blueprints/info/<blueprint_names>")
+                self.assertEqual(resp.status_code, 200)
+                report = resp.data.decode("utf-8")
+                self.assertIn("api_v0_blueprints_info_blueprint_names", report)
+                self.assertNotIn("api_status", report)
+
+                resp = self.server.get("/api/debug/profiles?sort=nosuchkey")
+                self.assertEqual(resp.status_code, 400)
+            finally:
+                server.config["PROFILER"] = None
 
     def test_02_blueprints_list(self):
         """Test the /api/v0/blueprints/list route"""
@@ -946,6 +995,20 @@ class ServerTestCase(unittest.TestCase):
         self.assertEqual(data["errors"], [{"id": UNKNOWN_UUID, "msg": "NO-UUID-TO-SEE-HERE is not a valid build uuid"}],
                                          "Failed to get errors: %s" % data)
 
+    def test_compose_10_log_follow_fail(self):
+        """Test that following the log with a bad uuid or cursor fails."""
+        resp = self.server.get("/api/v0/compose/log/NO-UUID-TO-SEE-HERE?follow=1")
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["errors"], [{"id": UNKNOWN_UUID, "msg": "NO-UUID-TO-SEE-HERE is not a valid build uuid"}],
+                                         "Failed to get errors: %s" % data)
+
+        resp = self.server.get("/api/v0/compose/log/NO-UUID-TO-SEE-HERE?follow=1&cursor=program:10")
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["errors"], [{"id": COMPOSE_ERROR, "msg": "Invalid log cursor: program:10"}],
+                                         "Failed to get errors: %s" % data)
+
     def test_compose_11_create_failed(self):
         """Test the /api/v0/compose routes with a failed test compose"""
         test_compose = {"blueprint_name": "example-glusterfs",
@@ -1065,6 +1128,13 @@ class ServerTestCase(unittest.TestCase):
         self.assertNotEqual(data, None)
         self.assertEqual(data["queue_status"], "FINISHED", "Build not in FINISHED state")
 
+        # Following the log of a finished compose ends with its status
+        resp = self.server.get("/api/v0/compose/log/%s?follow=1" % build_id)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertTrue(resp.data.decode("utf-8").endswith("event: end\nid: combined:%d\ndata: FINISHED\n\n" %
+                        os.path.getsize(joinpaths(server.config["COMPOSER_CFG"].get("composer", "lib_dir"),
+                                                  "results", build_id, "logs", "combined.log"))))
+
         # Test the /api/v0/compose/finished route
         resp = self.server.get("/api/v0/compose/finished")
         data = json.loads(resp.data)
@@ -1094,12 +1164,48 @@ class ServerTestCase(unittest.TestCase):
         resp = self.server.get("/api/v0/compose/results/%s" % build_id)
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(resp.data) > 1024, True)
+        self.assertEqual(int(resp.headers["Content-Length"]), len(resp.data))
+        with tarfile.open(fileobj=io.BytesIO(resp.data)) as tar:
+            self.assertTrue("logs/combined.log" in tar.getnames())
+
+        # Test the compressed /api/v0/compose/logs/<uuid> route
+        resp = self.server.get("/api/v0/compose/logs/%s?compression=gzip" % build_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/gzip")
+        self.assertTrue(("%s-logs.tar.gz" % build_id) in resp.headers["Content-Disposition"])
+        with tarfile.open(fileobj=io.BytesIO(resp.data), mode="r:gz") as tar:
+            self.assertTrue("logs/combined.log" in tar.getnames())
+
+        resp = self.server.get("/api/v0/compose/logs/%s?compression=bzip2" % build_id)
+        self.assertEqual(resp.status_code, 400)
 
         # Test the /api/v0/compose/image/<uuid> route
         resp = self.server.get("/api/v0/compose/image/%s" % build_id)
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(resp.data) > 0, True)
         self.assertEqual(resp.data, b"TEST IMAGE")
+        self.assertEqual(resp.headers["Accept-Ranges"], "bytes")
+        etag = resp.headers["ETag"]
+
+        # Resume the download of the image
+        resp = self.server.get("/api/v0/compose/image/%s" % build_id,
+                               headers={"Range": "bytes=5-", "If-Range": etag})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers["Content-Range"], "bytes 5-9/10")
+        self.assertEqual(resp.data, b"IMAGE")
+
+        # The whole image is sent when If-Range does not match
+        resp = self.server.get("/api/v0/compose/image/%s" % build_id,
+                               headers={"Range": "bytes=5-", "If-Range": '"changed"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"TEST IMAGE")
+
+        resp = self.server.get("/api/v0/compose/image/%s" % build_id, headers={"Range": "bytes=10-"})
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp.headers["Content-Range"], "bytes */10")
+
+        resp = self.server.get("/api/v0/compose/image/%s" % build_id, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
 
         # Examine the final-kickstart.ks for the customizations
         # A bit kludgy since it examines the filesystem directly, but that's better than unpacking the metadata
@@ -14,13 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import hashlib
 import io
+import threading
 import unittest
+from unittest import mock
 import tempfile
 import os
 
-from pylorax.sysutils import joinpaths, touch, replace, chown_, chmod_, remove, linktree
-from pylorax.sysutils import _read_file_end
+from pylorax.sysutils import joinpaths, touch, replace, chown_, chmod_, remove, linktree, clonefile
+from pylorax.sysutils import publish_file, publish_tree, _copy_and_hash
+from pylorax.sysutils import _read_file_end, _cgroup_cpu_limit, cpu_budget, set_cpu_budget, run_stages
+from pylorax.sysutils import replace_files, remove_files
 
 class SysUtilsTest(unittest.TestCase):
     def joinpaths_test(self):
@@ -65,6 +70,52 @@ class SysUtilsTest(unittest.TestCase):
         remove(remove_file)
         self.assertFalse(os.path.exists(remove_file))
 
+    def replace_files_test(self):
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tdname:
+            changed = os.path.join(tdname, "changed")
+            open(changed, "wb").write(b"@VERSION@\r\nkeep \xff\n@VERSION@@VERSION@\n")
+            unchanged = os.path.join(tdname, "unchanged")
+            open(unchanged, "w").write("nothing to see\n")
+            os.utime(unchanged, (0, 0))
+
+            self.assertEqual(replace_files([changed, unchanged], "@VERSION@", "31"), [changed])
+            self.assertEqual(open(changed, "rb").read(), b"31\r\nkeep \xff\n3131\n")
+            self.assertEqual(os.stat(unchanged).st_mtime, 0)
+
+    def remove_files_test(self):
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tdname:
+            keep = os.path.join(tdname, "keep")
+            os.makedirs(os.path.join(keep, "dir"))
+            open(os.path.join(keep, "dir", "file"), "w").write("keep")
+            tree = os.path.join(tdname, "tree")
+            for i in range(10):
+                os.makedirs(os.path.join(tree, "sub%d" % i, "deeper"))
+                for j in range(10):
+                    open(os.path.join(tree, "sub%d" % i, "deeper", "file%d" % j), "w").write("x")
+            os.symlink(os.path.join(keep, "dir"), os.path.join(tree, "link"))
+            single = os.path.join(tdname, "single")
+            open(single, "w").write("x")
+
+            targets = [tree, tree + "/", os.path.join(tree, "sub1"), os.path.join(tree, "sub2", "deeper", "file3"), single]
+            # 100 files, a symlink, 21 directories and a file
+            self.assertEqual(remove_files(targets, workers=4), 123)
+            self.assertEqual(os.listdir(tdname), ["keep"])
+            self.assertTrue(os.path.exists(os.path.join(keep, "dir", "file")))
+
+    def remove_files_symlinked_dir_test(self):
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tdname:
+            os.makedirs(os.path.join(tdname, "usr", "lib", "modules"))
+            open(os.path.join(tdname, "usr", "lib", "modules", "file"), "w").write("x")
+            os.symlink("usr/lib", os.path.join(tdname, "lib"))
+
+            # The same file through the symlinked directory, the directory, and a missing file
+            targets = [os.path.join(tdname, "lib", "modules", "file"),
+                       os.path.join(tdname, "usr", "lib", "modules"),
+                       os.path.join(tdname, "lib", "modules", "missing")]
+            self.assertEqual(remove_files(targets), 2)
+            self.assertEqual(os.listdir(os.path.join(tdname, "usr", "lib")), [])
+            self.assertTrue(os.path.islink(os.path.join(tdname, "lib")))
+
     def linktree_test(self):
         with tempfile.TemporaryDirectory() as tdname:
             path = os.path.join("one", "two", "three")
@@ -75,6 +126,138 @@ class SysUtilsTest(unittest.TestCase):
 
             self.assertTrue(os.path.exists(os.path.join(tdname, "copy", "two", "three", "lorax-link-test-file")))
 
+    def clonefile_test(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            src = os.path.join(tdname, "lorax-clone-src")
+            dst = os.path.join(tdname, "lorax-clone-dst")
+            open(src, "wb").write(os.urandom(3 * 1024**2 + 17))
+            os.chmod(src, 0o640)
+
+            self.assertIn(clonefile(src, dst), ["reflink", "copy_file_range", "copy"])
+            self.assertEqual(open(src, "rb").read(), open(dst, "rb").read())
+            self.assertEqual(os.stat(dst).st_mode, 0o100640)
+
+    def copy_and_hash_test(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            data = os.urandom(2 * 1024**2 + 5)
+            open(os.path.join(tdname, "src"), "wb").write(data)
+            with open(os.path.join(tdname, "src"), "rb") as src_fp:
+                with open(os.path.join(tdname, "dst"), "wb") as dst_fp:
+                    digest = _copy_and_hash(src_fp, dst_fp, "sha256")
+            self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+            self.assertEqual(open(os.path.join(tdname, "dst"), "rb").read(), data)
+
+    def publish_file_test(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            src = os.path.join(tdname, "src")
+            dst = os.path.join(tdname, "dst")
+            open(src, "w").write("lorax test file")
+            self.assertEqual(publish_file(src, dst, "sha256"), ("rename", None))
+            self.assertFalse(os.path.exists(src))
+            self.assertEqual(open(dst).read(), "lorax test file")
+
+            # Symlinks are replaced by the file they point to
+            os.symlink(dst, src)
+            method, _ = publish_file(src, os.path.join(tdname, "copy"), "sha256")
+            self.assertNotEqual(method, "rename")
+            self.assertFalse(os.path.lexists(src))
+            self.assertFalse(os.path.islink(os.path.join(tdname, "copy")))
+            self.assertEqual(open(os.path.join(tdname, "copy")).read(), "lorax test file")
+
+            # A copy that does not match the recorded digest is removed, the source is kept
+            os.symlink(dst, src)
+            with mock.patch("pylorax.sysutils.fcntl.ioctl", side_effect=OSError):
+                with self.assertRaises(OSError):
+                    publish_file(src, os.path.join(tdname, "bad"), "sha256", expected="0" * 64)
+                self.assertFalse(os.path.exists(os.path.join(tdname, "bad")))
+                self.assertTrue(os.path.lexists(src))
+
+                expected = hashlib.sha256(b"lorax test file").hexdigest()
+                self.assertEqual(publish_file(src, os.path.join(tdname, "good"), "sha256", expected=expected),
+                                 ("copy", expected))
+
+    def publish_tree_test(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            src = os.path.join(tdname, "src")
+            os.makedirs(os.path.join(src, "images", "pxeboot"))
+            open(os.path.join(src, "images", "boot.iso"), "w").write("lorax iso")
+            open(os.path.join(src, "images", "pxeboot", "vmlinuz"), "w").write("lorax kernel")
+            os.symlink("../boot.iso", os.path.join(src, "images", "pxeboot", "boot.iso"))
+            os.symlink("images/pxeboot", os.path.join(src, "pxeboot"))
+            os.makedirs(os.path.join(tdname, "dst"))
+
+            publish_tree(src, os.path.join(tdname, "dst"))
+            self.assertFalse(os.path.exists(os.path.join(src, "images", "boot.iso")))
+            for path, data in [("images/boot.iso", "lorax iso"),
+                               ("images/pxeboot/vmlinuz", "lorax kernel"),
+                               ("images/pxeboot/boot.iso", "lorax iso"),
+                               ("pxeboot/vmlinuz", "lorax kernel")]:
+                self.assertFalse(os.path.islink(os.path.join(tdname, "dst", path)))
+                self.assertEqual(open(os.path.join(tdname, "dst", path)).read(), data)
+
+    def cgroup_cpu_limit_test(self):
+        with tempfile.TemporaryDirectory() as tdname:
+            proc_cgroup = os.path.join(tdname, "cgroup")
+            open(proc_cgroup, "w").write("0::/system.slice/lorax.service\n")
+            os.makedirs(os.path.join(tdname, "system.slice/lorax.service"))
+            open(os.path.join(tdname, "cpu.max"), "w").write("max 100000\n")
+
+            # No quotas anywhere
+            self.assertEqual(_cgroup_cpu_limit(tdname, proc_cgroup), None)
+
+            # Partial cpus are rounded up, the smallest quota wins
+            open(os.path.join(tdname, "system.slice/cpu.max"), "w").write("250000 100000\n")
+            self.assertEqual(_cgroup_cpu_limit(tdname, proc_cgroup), 3)
+            open(os.path.join(tdname, "system.slice/lorax.service/cpu.max"), "w").write("150000 100000\n")
+            self.assertEqual(_cgroup_cpu_limit(tdname, proc_cgroup), 2)
+
+            # cgroup v1 only
+            open(proc_cgroup, "w").write("4:cpu,cpuacct:/\n")
+            self.assertEqual(_cgroup_cpu_limit(tdname, proc_cgroup), None)
+
+    def cpu_budget_test(self):
+        self.assertTrue(cpu_budget() >= 1)
+        self.assertTrue(cpu_budget() <= os.cpu_count())
+        try:
+            set_cpu_budget(3)
+            self.assertEqual(cpu_budget(), 3)
+        finally:
+            set_cpu_budget(0)
+
+    def run_stages_test(self):
+        """Test running stages concurrently in dependency order"""
+        order = []
+        # squashfs and initramfs must both be running before either one can finish
+        barrier = threading.Barrier(2, timeout=10)
+        def stage(name, result):
+            def run():
+                if name in ("squashfs", "initramfs"):
+                    barrier.wait()
+                order.append(name)
+                return result
+            return run
+
+        results = run_stages({"pxe-config": (stage("pxe-config", 3), ["initramfs"]),
+                              "squashfs": (stage("squashfs", 1), []),
+                              "initramfs": (stage("initramfs", 2), [])})
+        self.assertEqual(results, {"squashfs": 1, "initramfs": 2, "pxe-config": 3})
+        self.assertTrue(order.index("pxe-config") > order.index("initramfs"))
+
+    def run_stages_error_test(self):
+        """Test that a failed stage stops the stages that depend on it"""
+        order = []
+        def fail():
+            raise RuntimeError("dracut failed")
+        with self.assertRaises(RuntimeError):
+            run_stages({"initramfs": (fail, []),
+                        "pxe-config": (lambda: order.append("pxe-config"), ["initramfs"])})
+        self.assertEqual(order, [])
+
+        with self.assertRaises(ValueError):
+            run_stages({"boot.iso": (lambda: None, ["runtime"])})
+        with self.assertRaises(ValueError):
+            run_stages({"a": (lambda: None, ["b"]), "b": (lambda: None, ["a"])})
+
     def _generate_lines(self, unicode=False):
         # helper to generate several KiB of lines of text
         bio = io.BytesIO()
@@ -0,0 +1,51 @@
+#
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import tempfile
+import unittest
+
+from pylorax.sysutils import joinpaths
+from pylorax.treebuilder import tree_sizes, tree_realpath
+
+class TreeBuilderTest(unittest.TestCase):
+    def tree_sizes_test(self):
+        """Test reading the sizes of everything under a directory"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root:
+            os.makedirs(joinpaths(root, "usr/bin"))
+            open(joinpaths(root, "usr/bin/true"), "w").write("x" * 100)
+            os.symlink("/usr/bin/true", joinpaths(root, "usr/bin/false"))
+
+            sizes = tree_sizes(root + "/")
+            self.assertEqual(sizes["/usr/bin/true"], 100)
+            self.assertEqual(sizes["/usr/bin/false"], len("/usr/bin/true"))
+            self.assertTrue("/usr" in sizes)
+            self.assertEqual(set(sizes), set(["/usr", "/usr/bin", "/usr/bin/true", "/usr/bin/false"]))
+
+    def tree_realpath_test(self):
+        """Test finding the sizes of files under symlinked directories"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root:
+            os.makedirs(joinpaths(root, "usr/lib/modules"))
+            open(joinpaths(root, "usr/lib/modules/modules.dep"), "w").write("x" * 100)
+            os.symlink("usr/lib", joinpaths(root, "lib"))
+            os.symlink("/usr/lib/modules/modules.dep", joinpaths(root, "usr/lib/modules.dep"))
+
+            realdirs = {}
+            self.assertEqual(tree_realpath(root, "/lib/modules/modules.dep", realdirs), "/usr/lib/modules/modules.dep")
+            self.assertEqual(tree_realpath(root, "/usr/lib/modules.dep", realdirs), "/usr/lib/modules.dep")
+            self.assertEqual(tree_realpath(root, "/lib", realdirs), "/lib")
+            self.assertEqual(tree_realpath(root, "/nonexistent/file", realdirs), "/nonexistent/file")
+            self.assertEqual(tree_sizes(root)[tree_realpath(root, "/lib/modules/modules.dep", realdirs)], 100)